@@ -2,18 +2,19 @@ import os
 from functools import wraps
 import sqlite3
 import time
-import json
-from datetime import timedelta
-import requests
+from datetime import datetime, timedelta
 import random
+import click
 from threading import Thread
 from dotenv import load_dotenv
 from base import Database
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify
+from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, send_file
 from werkzeug.utils import secure_filename
 from werkzeug.security import generate_password_hash, check_password_hash
-from parser.taobao import parse_taobao_product
-from parser.weidian import parse_weidian_product
+from catalog import detect_marketplace, import_product, bulk_import, resync_products, RESYNC_INTERVAL
+import http_client
+from image_proxy import image_cache, IMAGE_MAX_AGE
+from rates import rate_provider, get_cny_to_rub_rate, fetch_cbr_rates, convert_rub_to_cny, convert_cny_to_rub
 
 load_dotenv()
 UPLOAD_FOLDER = os.path.join('static', 'uploads')
@@ -54,6 +55,17 @@ os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs('instance', exist_ok=True)  # Убедимся, что папка instance существует
 db = Database(app)
 
+
+@rate_provider.on_refresh
+def store_fx_rates(payload):
+    # каждая удачная загрузка курсов ЦБ попадает в таблицу fx_rates
+    with app.app_context():
+        db.save_fx_rates(payload)
+
+# ответ, когда курса ЦБ нет ни в кэше, ни в ЦБ: без курса не двигаем балансы
+RATE_UNAVAILABLE = 'Курс ЦБ сейчас недоступен, повторите позже'
+
+
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
@@ -85,6 +97,19 @@ def start_cleanup_loop(db):
     thread = Thread(target=run, daemon=True)
     thread.start()
 
+def start_resync_loop(db):
+    def run():
+        with app.app_context():
+            while True:
+                try:
+                    resync_products(db)
+                except Exception as e:
+                    app.logger.error(f"Ошибка сверки товаров: {e}")
+                time.sleep(RESYNC_INTERVAL)
+
+    thread = Thread(target=run, daemon=True)
+    thread.start()
+
 @app.route('/profile')
 @login_required
 def profile():
@@ -207,6 +232,34 @@ def admin_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+# Рабочие статусы посылок — по умолчанию админка показывает их
+SHIPMENT_WORKING_STATUSES = ('pending', 'processing', 'shipped', 'delivered')
+
+# Разделы админки: метод страницы в Database, шаблон строк и статус (или статусы) по умолчанию
+ADMIN_SECTIONS = {
+    'replenishments': ('get_admin_replenishments', 'admin/_replenishment_rows.html', 'pending'),
+    'withdrawals': ('get_admin_withdrawals', 'admin/_withdrawal_rows.html', 'pending'),
+    'orders': ('get_admin_orders', 'admin/_order_rows.html', None),
+    'shipments': ('get_admin_shipments', 'admin/_shipment_rows.html', SHIPMENT_WORKING_STATUSES),
+}
+
+
+def admin_filters(section, args):
+    """Фильтры раздела из query string; status=all — без фильтра по статусу"""
+    filters = {key: (args.get(key) or '').strip() for key in ('status', 'date_from', 'date_to', 'user', 'tracking')}
+    if not filters['status']:
+        filters['status'] = ADMIN_SECTIONS[section][2]
+    elif filters['status'] == 'all':
+        filters['status'] = None
+    for key in ('date_from', 'date_to'):
+        if filters[key]:
+            try:
+                datetime.strptime(filters[key], '%Y-%m-%d')
+            except ValueError:
+                raise ValueError("Дата должна быть в формате ГГГГ-ММ-ДД")
+    return filters
+
+
 @app.route('/admin')
 @admin_required
 def admin_panel():
@@ -217,24 +270,58 @@ def admin_panel():
         flash('Пользователь не найден', 'error')
         return redirect(url_for('login'))
     
-    # Получаем все ожидающие заявки
-    pending_replenishments = db.get_pending_replenishments()
-    pending_withdrawals = db.get_pending_withdrawals()
-    orders = db.get_pending_orders()  
-    pending_shipments = db.get_pending_shipments()
-    print("DEBUG pending_shipments:", pending_shipments)
-    for s in pending_shipments:
-        print("DEBUG shipment:", s['id'], type(s['model_ids']), s['model_ids'])
+    # Только первые страницы разделов; дальше — /admin/api/<section>
+    pages, cursors = {}, {}
+    for section, (method, _, status) in ADMIN_SECTIONS.items():
+        pages[section], cursors[section] = getattr(db, method)({'status': status})
 
     return render_template(
         'admin/admin_panel.html',
         user=user,
-        replenishments=pending_replenishments,
-        withdrawals=pending_withdrawals,
-        orders=orders, 
-        shipments=pending_shipments
+        cursors=cursors,
+        **pages
     )
 
+@app.route('/admin/api/<section>')
+@admin_required
+def admin_section_page(section):
+    if section not in ADMIN_SECTIONS:
+        return jsonify({'success': False, 'error': 'Неизвестный раздел'}), 404
+    method, template, _ = ADMIN_SECTIONS[section]
+    try:
+        filters = admin_filters(section, request.args)
+        items, next_cursor = getattr(db, method)(filters, before=request.args.get('before') or None)
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+
+    return jsonify({
+        'success': True,
+        'items': items,
+        'next_cursor': next_cursor,
+        'html': render_template(template, **{section: items}),
+    })
+
+@app.route('/admin/http/stats')
+@admin_required
+def admin_http_stats():
+    # задержки исходящих запросов (tmapi, weidian, ЦБ) по хостам
+    return jsonify(http_client.stats())
+
+@app.route('/admin/db/stats')
+@admin_required
+def admin_db_stats():
+    # соединения SQLite, транзакции записи и ожидание блокировок
+    return jsonify(db.stats())
+
+@app.route('/admin/resync', methods=['POST'])
+@admin_required
+def admin_resync():
+    # внеочередная сверка цен и остатков товаров из корзин и заказов
+    try:
+        return jsonify(success=True, **resync_products(db))
+    except Exception as e:
+        return jsonify(success=False, error=str(e)), 500
+
 @app.route('/admin/shipments/<int:shipment_id>/packaging', methods=['POST'])
 def admin_set_packaging(shipment_id):
     # TODO: тут проверь, что user — админ
@@ -265,48 +352,6 @@ def admin_set_packaging(shipment_id):
         app.logger.exception("admin_set_packaging failed: %s", e)
         return jsonify({'success': False, 'error': 'DB error'}), 500
 
-def get_cny_to_rub_rate():
-    try:
-        url = "https://www.cbr-xml-daily.ru/daily_json.js"
-        response = requests.get(url, timeout=5)
-        response.raise_for_status()
-        data = response.json()
-        cny_rate = data["Valute"]["CNY"]["Value"]
-        return cny_rate
-    except Exception as e:
-        app.logger.error(f"Ошибка при получении курса: {str(e)}")
-        return None
-    
-def fetch_cbr_rates():
-    try:
-        url = "https://www.cbr-xml-daily.ru/daily_json.js"
-        r = requests.get(url, timeout=5)
-        r.raise_for_status()
-        data = r.json()
-        usd = data["Valute"]["USD"]["Value"]
-        cny = data["Valute"]["CNY"]["Value"]
-        return {"USD": float(usd), "CNY": float(cny)}
-    except Exception as e:
-        app.logger.error(f"Ошибка при получении курса ЦБ: {e}")
-        return None
-    
-def convert_rub_to_cny(rub_amount):
-    cny_to_rub_rate = get_cny_to_rub_rate()
-    if cny_to_rub_rate is None:
-        return None
-    rub_to_cny_rate = 1 / cny_to_rub_rate
-    cny_amount = rub_amount * rub_to_cny_rate
-    
-    return round(cny_amount, 2)
-
-def convert_cny_to_rub(cny_amount):
-    cny_to_rub_rate = get_cny_to_rub_rate()
-    if cny_to_rub_rate is None:
-        return None
-    
-    rub_amount = cny_amount * cny_to_rub_rate
-    return round(rub_amount, 2)
-
 @app.route('/logout')
 @login_required
 def logout():
@@ -346,17 +391,32 @@ def balance():
     user_id = session['user']['id']
     
     # Получаем текущие балансы
-    balance_rub = db.get_balance(user_id)['rub']
-    balance_cny = db.get_balance(user_id)['cny']
+    balance = db.get_balance(user_id)
     
-    # Получаем историю транзакций
-    transactions = db.get_balance_history(user_id)
-    print(transactions)
+    # Первая страница истории и помесячные итоги; дальше — /profile/balance/history
+    transactions, next_cursor = db.get_balance_history(user_id)
+    rollups = db.get_balance_rollups(user_id)
     
     return render_template('profile/balance.html',
-                         balance_rub=balance_rub,
-                         balance_cny=balance_cny,
-                         transactions=transactions)
+                         balance_rub=balance['rub'],
+                         balance_cny=balance['cny'],
+                         transactions=transactions,
+                         next_cursor=next_cursor,
+                         rollups=rollups)
+
+@app.route('/profile/balance/history')
+@login_required
+def balance_history():
+    try:
+        transactions, next_cursor = db.get_balance_history(
+            session['user']['id'], before=request.args.get('before') or None
+        )
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    
+    for t in transactions:
+        t['date'] = t['date'].strftime('%d.%m.%Y %H:%M') if hasattr(t['date'], 'strftime') else t['date']
+    return jsonify({'success': True, 'transactions': transactions, 'next_cursor': next_cursor})
 
 @app.route('/profile/replenishment', methods=['GET', 'POST'])
 @login_required
@@ -379,7 +439,13 @@ def replenishment():
                 return redirect(url_for('replenishment'))
             
             amount_rub = float(amount)
-            amount_cny = convert_rub_to_cny(amount_rub)
+            fx_rate = get_cny_to_rub_rate()
+            if fx_rate is None:
+                if is_ajax:
+                    return jsonify({'success': False, 'message': RATE_UNAVAILABLE}), 503
+                flash(RATE_UNAVAILABLE, 'error')
+                return redirect(url_for('replenishment'))
+            amount_cny = convert_rub_to_cny(amount_rub, fx_rate)
             if amount_rub <= 0:
                 raise ValueError("Сумма должна быть положительной")
             
@@ -395,7 +461,8 @@ def replenishment():
                 amount_rub=amount_rub,
                 amount_cny=amount_cny,
                 payment_date=payment_date,
-                receipt_path=filename
+                receipt_path=filename,
+                fx_rate=fx_rate
             )
             
             if is_ajax:
@@ -580,27 +647,23 @@ def handle_withdrawal_action(withdrawal_id, action):
         user_id = withdrawal['user_id']
         amount = withdrawal['amount']
         
-        # Для подтверждения - проверяем баланс и списываем средства
-        if action == 'approve':
-            user_balance = db.get_user_balance(user_id)
-            db.update_balance_rub(user_id, -amount)
-            amount_cny = convert_rub_to_cny(amount)
-            db.update_balance_cny(user_id, -amount_cny)
-
-            if user_balance < amount:
-                return jsonify({'error': 'Недостаточно средств на балансе'}), 400
+        # Для подтверждения - проверяем баланс
+        if action == 'approve' and db.get_user_balance(user_id) < amount:
+            return jsonify({'error': 'Недостаточно средств на балансе'}), 400
         
-        # Обновляем статус заявки
+        # Статус заявки и списание (с записью в журнал) — одной транзакцией
+        fx_rate = get_cny_to_rub_rate() if action == 'approve' else None
+        if action == 'approve' and fx_rate is None:
+            return jsonify({'error': RATE_UNAVAILABLE}), 503
         success = db.update_withdrawal_status(
             withdrawal_id=withdrawal_id,
             status=new_status,
-            comment=comment
+            comment=comment,
+            charge={'rub': amount, 'cny': convert_rub_to_cny(amount, fx_rate), 'fx_rate': fx_rate}
+                   if action == 'approve' else None
         )
         
         if not success:
-            # Если не удалось обновить статус - отменяем изменения баланса
-            if action == 'approve':
-                db.update_balance(user_id, amount)
             return jsonify({'error': 'Ошибка обновления статуса'}), 500
             
         return jsonify({
@@ -630,14 +693,10 @@ def add_product():
     url = request.form['product_url'].strip()
     
     try:
-        if 'taobao.com' in url or 'tmall.com' in url:
-            product = parse_taobao_product(API_TOKEN, url)
-        elif 'weidian.com' in url:
-            product = parse_weidian_product(url)
-        else:
+        if not detect_marketplace(url):
             return render_template('error.html', message="Неподдерживаемый сайт")
-        
-        product_id = db.add_product(product, url)
+
+        product_id = import_product(db, url)
         
         return redirect(url_for('product_page', product_id=product_id))
     
@@ -645,6 +704,103 @@ def add_product():
         return render_template('error.html', message=f"Ошибка: {str(e)}")
 
 
+@app.route('/import_products', methods=['POST'])
+@login_required
+def import_products():
+    # ссылки: JSON {"urls": [...]}, поле формы urls (по строке на ссылку) или файл file
+    data = request.get_json(silent=True) or {}
+    urls = data.get('urls')
+    if urls is None:
+        text = request.form.get('urls', '')
+        upload = request.files.get('file')
+        if upload:
+            text += '\n' + upload.read().decode('utf-8', 'ignore')
+        urls = text.splitlines()
+    if not isinstance(urls, list) or not urls:
+        return jsonify(success=False, error='Нет ссылок для импорта'), 400
+
+    try:
+        started = time.perf_counter()
+        report = bulk_import(db, [str(u) for u in urls], concurrency=int(data.get('workers') or 20))
+    except ValueError as e:
+        return jsonify(success=False, error=str(e)), 400
+    except Exception as e:
+        app.logger.exception("import_products failed: %s", e)
+        return jsonify(success=False, error=str(e)), 500
+
+    return jsonify(
+        success=True,
+        imported=sum(1 for r in report if r['status'] == 'imported'),
+        duplicates=sum(1 for r in report if r['status'] == 'duplicate'),
+        errors=sum(1 for r in report if r['status'] == 'error'),
+        elapsed_ms=round((time.perf_counter() - started) * 1000, 1),
+        items=report
+    )
+
+@app.cli.command('import-products')
+@click.argument('source', type=click.File('r', encoding='utf-8'))
+@click.option('--workers', default=20, show_default=True, help='Одновременных загрузок')
+def import_products_command(source, workers):
+    """Импортирует товары по ссылкам из файла (по одной на строку, '-' — stdin)"""
+    started = time.perf_counter()
+    report = bulk_import(db, source.read().splitlines(), concurrency=workers)
+    for r in report:
+        line = f"{r['status']:<9} {r['elapsed_ms']:>8.1f} ms  {r['url']}"
+        if r['product_id']:
+            line += f"  -> product {r['product_id']}"
+        if r['error']:
+            line += f"  ({r['error']})"
+        click.echo(line)
+    click.echo(f"Готово за {time.perf_counter() - started:.1f} с: "
+               f"{sum(1 for r in report if r['status'] == 'imported')} импортировано, "
+               f"{sum(1 for r in report if r['status'] == 'duplicate')} дублей, "
+               f"{sum(1 for r in report if r['status'] == 'error')} ошибок")
+
+@app.cli.command('audit-balances')
+def audit_balances_command():
+    """Сверяет балансы пользователей с журналом ledger_entries; код 1 при расхождениях"""
+    mismatches = db.audit_balances()
+    for m in mismatches:
+        click.echo(f"{m['id']:>6} {m['name']:<20} {m['currency']}  баланс {m['balance']:.2f}, "
+                   f"сумма журнала {m['ledger_sum']:.2f}, последняя запись {m['last_balance_after']}")
+    click.echo(f"Расхождений: {len(mismatches)}")
+    if mismatches:
+        raise SystemExit(1)
+
+@app.template_filter('thumb')
+def thumb_filter(url, size=160):
+    # картинки маркетплейсов — через локальный прокси в нужном размере, остальные как есть
+    if not image_cache.is_allowed(url):
+        return url or ''
+    return url_for('image_proxy', size=image_cache.snap_size(int(size)), u=url)
+
+@app.route('/img/<int:size>')
+def image_proxy(size):
+    url = request.args.get('u', '')
+    if not image_cache.is_allowed(url):
+        return 'Неподдерживаемый адрес картинки', 404
+
+    size = image_cache.snap_size(size)
+    fmt = 'webp' if 'image/webp' in request.headers.get('Accept', '') else 'jpeg'
+    try:
+        image = image_cache.open_thumbnail(url, size, fmt)
+    except Exception as e:
+        app.logger.warning(f"Не удалось подготовить картинку {url}: {e}")
+        # пусть браузер попробует загрузить оригинал сам
+        return redirect(url if '://' in url else 'https:' + url)
+
+    response = send_file(
+        image,
+        mimetype=image_cache.mimetype(fmt),
+        etag=image_cache.etag(url, size, fmt),
+        max_age=IMAGE_MAX_AGE,
+        conditional=True,
+    )
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    response.vary.add('Accept')
+    return response
+
 @app.route('/product/<int:product_id>')
 def product_page(product_id):
     try:
@@ -775,11 +931,12 @@ def checkout():
     cart_items = []
     total = 0.0
 
+    models = db.get_models_by_ids(int(entry['model_id']) for entry in items)
     for entry in items:
-        model_id = entry['model_id']
+        model_id = int(entry['model_id'])
         qty = int(entry['quantity'])
         
-        row = db.get_model_info(model_id)
+        row = models.get(model_id)
 
         if not row:
             continue
@@ -814,8 +971,7 @@ def process_payment():
             return jsonify(success=False, error='Неверные данные товаров'), 400
 
         # 1) Собираем детальную информацию по товарам и считаем total_products
-        detailed = []
-        total_products = 0.0
+        parsed = []
         for idx, it in enumerate(items):
             raw_mid = it.get('model_id')
             if raw_mid is None:
@@ -830,8 +986,14 @@ def process_payment():
                 qty = int(raw_qty)
             except (ValueError, TypeError):
                 qty = 1
+            parsed.append((model_id, qty))
 
-            row = db.get_model_info(model_id)
+        # все модели заказа — одним запросом
+        models = db.get_models_by_ids(model_id for model_id, _ in parsed)
+        detailed = []
+        total_products = 0.0
+        for model_id, qty in parsed:
+            row = models.get(model_id)
             if not row:
                 return jsonify(success=False, error=f'Модель {model_id} не найдена'), 404
 
@@ -864,16 +1026,19 @@ def process_payment():
         # 4) Общая стоимость в юанях
         total_cny = total_products + total_services
 
-        # 5) Проверяем баланс CNY и списываем
+        # 5) Проверяем баланс CNY
         user_id = session['user']['id']
         balance_cny = db.get_balance(user_id)['cny']
         if total_cny > balance_cny:
             return jsonify(success=False, error='Недостаточно средств на балансе CNY'), 400
-        db.update_balance_cny(user_id, -total_cny)
 
-        # 6) Конвертируем и списываем рубли
-        total_rub = convert_cny_to_rub(total_cny)
-        db.update_balance_rub(user_id, -total_rub)
+        # 6) Рублёвый эквивалент каждого заказа (курс сохраняем в заказе);
+        #    списание — вместе с заказами в create_orders
+        fx_rate = get_cny_to_rub_rate()
+        if fx_rate is None:
+            return jsonify(success=False, error=RATE_UNAVAILABLE), 503
+        for item in detailed:
+            item['total_rub'] = convert_cny_to_rub(item['total_price'], fx_rate)
 
         # 7) Генерируем уникальный трек-номер для заказа
         with db.get_cursor() as cursor:
@@ -887,99 +1052,8 @@ def process_payment():
                 if cursor.fetchone()['cnt'] == 0:
                     break
 
-        # --- Вспомогательная функция: удаляет/уменьшает товар в корзине (проверяет несколько возможных таблиц) ---
-        def remove_from_cart(cursor, user_id, model_id, qty_to_remove):
-            candidate_tables = ['cart_items', 'cart', 'basket', 'user_cart']
-            for table in candidate_tables:
-                try:
-                    # 1) Попробуем прочитать запись — проверим, есть ли колонка quantity
-                    cursor.execute(f"SELECT * FROM {table} WHERE user_id = ? AND model_id = ?", (user_id, model_id))
-                    row = cursor.fetchone()
-                except Exception:
-                    # Таблица не существует или ошибка — пробуем следующую
-                    continue
-
-                if not row:
-                    # Если таблица есть, но записи нет — ничего делать не нужно, считаем успешно
-                    return True
-
-                # Если у записи есть поле 'quantity' — уменьшаем
-                if 'quantity' in row.keys():
-                    try:
-                        current_qty = int(row['quantity'] or 0)
-                    except Exception:
-                        current_qty = 0
-                    new_qty = current_qty - int(qty_to_remove)
-                    if new_qty > 0:
-                        try:
-                            cursor.execute(f"UPDATE {table} SET quantity = ? WHERE user_id = ? AND model_id = ?",
-                                           (new_qty, user_id, model_id))
-                        except Exception:
-                            # если UPDATE неожиданно упал — пробуем удалить
-                            try:
-                                cursor.execute(f"DELETE FROM {table} WHERE user_id = ? AND model_id = ?",
-                                               (user_id, model_id))
-                            except Exception:
-                                pass
-                    else:
-                        # удаляем запись целиком
-                        try:
-                            cursor.execute(f"DELETE FROM {table} WHERE user_id = ? AND model_id = ?",
-                                           (user_id, model_id))
-                        except Exception:
-                            pass
-                    # После успешной операции — возвращаем True
-                    return True
-                else:
-                    # Если quantity нет — просто удаляем строку
-                    try:
-                        cursor.execute(f"DELETE FROM {table} WHERE user_id = ? AND model_id = ?",
-                                       (user_id, model_id))
-                        return True
-                    except Exception:
-                        # не получилось удалить из этой таблицы — пробуем следующую
-                        continue
-
-            # Если не нашли подходящей таблицы — считаем это нефатальной ситуацией и возвращаем True
-            # (можно логировать это место)
-            return True
-
-        # 8) Сохраняем заказы в базу данных и удаляем товары из корзины
-        order_ids = []
-        with db.get_cursor() as cursor:
-            for item in detailed:
-                cursor.execute('''
-                    INSERT INTO orders (
-                        user_id, model_id, quantity,
-                        status, additional_services,
-                        total_price, our_tracking_number,
-                        created_at, updated_at,
-                        cn_delivery_paid
-                    ) VALUES (?, ?, ?, 'ordered', ?, ?, ?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP, 0)
-                ''', (
-                    user_id,
-                    item['model_id'],
-                    item['quantity'],
-                    json.dumps(services),
-                    item['total_price'],  # Индивидуальная стоимость для каждого товара
-                    our_track  # Одинаковый трек-номер для всех товаров заказа
-                ))
-
-                order_id = cursor.lastrowid
-                order_ids.append(order_id)
-
-                # Обновляем статус модели (как было в твоём коде)
-                cursor.execute(
-                    "UPDATE models SET status = 'Принято' WHERE id = ?",
-                    (item['model_id'],)
-                )
-
-                # Удаляем / уменьшаем товар в корзине
-                try:
-                    remove_from_cart(cursor, user_id, item['model_id'], item['quantity'])
-                except Exception:
-                    # не критично — продолжаем, можно логировать
-                    pass
+        # 8) Сохраняем заказы, списываем баланс и удаляем товары из корзины
+        order_ids = db.create_orders(user_id, detailed, services, our_track, fx_rate)
 
         # Возвращаем первый order_id для совместимости
         first_order_id = order_ids[0] if order_ids else None
@@ -991,139 +1065,13 @@ def process_payment():
 @app.route('/profile/orders')
 @login_required
 def profile_orders():
-    user_id = session['user']['id']
-    with db.get_cursor() as cursor:
-        cursor.execute('''
-            SELECT 
-                o.id            AS order_id,
-                o.created_at    AS order_date,
-                o.our_tracking_number,
-                o.total_price,
-                o.model_id,
-                o.quantity,
-                o.status,
-                o.cn_delivery_price,
-                o.cn_delivery_paid,
-                o.photos,
-                m.image_url,
-                m.color_name    AS color,
-                m.size_name     AS size,
-                m.price         AS unit_price,
-                p.title         AS product_title
-            FROM orders o
-            JOIN models m ON o.model_id = m.id
-            JOIN products p ON m.product_id = p.id
-            WHERE o.user_id = ?
-            ORDER BY o.created_at DESC, o.id, o.model_id
-        ''', (user_id,))
-        rows = [dict(r) for r in cursor.fetchall()]
-
-    orders = []
-    current = None
-    for r in rows:
-        if current is None or current['id'] != r['order_id']:
-            current = {
-                'id': r['order_id'],
-                'created_at': r['order_date'],
-                'our_tracking_number': r['our_tracking_number'],
-                'total_price': r['total_price'],
-                'cn_delivery_price': r['cn_delivery_price'],
-                'cn_delivery_paid': r['cn_delivery_paid'],
-                'items': []
-            }
-            orders.append(current)
-        
-        # Парсим photos из JSON-строки
-        photos = []
-        if r['photos']:
-            try:
-                # Удаляем лишние кавычки и пробелы, пробуем распарсить JSON
-                photos_str = r['photos'].strip('"\'')
-                photos = json.loads(photos_str) if photos_str else []
-            except (json.JSONDecodeError, TypeError, AttributeError):
-                # Если не получается распарсить, создаём массив из строки
-                photos = [r['photos']] if isinstance(r['photos'], str) else []
-        
-        current['items'].append({
-            'product_title': r['product_title'],
-            'image_url': r['image_url'],
-            'color': r['color'],
-            'size': r['size'],
-            'price': r['unit_price'],
-            'quantity': r['quantity'],
-            'status': r['status'],
-            'photos': [url.split(' ')[0] for url in photos]
-        })
-
+    orders = db.get_orders_with_photos(session['user']['id'])
     return render_template('profile/orders.html', orders=orders)
 
 @app.route('/profile/warehouse')
 @login_required
 def warehouse():
-    user_id = session['user']['id']
-    with db.get_cursor() as cursor:
-        cursor.execute('''
-            SELECT 
-                o.id            AS order_id,
-                o.created_at    AS order_date,
-                o.our_tracking_number,
-                o.total_price,
-                o.model_id,
-                o.quantity,
-                o.status,
-                o.cn_delivery_price,
-                o.cn_delivery_paid,
-                o.photos,
-                m.image_url,
-                m.color_name    AS color,
-                m.size_name     AS size,
-                m.price         AS unit_price,
-                p.title         AS product_title
-            FROM orders o
-            JOIN models m ON o.model_id = m.id
-            JOIN products p ON m.product_id = p.id
-            WHERE o.user_id = ?
-            ORDER BY o.created_at DESC, o.id, o.model_id
-        ''', (user_id,))
-        rows = [dict(r) for r in cursor.fetchall()]
-
-    orders = []
-    current = None
-    for r in rows:
-        if current is None or current['id'] != r['order_id']:
-            current = {
-                'id': r['order_id'],
-                'created_at': r['order_date'],
-                'our_tracking_number': r['our_tracking_number'],
-                'total_price': r['total_price'],
-                'cn_delivery_price': r['cn_delivery_price'],
-                'cn_delivery_paid': r['cn_delivery_paid'],
-                'items': []
-            }
-            orders.append(current)
-        
-        # Парсим photos из JSON-строки
-        photos = []
-        if r['photos']:
-            try:
-                # Удаляем лишние кавычки и пробелы, пробуем распарсить JSON
-                photos_str = r['photos'].strip('"\'')
-                photos = json.loads(photos_str) if photos_str else []
-            except (json.JSONDecodeError, TypeError, AttributeError):
-                # Если не получается распарсить, создаём массив из строки
-                photos = [r['photos']] if isinstance(r['photos'], str) else []
-        
-        current['items'].append({
-            'product_title': r['product_title'],
-            'image_url': r['image_url'],
-            'color': r['color'],
-            'size': r['size'],
-            'price': r['unit_price'],
-            'quantity': r['quantity'],
-            'status': r['status'],
-            'photos': [url.split(' ')[0] for url in photos]
-        })
-
+    orders = db.get_orders_with_photos(session['user']['id'])
     return render_template('profile/my_warehouse.html', orders=orders)
     
 @app.route('/api/orders/<int:order_id>/status', methods=['POST'])
@@ -1212,16 +1160,19 @@ def pay_delivery(order_id):
                 }), 400
             
             # 4. Конвертация и списание
-            price_rub = convert_cny_to_rub(price)
+            fx_rate = get_cny_to_rub_rate()
+            if fx_rate is None:
+                return jsonify({'error': RATE_UNAVAILABLE}), 503
+            price_rub = convert_cny_to_rub(price, fx_rate)
             
-            # Обновляем балансы
-            db.update_balance_cny(user_id, -price)
-            db.update_balance_rub(user_id, -price_rub)
+            # Обновляем балансы (в той же транзакции, с записью в журнал)
+            db.change_balance(user_id, 'delivery_cn', order_id, cny=-price, rub=-price_rub,
+                              fx_rate=fx_rate, cursor=cursor)
             
             # 5. Обновляем статус оплаты
             cursor.execute(
-                "UPDATE orders SET cn_delivery_paid = 1 WHERE id = ?",
-                (order_id,)
+                "UPDATE orders SET cn_delivery_paid = 1, cn_delivery_fx_rate = ? WHERE id = ?",
+                (fx_rate, order_id)
             )
 
             
@@ -1239,29 +1190,16 @@ def pay_delivery(order_id):
 def add_photo(order_id):
     try:
         data = request.json
-        photo_url = data.get('photo_url')
+        photo_url = (data.get('photo_url') or '').strip()
         
         if not photo_url:
             return jsonify(success=False, error='Не указана ссылка на фото'), 400
         
-        with db.get_cursor() as cursor:
-            # Получаем текущие фото
-            cursor.execute("SELECT photos FROM orders WHERE id = ?", (order_id,))
-            row = cursor.fetchone()
-            current_photos = json.loads(row['photos']) if row and row['photos'] else []
-            
-            # Проверяем, нет ли уже такой ссылки
-            if photo_url in current_photos:
-                return jsonify(success=False, error='Фото уже добавлено'), 400
-                
-            # Добавляем новую ссылку
-            current_photos.append(photo_url)
-            
-            # Обновляем запись
-            cursor.execute(
-                "UPDATE orders SET photos = ? WHERE id = ?",
-                (json.dumps(current_photos), order_id)
-            )
+        added = db.add_order_photos(order_id, [photo_url])
+        if added is None:
+            return jsonify(success=False, error='Заказ не найден'), 404
+        if not added:
+            return jsonify(success=False, error='Фото уже добавлено'), 400
         
         return jsonify(success=True)
     
@@ -1273,38 +1211,55 @@ def add_photo(order_id):
 def remove_photo(order_id):
     try:
         data = request.json
-        photo_url = data.get('photo_url')
+        photo_url = (data.get('photo_url') or '').strip()
         
         if not photo_url:
             return jsonify(success=False, error='Не указана ссылка на фото'), 400
         
-        with db.get_cursor() as cursor:
-            # Получаем текущие фото
-            cursor.execute("SELECT photos FROM orders WHERE id = ?", (order_id,))
-            row = cursor.fetchone()
-            
-            if not row or not row['photos']:
-                return jsonify(success=False, error='Фото не найдены'), 404
-                
-            current_photos = json.loads(row['photos'])
-            
-            # Проверяем, есть ли такая ссылка
-            if photo_url not in current_photos:
-                return jsonify(success=False, error='Фото не найдено'), 404
-                
-            # Удаляем ссылку
-            current_photos.remove(photo_url)
-            
-            # Обновляем запись
-            cursor.execute(
-                "UPDATE orders SET photos = ? WHERE id = ?",
-                (json.dumps(current_photos), order_id)
-            )
+        if not db.remove_order_photos(order_id, [photo_url]):
+            return jsonify(success=False, error='Фото не найдено'), 404
         
         return jsonify(success=True)
     
     except Exception as e:
         return jsonify(success=False, error=str(e)), 500
+
+@app.route('/admin/orders/<int:order_id>/photos', methods=['POST'])
+@admin_required
+def add_photos(order_id):
+    """Пакетное добавление: {"photo_urls": [...]}; уже добавленные пропускаются"""
+    try:
+        data = request.get_json() or {}
+        photo_urls = data.get('photo_urls')
+        
+        if not isinstance(photo_urls, list) or not photo_urls:
+            return jsonify(success=False, error='Не указаны ссылки на фото'), 400
+        
+        added = db.add_order_photos(order_id, photo_urls)
+        if added is None:
+            return jsonify(success=False, error='Заказ не найден'), 404
+        
+        return jsonify(success=True, added=added)
+    
+    except Exception as e:
+        return jsonify(success=False, error=str(e)), 500
+
+@app.route('/admin/orders/<int:order_id>/photos/delete', methods=['POST'])
+@admin_required
+def remove_photos(order_id):
+    """Пакетное удаление: {"photo_urls": [...]}; ненайденные ссылки игнорируются"""
+    try:
+        data = request.get_json() or {}
+        photo_urls = data.get('photo_urls')
+        
+        if not isinstance(photo_urls, list) or not photo_urls:
+            return jsonify(success=False, error='Не указаны ссылки на фото'), 400
+        
+        removed = db.remove_order_photos(order_id, photo_urls)
+        return jsonify(success=True, removed=removed)
+    
+    except Exception as e:
+        return jsonify(success=False, error=str(e)), 500
     
 @app.route('/profile/warehouse_order', methods=['POST'])
 @login_required
@@ -1386,7 +1341,6 @@ def calc_delivery_cost_with_pct(
 
 @app.route('/process-shipment', methods=['POST'])
 def process_shipment():
-    import json
     try:
         data = request.get_json(silent=True)
         app.logger.debug("process-shipment: incoming data: %s", data)
@@ -1453,7 +1407,7 @@ def process_shipment():
         rates = fetch_cbr_rates()
         if not rates:
             app.logger.error("fetch_cbr_rates failed -> %r", rates)
-            return jsonify({'success': False, 'error': 'Не удалось получить курсы валют (ЦБ)'}), 500
+            return jsonify({'success': False, 'error': RATE_UNAVAILABLE}), 503
 
         # Извлекаем курс
         try:
@@ -1514,13 +1468,6 @@ def process_shipment():
         if float(total_cost_cny) > balance_cny:
             return jsonify({'success': False, 'error': 'Недостаточно средств на балансе CNY'}), 400
 
-        # Списание CNY (и опционально зеркальный RUB)
-        db.update_balance_cny(user_id, -float(total_cost_cny))
-        try:
-            db.update_balance_rub(user_id, -float(total_cost_rub))
-        except Exception:
-            app.logger.debug("update_balance_rub failed or not needed; continuing")
-
         # Генерация уникального трека
         with db.get_cursor() as cursor:
             while True:
@@ -1539,11 +1486,11 @@ def process_shipment():
         else:
             packaging_options = [str(packaging_raw)]
 
-        # Сохранение отправки (стоимость доставки — в CNY).
-        # model_ids сохраняем как JSON-строку строго по orders.id текущего пользователя.
+        # Сохранение отправки (стоимость доставки — в CNY) и списание CNY и зеркального RUB.
+        # состав посылки — строго orders.id текущего пользователя (shipment_items).
         db.add_shipment(
             user_id=user_id,
-            model_ids=json.dumps(order_ids, ensure_ascii=False),
+            order_ids=order_ids,
             delivery_method=delivery_key,
             packaging_options=packaging_options,   # <-- ВАЖНО: правильное имя аргумента
             recipient_name=str(data['fullname']),
@@ -1554,21 +1501,15 @@ def process_shipment():
             delivery_cost=float(total_cost_cny),
             packaging_cost=0.0,
             total_cost=float(total_cost_cny),
-            our_tracking_number=our_track
+            our_tracking_number=our_track,
             # статус не передаем — пусть отработает DEFAULT 'pending' вашей таблицы
+            fx_rate=float(cny_to_rub),
+            charge={'cny': float(total_cost_cny), 'rub': float(total_cost_rub)}
         )
 
         # Обновление статусов заказов
         try:
-            with db.get_cursor() as cursor:
-                for oid in order_ids:
-                    try:
-                        cursor.execute(
-                            "UPDATE orders SET status = ? WHERE id = ? AND user_id = ?",
-                            ('in_shipment', oid, user_id)
-                        )
-                    except Exception:
-                        app.logger.exception("Failed updating order %s", oid)
+            db.update_orders_status(order_ids, 'in_shipment', user_id=user_id)
         except Exception:
             app.logger.exception("Failed updating orders (non-fatal)")
 
@@ -1664,7 +1605,7 @@ def pay_packaging():
                 return jsonify({'success': False, 'error': 'Недостаточно средств на балансе CNY'}), 400
 
             # списываем и помечаем оплачено
-            db.update_balance_cny(user_id, -packaging_cost)
+            db.change_balance(user_id, 'packaging', shipment_id, cny=-packaging_cost, cursor=cursor)
             cursor.execute("""
                 UPDATE order_shipments
                 SET packaging_paid = 1
@@ -1702,26 +1643,10 @@ def admin_set_shipment_status(shipment_id):
             if not row:
                 return jsonify({'success': False, 'error': 'Посылка не найдена'}), 404
 
-            # Проверим, есть ли колонка updated_at
-            cols = cursor.execute("PRAGMA table_info(order_shipments)").fetchall()
-
-            def _colname(c):
-                # PRAGMA table_info returns (cid, name, type, notnull, dflt_value, pk)
-                return c['name'] if isinstance(c, dict) else c[1]
-
-            colnames = { _colname(c) for c in cols }
-
-            if 'updated_at' in colnames:
-                cursor.execute(
-                    "UPDATE order_shipments SET status = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
-                    (new_status, shipment_id)
-                )
-            else:
-                # Без updated_at — просто меняем статус
-                cursor.execute(
-                    "UPDATE order_shipments SET status = ? WHERE id = ?",
-                    (new_status, shipment_id)
-                )
+            cursor.execute(
+                "UPDATE order_shipments SET status = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
+                (new_status, shipment_id)
+            )
 
         return jsonify({
             'success': True,
@@ -1761,11 +1686,12 @@ def shipments():
     
 if __name__ == '__main__':
     with app.app_context():
-        db.init_db()
         if not db.get_user(name=ADMIN_USERNAME):
             db.create_admin(ADMIN_USERNAME, ADMIN_PASSWORD)
             
     start_cleanup_loop(db)
+    start_resync_loop(db)
+    rate_provider.start()
 
     app.run(host='0.0.0.0', debug=True)
 
@@ -1,7 +1,8 @@
 import sqlite3
-import requests
 import os
+import time
 import re
+import threading
 import json
 from werkzeug.security import generate_password_hash, check_password_hash
 from typing import List, Dict, Any
@@ -10,229 +11,415 @@ import json, re
 from collections import defaultdict
 from flask import current_app, g
 from contextlib import contextmanager
+from migrations import migrate, table_columns
 
 
-def get_cny_to_rub_rate():
-    try:
-        url = "https://www.cbr-xml-daily.ru/daily_json.js"
-        response = requests.get(url, timeout=5)
-        response.raise_for_status()
-        data = response.json()
-        cny_rate = data["Valute"]["CNY"]["Value"]
-        return cny_rate
-    except Exception as e:
-        return None
-    
-def convert_rub_to_cny(rub_amount):
-    cny_to_rub_rate = get_cny_to_rub_rate()
-    if cny_to_rub_rate is None:
-        return None
-    
-    rub_to_cny_rate = 1 / cny_to_rub_rate
-    
-    cny_amount = rub_amount * rub_to_cny_rate
-    return round(cny_amount, 2)
+# Профиль SQLite для боевого режима (значения по умолчанию для app.config)
+SQLITE_JOURNAL_MODE = os.getenv("SQLITE_JOURNAL_MODE", "WAL")
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", 5000))    # ждать блокировку, а не падать с "database is locked"
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")             # в WAL NORMAL не теряет целостность
+SQLITE_CACHE_SIZE_KB = int(os.getenv("SQLITE_CACHE_SIZE_KB", 16384))       # страничный кэш на соединение
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", 256 * 1024 * 1024))
+SQLITE_SLOW_LOCK_MS = 100                                                  # ожидание блокировки дольше — "медленное"
+
+
+class _ThreadConnections(dict):
+    """Соединения одного потока (путь к БД -> соединение); закрываются вместе с потоком"""
+
+    def __init__(self, manager):
+        super().__init__()
+        self.manager = manager
+
+    def __del__(self):
+        for conn in self.values():
+            try:
+                conn.close()
+            except Exception:
+                pass
+        self.manager.count('connections_live', -len(self))
+
+
+class _TimedCursor:
+    """
+    Курсор, замеряющий запрос, с которого началась транзакция записи:
+    именно на нём SQLite ждёт блокировку (busy_timeout).
+    """
+
+    def __init__(self, cursor, manager):
+        self._cursor = cursor
+        self._manager = manager
+
+    def _timed(self, method, *args):
+        conn = self._cursor.connection
+        if conn.in_transaction:
+            method(*args)
+            return self
+        started = time.perf_counter()
+        method(*args)
+        if conn.in_transaction:
+            self._manager._record_lock_wait((time.perf_counter() - started) * 1000)
+        return self
+
+    def execute(self, sql, params=()):
+        return self._timed(self._cursor.execute, sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self._timed(self._cursor.executemany, sql, seq_of_params)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class ConnectionManager:
+    """
+    Соединения с SQLite, переиспользуемые потоком между запросами.
+
+    Каждое соединение открывается один раз на поток и получает профиль из
+    конфигурации: журнал WAL (читатели не блокируют писателя), busy_timeout,
+    synchronous, cache_size и mmap_size. Ведёт счётчики соединений, транзакций
+    и ожидания блокировок записи.
+    """
+
+    def __init__(self, journal_mode=SQLITE_JOURNAL_MODE, busy_timeout_ms=SQLITE_BUSY_TIMEOUT_MS,
+                 synchronous=SQLITE_SYNCHRONOUS, cache_size_kb=SQLITE_CACHE_SIZE_KB,
+                 mmap_size=SQLITE_MMAP_SIZE):
+        self.journal_mode = journal_mode
+        self.busy_timeout_ms = busy_timeout_ms
+        self.synchronous = synchronous
+        self.cache_size_kb = cache_size_kb
+        self.mmap_size = mmap_size
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+        self._stats = defaultdict(float)
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            journal_mode=config['SQLITE_JOURNAL_MODE'],
+            busy_timeout_ms=config['SQLITE_BUSY_TIMEOUT_MS'],
+            synchronous=config['SQLITE_SYNCHRONOUS'],
+            cache_size_kb=config['SQLITE_CACHE_SIZE_KB'],
+            mmap_size=config['SQLITE_MMAP_SIZE'],
+        )
+
+    def count(self, name, value=1):
+        with self._stats_lock:
+            self._stats[name] += value
+
+    def _record_lock_wait(self, elapsed_ms):
+        with self._stats_lock:
+            self._stats['write_transactions'] += 1
+            self._stats['lock_wait_ms_total'] += elapsed_ms
+            self._stats['lock_wait_ms_max'] = max(self._stats['lock_wait_ms_max'], elapsed_ms)
+            if elapsed_ms >= SQLITE_SLOW_LOCK_MS:
+                self._stats['slow_lock_waits'] += 1
+
+    def _open(self, path):
+        conn = sqlite3.connect(
+            path,
+            detect_types=sqlite3.PARSE_DECLTYPES,
+            timeout=self.busy_timeout_ms / 1000,
+        )
+        conn.row_factory = sqlite3.Row
+        conn.execute(f"PRAGMA journal_mode = {self.journal_mode}")
+        conn.execute(f"PRAGMA busy_timeout = {int(self.busy_timeout_ms)}")
+        conn.execute(f"PRAGMA synchronous = {self.synchronous}")
+        conn.execute(f"PRAGMA cache_size = {-int(self.cache_size_kb)}")
+        conn.execute(f"PRAGMA mmap_size = {int(self.mmap_size)}")
+        conn.execute("PRAGMA foreign_keys = ON")
+        return conn
+
+    def acquire(self, path):
+        """Соединение текущего потока с базой path (вложенные контексты получают то же)"""
+        conns = getattr(self._local, 'conns', None)
+        if conns is None:
+            conns = self._local.conns = _ThreadConnections(self)
+            self._local.depth = defaultdict(int)
+        conn = conns.get(path)
+        if conn is None:
+            conn = conns[path] = self._open(path)
+            self.count('connections_opened')
+            self.count('connections_live')
+        else:
+            self.count('reused')
+        self._local.depth[path] += 1
+        self.count('checkouts')
+        return conn
+
+    def release(self, path):
+        """
+        Конец контекста приложения: соединение остаётся открытым для следующих
+        запросов потока, незавершённая транзакция внешнего контекста откатывается.
+        """
+        conns = getattr(self._local, 'conns', None)
+        if not conns or path not in conns:
+            return
+        self._local.depth[path] -= 1
+        if self._local.depth[path] > 0:
+            return
+        conn = conns[path]
+        if conn.in_transaction:
+            conn.rollback()
+            self.count('abandoned_transactions')
+
+    def cursor(self, conn):
+        return _TimedCursor(conn.cursor(), self)
+
+    def stats(self):
+        with self._stats_lock:
+            s = dict(self._stats)
+        result = {name: int(s.get(name, 0)) for name in (
+            'connections_opened', 'connections_live', 'checkouts', 'reused',
+            'write_transactions', 'slow_lock_waits', 'lock_errors', 'rollbacks',
+            'abandoned_transactions',
+        )}
+        result['lock_wait_ms_total'] = round(s.get('lock_wait_ms_total', 0.0), 2)
+        result['lock_wait_ms_max'] = round(s.get('lock_wait_ms_max', 0.0), 2)
+        result['lock_wait_ms_avg'] = round(
+            s.get('lock_wait_ms_total', 0.0) / s['write_transactions'], 2
+        ) if s.get('write_transactions') else 0.0
+        result['profile'] = {
+            'journal_mode': self.journal_mode,
+            'busy_timeout_ms': self.busy_timeout_ms,
+            'synchronous': self.synchronous,
+            'cache_size_kb': self.cache_size_kb,
+            'mmap_size': self.mmap_size,
+        }
+        return result
+
+
+# Подписи операций журнала баланса для истории в профиле
+LEDGER_LABELS = {
+    'opening': 'Начальный остаток',
+    'replenishment': 'Пополнение',
+    'withdrawal': 'Вывод',
+    'purchase': 'Оплата заказа',
+    'delivery_cn': 'Оплата доставки (Китай)',
+    'shipment': 'Оплата отправки',
+    'packaging': 'Оплата упаковки',
+    'adjustment': 'Корректировка',
+    'reconciliation': 'Сверка остатка',
+}
+
+
+# Строк истории баланса на странице профиля
+BALANCE_HISTORY_PAGE = 50
+
+
+def parse_history_cursor(cursor):
+    """'2025-10-07 09:16:41|13' -> ('2025-10-07 09:16:41', 13); ValueError, если курсор испорчен"""
+    date, sep, entry_id = str(cursor).rpartition('|')
+    if not sep or not date or not entry_id.isdigit():
+        raise ValueError("Некорректный курсор страницы")
+    return date, int(entry_id)
+
+
+def debit(charge, key):
+    """Сумма списания со знаком минус; None (курса не было) остаётся None — журнал её отвергнет"""
+    amount = charge.get(key)
+    return None if amount is None else -amount
+
+
+def group_ledger_entries(rows):
+    """
+    Сводит подряд идущие записи одной операции (ref_type, ref_id, время) в
+    строку истории. В операции не больше одной записи на валюту: повтор валюты
+    — уже другая операция (например, корректировки без ref_id в одну секунду).
+    """
+    history = []
+    key = None
+    currencies = set()
+    for r in rows:
+        row_key = (r['ref_type'], r['ref_id'], r['created_at'])
+        if row_key != key or r['currency'] in currencies:
+            key = row_key
+            currencies = set()
+            current = {
+                'id': r['id'],
+                'min_id': r['id'],
+                'type': LEDGER_LABELS.get(r['ref_type'], r['ref_type']),
+                'operation_type': r['ref_type'],
+                'ref_id': r['ref_id'],
+                'date': r['created_at'],
+                'amount_rub': None,
+                'amount_cny': None,
+                'change_rub': 0.0,
+                'change_cny': 0.0,
+                'balance_after': None,
+                'balance_after_rub': None,
+            }
+            history.append(current)
+        current['min_id'] = r['id']
+        currencies.add(r['currency'])
+        amount = float(r['amount'])
+        display = f"{'+' if amount > 0 else '-'}{abs(amount):.2f}"
+        if r['currency'] == 'CNY':
+            current['change_cny'] += amount
+            current['amount_cny'] = display
+            current['balance_after'] = float(r['balance_after'])
+        else:
+            current['change_rub'] += amount
+            current['amount_rub'] = display
+            current['balance_after_rub'] = float(r['balance_after'])
+    return history
+
+
+# Строк на странице раздела админки
+ADMIN_PAGE = 50
+
+# id заказов с нашим или китайским трек-номером (параметры: трек, трек)
+TRACKING_ORDER_IDS = '''
+    SELECT id FROM orders WHERE our_tracking_number = ?
+    UNION ALL
+    SELECT id FROM orders WHERE china_tracking_number = ?
+'''
+
+
+def admin_page_filter(alias, filters, before=None):
+    """
+    Условия страницы раздела админки по таблице alias: status (строка или
+    кортеж статусов), date_from и date_to (YYYY-MM-DD, обе границы
+    включительно), user (id или имя) и курсор before ('created_at|id'). Все
+    условия ложатся на индексы (status, created_at), (user_id, created_at) или
+    (created_at). Возвращает (условия, параметры).
+    """
+    clauses, params = [], []
+    status = filters.get('status')
+    if isinstance(status, (tuple, list)):
+        clauses.append(f"{alias}.status IN ({','.join('?' * len(status))})")
+        params += status
+    elif status:
+        clauses.append(f'{alias}.status = ?')
+        params.append(status)
+    if filters.get('date_from'):
+        clauses.append(f'{alias}.created_at >= ?')
+        params.append(filters['date_from'])
+    if filters.get('date_to'):
+        clauses.append(f"{alias}.created_at < date(?, '+1 day')")
+        params.append(filters['date_to'])
+    user = str(filters.get('user') or '').strip()
+    if user.isdigit():
+        clauses.append(f'{alias}.user_id = ?')
+        params.append(int(user))
+    elif user:
+        clauses.append(f'{alias}.user_id = (SELECT id FROM users WHERE name = ?)')
+        params.append(user)
+    if before:
+        before_date, before_id = parse_history_cursor(before)
+        clauses.append(f'({alias}.created_at, {alias}.id) < (?, ?)')
+        params += [before_date, before_id]
+    return clauses, params
+
+
+def cut_page(rows, limit):
+    """Выборку из limit + 1 строк обрезает до limit; возвращает (строки, курсор следующей страницы или None)"""
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    last = rows[-1]
+    return rows, f"{last['created_at']}|{last['id']}"
+
+
+def admin_page_query(query, alias, filters, limit, before, clauses=(), params=()):
+    """
+    Запрос страницы раздела админки: query — SELECT ... FROM без WHERE, к нему
+    добавляются фильтры, ключ страниц (created_at, id) и LIMIT limit + 1 —
+    строки обрезает cut_page. Курсор разбирается здесь, до открытия соединения,
+    так что неверный before — ValueError, а не ошибка базы.
+    Возвращает (запрос, параметры).
+    """
+    page_clauses, page_params = admin_page_filter(alias, filters or {}, before)
+    clauses = list(clauses) + page_clauses
+    if clauses:
+        query += ' WHERE ' + ' AND '.join(clauses)
+    query += f' ORDER BY {alias}.created_at DESC, {alias}.id DESC LIMIT ?'
+    return query, [*params, *page_params, limit + 1]
 
-def convert_cny_to_rub(cny_amount):
-    cny_to_rub_rate = get_cny_to_rub_rate()
-    if cny_to_rub_rate is None:
-        return None
-    
-    rub_amount = cny_amount * cny_to_rub_rate
-    return round(rub_amount, 2)
 
 class Database:
     def __init__(self, app=None):
         self.app = app
-        self._is_initialized = False  # Явно инициализируем атрибут
+        self.connections = ConnectionManager()
+        self._columns = {}  # таблица -> frozenset колонок
         if app is not None:
             self.init_app(app)
     
     def init_app(self, app):
         """Инициализация базы данных в приложении Flask"""
         app.config.setdefault('DATABASE', os.path.join(app.instance_path, 'users.db'))
+        app.config.setdefault('SQLITE_JOURNAL_MODE', SQLITE_JOURNAL_MODE)
+        app.config.setdefault('SQLITE_BUSY_TIMEOUT_MS', SQLITE_BUSY_TIMEOUT_MS)
+        app.config.setdefault('SQLITE_SYNCHRONOUS', SQLITE_SYNCHRONOUS)
+        app.config.setdefault('SQLITE_CACHE_SIZE_KB', SQLITE_CACHE_SIZE_KB)
+        app.config.setdefault('SQLITE_MMAP_SIZE', SQLITE_MMAP_SIZE)
+        self.connections = ConnectionManager.from_config(app.config)
         os.makedirs(app.instance_path, exist_ok=True)
         app.teardown_appcontext(self.close_connection)
-        
-        # Устанавливаем флаг инициализации в extensions приложения
-        if not hasattr(app, 'extensions'):
-            app.extensions = {}
-        app.extensions['db_initialized'] = False
-        
-        @app.before_request
-        def _initialize():
-            if not app.extensions['db_initialized']:
-                with app.app_context():
-                    self.init_db()
-                    if not self.get_user(name='admin1'):
-                        self.create_admin('admin1', '123456')
-                app.extensions['db_initialized'] = True
-                self._is_initialized = True
+
+        # Миграции схемы — один раз при старте, а не в обработчике запросов
+        with app.app_context():
+            self.init_db()
+            if not self.get_user(name='admin1'):
+                self.create_admin('admin1', '123456')
 
     
     def get_connection(self):
-        """Получает или создает соединение с БД для текущего контекста"""
+        """Соединение с БД для текущего контекста (переиспользуется потоком между запросами)"""
         if not hasattr(g, 'db_connection'):
-            # Создаем новое соединение
-            g.db_connection = sqlite3.connect(
-                current_app.config['DATABASE'],
-                detect_types=sqlite3.PARSE_DECLTYPES
-            )
-            g.db_connection.row_factory = sqlite3.Row
-            g.db_connection.execute("PRAGMA foreign_keys = ON")
+            g.db_path = current_app.config['DATABASE']
+            g.db_connection = self.connections.acquire(g.db_path)
         return g.db_connection
     
     def close_connection(self, exception=None):
-        """Закрывает соединение с БД"""
-        connection = getattr(g, 'db_connection', None)
+        """Возвращает соединение потоку; само соединение не закрывается"""
+        connection = g.pop('db_connection', None)
         if connection is not None:
-            connection.close()
+            self.connections.release(g.pop('db_path'))
     
     @contextmanager
     def get_cursor(self):
         """Контекстный менеджер для безопасной работы с курсором"""
         conn = self.get_connection()
-        cursor = conn.cursor()
+        cursor = self.connections.cursor(conn)
         try:
             yield cursor
             conn.commit()
         except Exception as e:
             conn.rollback()
+            self.connections.count('rollbacks')
+            if isinstance(e, sqlite3.OperationalError) and 'locked' in str(e):
+                self.connections.count('lock_errors')
             current_app.logger.error(f"Database error: {str(e)}")
             raise
         finally:
             cursor.close()
+
+    def stats(self):
+        """Счётчики соединений и ожидания блокировок"""
+        return self.connections.stats()
     
     def init_db(self):
-        """Инициализирует структуру базы данных"""
+        """Приводит схему БД к последней версии (см. migrations.py)"""
         with self.get_cursor() as cursor:
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS users (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    name TEXT UNIQUE NOT NULL,
-                    password TEXT NOT NULL,
-                    region TEXT NOT NULL,
-                    photo TEXT DEFAULT 'static/default.png',
-                    is_admin BOOLEAN DEFAULT FALSE,
-                    balance_cny DECIMAL(10, 2) DEFAULT 0.0,
-                    balance_rub DECIMAL(10, 2) DEFAULT 0.0,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS replenishments (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER NOT NULL,
-                    amount_rub DECIMAL(10, 2) NOT NULL,
-                    amount_cny DECIMAL(10, 2) NOT NULL,
-                    payment_date TEXT NOT NULL,
-                    receipt_path TEXT NOT NULL,
-                    status TEXT DEFAULT 'pending',
-                    admin_id INTEGER,
-                    admin_comment TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    processed_at TIMESTAMP,
-                    FOREIGN KEY (user_id) REFERENCES users (id),
-                    FOREIGN KEY (admin_id) REFERENCES users (id)
-                )
-            ''')
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS withdrawals (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER NOT NULL,
-                    amount DECIMAL(10, 2) NOT NULL,
-                    card_number TEXT NOT NULL,
-                    card_holder TEXT NOT NULL,
-                    name TEXT,
-                    status TEXT DEFAULT 'pending',
-                    admin_comment TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    processed_at TIMESTAMP,
-                    FOREIGN KEY (user_id) REFERENCES users (id)
-                )
-            ''')
-
-            # Таблица товаров
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS products (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    title TEXT NOT NULL,
-                    base_price REAL
-                )
-            ''')
-
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS models (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    product_id INTEGER,
-                    product_url TEXT,
-                    color_name TEXT,
-                    size_name TEXT,
-                    price REAL,
-                    stock INTEGER,  
-                    image_url TEXT,
-                    status TEXT DEFAULT 'temporary',
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (product_id) REFERENCES products(id)
-                )
-            ''')
-
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS cart_items (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER NOT NULL,
-                    model_id INTEGER NOT NULL,
-                    quantity INTEGER NOT NULL,
-                    added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (user_id) REFERENCES users(id),
-                    FOREIGN KEY (model_id) REFERENCES models(id)
-                )
-            ''')
-
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS orders (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER NOT NULL,
-                    model_id INTEGER NOT NULL,
-                    quantity INTEGER NOT NULL,
-                    status TEXT DEFAULT 'ordered',
-                    additional_services TEXT,
-                    total_price REAL,
-                    our_tracking_number TEXT,
-                    china_tracking_number TEXT,
-                    cn_delivery_price REAL,
-                    cn_delivery_paid BOOLEAN DEFAULT FALSE,
-                    photos TEXT DEFAULT '[]',
-                    weight REAL,
-                    warehouse_location TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP,
-                    FOREIGN KEY (user_id) REFERENCES users(id),
-                    FOREIGN KEY (model_id) REFERENCES models(id)
-                )
-            ''')
-
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS order_shipments  (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER NOT NULL,
-                    model_ids TEXT NOT NULL,
-                    delivery_method TEXT NOT NULL,
-                    packaging_options TEXT NOT NULL,
-                    recipient_name TEXT NOT NULL,
-                    recipient_phone TEXT NOT NULL,
-                    recipient_city TEXT NOT NULL,
-                    recipient_address TEXT NOT NULL,
-                    total_weight REAL NOT NULL,
-                    delivery_cost REAL NOT NULL,
-                    our_tracking_number TEXT,
-                    packaging_cost REAL NOT NULL,
-                    total_cost REAL NOT NULL,
-                    status TEXT DEFAULT 'pending' CHECK(status IN ('pending', 'processing', 'shipped', 'delivered')),
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
+            # один процесс за раз: остальные ждут и видят уже применённые версии
+            cursor.execute('BEGIN IMMEDIATE')
+            applied = migrate(cursor)
+        self._columns.clear()
+        if applied:
+            current_app.logger.info(f"Применены миграции схемы: {applied}")
+        return applied
+
+    def columns(self, table):
+        """Колонки таблицы; читаются из схемы один раз и кэшируются до следующей миграции"""
+        cached = self._columns.get(table)
+        if cached is None:
+            with self.get_cursor() as cursor:
+                cached = frozenset(table_columns(cursor, table))
+            self._columns[table] = cached
+        return cached
 
     # ============== User Methods ==============
     def create_user(self, name, password, region, photo_path='static/default.png', is_admin=False):
@@ -340,27 +527,124 @@ class Database:
                 'cny': float(result['balance_cny']) if result else 0.0
             }
 
-    def update_balance_rub(self, user_id, amount):
-        with self.get_cursor() as cursor:
-            try:
-                cursor.execute(
-                    'UPDATE users SET balance_rub = balance_rub + ? WHERE id = ?',
-                    (float(amount), user_id))
-                return True
-            except sqlite3.Error as e:
-                current_app.logger.error(f"Balance update failed: {str(e)}")
-                return False
+    def update_balance_rub(self, user_id, amount, ref_type='adjustment', ref_id=None):
+        try:
+            self.change_balance(user_id, ref_type, ref_id, rub=amount)
+            return True
+        except (sqlite3.Error, ValueError) as e:
+            current_app.logger.error(f"Balance update failed: {str(e)}")
+            return False
             
-    def update_balance_cny(self, user_id, amount):
+    def update_balance_cny(self, user_id, amount, ref_type='adjustment', ref_id=None):
+        try:
+            self.change_balance(user_id, ref_type, ref_id, cny=amount)
+            return True
+        except (sqlite3.Error, ValueError) as e:
+            current_app.logger.error(f"Balance update failed: {str(e)}")
+            return False
+
+    def change_balance(self, user_id, ref_type, ref_id=None, cny=0.0, rub=0.0, fx_rate=None, cursor=None):
+        """
+        Меняет балансы пользователя (суммы со знаком) и пишет записи в
+        ledger_entries в одной транзакции. С cursor — в транзакции вызывающего.
+        Возвращает {'cny': ..., 'rub': ...} после изменения.
+        """
+        entries = [(ref_type, ref_id, currency, amount, fx_rate)
+                   for currency, amount in (('CNY', cny), ('RUB', rub)) if amount != 0]
+        if cursor is None:
+            with self.get_cursor() as cursor:
+                return self._post_ledger(cursor, user_id, entries)
+        return self._post_ledger(cursor, user_id, entries)
+
+    def _post_ledger(self, cursor, user_id, entries):
+        """
+        entries — [(ref_type, ref_id, 'CNY' | 'RUB', сумма со знаком, курс)].
+        Число запросов не зависит от числа записей: UPDATE users ... RETURNING
+        даёт итоговый баланс, от него считаются balance_after всех записей;
+        затем вставка записей и прибавка к помесячным итогам ledger_monthly.
+        Сумма None (например, не было курса ЦБ) — ValueError: молча пропустить
+        валюту значит разойтись с балансом другой.
+        """
+        missing = sorted({currency for _, _, currency, amount, _ in entries if amount is None})
+        if missing:
+            raise ValueError(f"Не задана сумма в {', '.join(missing)} для записи в журнал баланса")
+        entries = [(ref_type, ref_id, currency, float(amount), fx_rate)
+                   for ref_type, ref_id, currency, amount, fx_rate in entries if amount]
+        totals = {'CNY': 0.0, 'RUB': 0.0}
+        for _, _, currency, amount, _ in entries:
+            totals[currency] += amount
+
+        cursor.execute('''
+            UPDATE users
+            SET balance_cny = balance_cny + ?,
+                balance_rub = balance_rub + ?
+            WHERE id = ?
+            RETURNING balance_cny, balance_rub
+        ''', (totals['CNY'], totals['RUB'], user_id))
+        row = cursor.fetchone()
+        if row is None:
+            raise ValueError(f"Пользователь {user_id} не найден")
+        after = {'CNY': float(row[0]), 'RUB': float(row[1])}
+        if not entries:
+            return {'cny': after['CNY'], 'rub': after['RUB']}
+
+        running = {currency: after[currency] - totals[currency] for currency in after}
+        values = ', '.join(['(?, ?, ?, ?, ?, ?, ?)'] * len(entries))
+        params = []
+        for ref_type, ref_id, currency, amount, fx_rate in entries:
+            running[currency] += amount
+            params += [user_id, currency, amount, running[currency], ref_type, ref_id, fx_rate]
+        cursor.execute(f'''
+            INSERT INTO ledger_entries
+                (user_id, currency, amount, balance_after, ref_type, ref_id, fx_rate)
+            VALUES {values}
+            RETURNING currency, amount, created_at
+        ''', params)
+
+        # помесячные итоги — по месяцу, записанному в самих записях
+        monthly = {}
+        for currency, amount, created_at in cursor.fetchall():
+            key = (str(created_at)[:7], currency)
+            total_in, total_out, count = monthly.get(key, (0.0, 0.0, 0))
+            if amount > 0:
+                total_in += amount
+            else:
+                total_out -= amount
+            monthly[key] = (total_in, total_out, count + 1)
+        cursor.executemany('''
+            INSERT INTO ledger_monthly (user_id, month, currency, total_in, total_out, entries)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (user_id, month, currency) DO UPDATE SET
+                total_in = total_in + excluded.total_in,
+                total_out = total_out + excluded.total_out,
+                entries = entries + excluded.entries
+        ''', [(user_id, month, currency, *totals) for (month, currency), totals in monthly.items()])
+        return {'cny': after['CNY'], 'rub': after['RUB']}
+
+    def audit_balances(self):
+        """
+        Сверка users.balance_* с журналом: пользователи, у которых баланс не равен
+        сумме записей или balance_after последней записи.
+        """
         with self.get_cursor() as cursor:
-            try:
-                cursor.execute(
-                    'UPDATE users SET balance_cny = balance_cny + ? WHERE id = ?',
-                    (float(amount), user_id))
-                return True
-            except sqlite3.Error as e:
-                current_app.logger.error(f"Balance update failed: {str(e)}")
-                return False
+            cursor.execute('''
+                SELECT u.id, u.name, c.currency,
+                       CASE c.currency WHEN 'CNY' THEN u.balance_cny ELSE u.balance_rub END AS balance,
+                       COALESCE((SELECT SUM(amount) FROM ledger_entries l
+                                 WHERE l.user_id = u.id AND l.currency = c.currency), 0) AS ledger_sum,
+                       (SELECT balance_after FROM ledger_entries l
+                        WHERE l.user_id = u.id AND l.currency = c.currency
+                        ORDER BY l.id DESC LIMIT 1) AS last_balance_after
+                FROM users u
+                CROSS JOIN (SELECT 'CNY' AS currency UNION ALL SELECT 'RUB') c
+            ''')
+            mismatches = []
+            for row in cursor.fetchall():
+                balance = float(row['balance'] or 0)
+                last = row['last_balance_after']
+                if abs(balance - row['ledger_sum']) >= 0.005 or (last is not None and abs(balance - last) >= 0.005):
+                    mismatches.append(dict(row))
+            return mismatches
     
     # ============== Admin Methods ==============
     
@@ -389,7 +673,7 @@ class Database:
             
     # заявки на пополнение
     
-    def create_replenishment(self, user_id, amount_rub,amount_cny, payment_date, receipt_path):
+    def create_replenishment(self, user_id, amount_rub,amount_cny, payment_date, receipt_path, fx_rate=None):
         with self.get_cursor() as cursor:
             try:
                 cursor.execute('''
@@ -398,35 +682,28 @@ class Database:
                         amount_rub, 
                         amount_cny, 
                         payment_date, 
-                        receipt_path
-                    ) VALUES (?, ?, ?, ?, ?)
-                ''', (user_id, amount_rub, amount_cny, payment_date, receipt_path))
+                        receipt_path,
+                        fx_rate
+                    ) VALUES (?, ?, ?, ?, ?, ?)
+                ''', (user_id, amount_rub, amount_cny, payment_date, receipt_path, fx_rate))
                 return cursor.lastrowid
             except Exception as e:
                 print(f"Error creating replenishment: {str(e)}")
                 raise        
             
-    def get_pending_replenishments(self):
-        """Получает все ожидающие заявки на пополнение"""
+    def get_admin_replenishments(self, filters=None, limit=ADMIN_PAGE, before=None):
+        """Страница заявок на пополнение для админки: (заявки, курсор следующей страницы)"""
+        query, params = admin_page_query('''
+            SELECT
+                r.id, r.user_id, r.amount_rub, r.amount_cny, r.payment_date,
+                r.receipt_path, r.status, r.created_at, u.name AS user_name
+            FROM replenishments r
+            JOIN users u ON r.user_id = u.id
+        ''', 'r', filters, limit, before)
         with self.get_cursor() as cursor:
-            cursor.execute('''
-                SELECT 
-                    r.id,
-                    r.user_id,
-                    r.amount_rub,
-                    r.amount_cny,
-                    r.payment_date,
-                    r.receipt_path,
-                    r.status,
-                    r.created_at,
-                    u.name as user_name 
-                FROM replenishments r
-                JOIN users u ON r.user_id = u.id
-                WHERE r.status = 'pending'
-                ORDER BY r.created_at DESC
-            ''')
-            columns = [column[0] for column in cursor.description]
-            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+            cursor.execute(query, params)
+            rows, next_cursor = cut_page(cursor.fetchall(), limit)
+            return [dict(row) for row in rows], next_cursor
             
     def process_replenishment(self, replenishment_id, action, admin_id, comment=None):
         if action not in ('approve', 'reject'):
@@ -437,7 +714,7 @@ class Database:
             
             # Получаем данные заявки
             cursor.execute('''
-                SELECT user_id, amount_rub, amount_cny
+                SELECT user_id, amount_rub, amount_cny, fx_rate
                 FROM replenishments 
                 WHERE id = ? AND status = 'pending'
             ''', (replenishment_id,))
@@ -446,16 +723,12 @@ class Database:
             if not replenishment:
                 return False
             
-            user_id, amount_rub, amount_cny = replenishment
+            user_id, amount_rub, amount_cny, fx_rate = replenishment
             
-            # Одобрение: пополняем рубли и юани
+            # Одобрение: пополняем рубли и юани (с записью в журнал)
             if action == 'approve':
-                cursor.execute('''
-                    UPDATE users 
-                    SET balance_rub = balance_rub + ?,
-                        balance_cny = balance_cny + ?
-                    WHERE id = ?
-                ''', (amount_rub, amount_cny, user_id))
+                self.change_balance(user_id, 'replenishment', replenishment_id,
+                                    cny=amount_cny, rub=amount_rub, fx_rate=fx_rate, cursor=cursor)
             
             # Обновляем статус заявки
             new_status = 'approved' if action == 'approve' else 'rejected'
@@ -501,192 +774,86 @@ class Database:
 
 
 
-    def get_balance_history(self, user_id):
+    # курсы валют
+
+    def save_fx_rates(self, payload):
+        """Сохраняет курсы из ответа ЦБ (daily_json.js) за его дату"""
+        rate_date = str(payload.get('Date') or '')[:10]
+        if not rate_date:
+            return 0
+        rows = []
+        for code, valute in (payload.get('Valute') or {}).items():
+            try:
+                rate = float(valute['Value']) / float(valute.get('Nominal', 1) or 1)
+            except (KeyError, TypeError, ValueError, ZeroDivisionError):
+                continue
+            rows.append((code, rate_date, rate))
+        with self.get_cursor() as cursor:
+            cursor.executemany('''
+                INSERT INTO fx_rates (currency, rate_date, rate)
+                VALUES (?, ?, ?)
+                ON CONFLICT(currency, rate_date) DO UPDATE SET
+                    rate = excluded.rate,
+                    fetched_at = CURRENT_TIMESTAMP
+            ''', rows)
+        return len(rows)
+
+    def get_balance_history(self, user_id, limit=BALANCE_HISTORY_PAGE, before=None):
         """
-        История баланса: replenishments, withdrawals, оплаты заказов (orders.total_price),
-        оплата CN-доставки (orders.cn_delivery_price если cn_delivery_paid = 1),
-        и order_shipments.total_cost (если есть).
+        Страница истории баланса из ledger_entries, новые сверху. Ключ страниц —
+        (created_at, id): before — курсор из предыдущей страницы, и запрос читает
+        только limit строк по индексу, сколько бы ни было записей раньше.
+        Возвращает (строки истории, курсор следующей страницы или None).
         """
-        with self.get_cursor() as cursor:
-            cursor.execute('''
-                SELECT amount_rub, amount_cny, date, status, operation_type FROM (
-                    -- пополнения (RUB)
-                    SELECT 
-                        amount_rub,
-                        amount_cny,
-                        created_at AS date,
-                        status,
-                        'replenishment' AS operation_type
-                    FROM replenishments
-                    WHERE user_id = ?
-
-                    UNION ALL
-
-                    -- выводы (RUB)
-                    SELECT
-                        amount AS amount_rub,
-                        NULL AS amount_cny,
-                        created_at AS date,
-                        status,
-                        'withdrawal' AS operation_type
-                    FROM withdrawals
-                    WHERE user_id = ?
-
-                    UNION ALL
-
-                    -- оплата заказа (orders.total_price в CNY)
-                    SELECT
-                        NULL AS amount_rub,
-                        COALESCE(total_price, 0.0) AS amount_cny,
-                        created_at AS date,
-                        status,
-                        'purchase' AS operation_type
-                    FROM orders
-                    WHERE user_id = ? AND COALESCE(total_price, 0) != 0
-
-                    UNION ALL
-
-                    -- ОТДЕЛЬНО: оплата китайской доставки (orders.cn_delivery_price),
-                    -- только если пользователь уже оплатил cn_delivery_paid = 1
-                    SELECT
-                        NULL AS amount_rub,
-                        COALESCE(cn_delivery_price, 0.0) AS amount_cny,
-                        created_at AS date,
-                        CASE WHEN cn_delivery_paid = 1 THEN 'approved' ELSE 'pending' END AS status,
-                        'delivery_cn' AS operation_type
-                    FROM orders
-                    WHERE user_id = ? AND COALESCE(cn_delivery_price, 0) != 0 AND cn_delivery_paid = 1
-
-                    UNION ALL
-
-                    -- оплата отправки/доставки из order_shipments (если применимо)
-                    SELECT
-                        NULL AS amount_rub,
-                        COALESCE(total_cost, 0.0) AS amount_cny,
-                        created_at AS date,
-                        status,
-                        'shipment' AS operation_type
-                    FROM order_shipments
-                    WHERE user_id = ? AND COALESCE(total_cost, 0) != 0
-                )
-                ORDER BY date DESC
-            ''', (user_id, user_id, user_id, user_id, user_id))
+        query = '''
+            SELECT id, currency, amount, balance_after, ref_type, ref_id, created_at
+            FROM ledger_entries
+            WHERE user_id = ?
+        '''
+        params = [user_id]
+        if before:
+            before_date, before_id = parse_history_cursor(before)
+            query += ' AND (created_at, id) < (?, ?)'
+            params += [before_date, before_id]
+        # в строке истории не больше двух записей (по одной на валюту), так что
+        # 2 * limit + 2 строк всегда хватает на limit целых строк и признак продолжения
+        query += ' ORDER BY created_at DESC, id DESC LIMIT ?'
+        params.append(2 * limit + 2)
 
+        with self.get_cursor() as cursor:
+            cursor.execute(query, params)
             rows = cursor.fetchall()
 
-            # текущие балансы
-            bal = self.get_balance(user_id)
-            current_balance_rub = float(bal.get('rub', 0.0))
-            current_balance_cny = float(bal.get('cny', 0.0))
-
-            history = []
-
-            def get_field(row, name, idx):
-                try:
-                    return row[name]
-                except Exception:
-                    try:
-                        return row[idx]
-                    except Exception:
-                        return None
-
-            for r in rows:
-                amount_rub_raw = get_field(r, 'amount_rub', 0)
-                amount_cny_raw = get_field(r, 'amount_cny', 1)
-                date = get_field(r, 'date', 2)
-                status = get_field(r, 'status', 3)
-                op_type = get_field(r, 'operation_type', 4)
-
-                try:
-                    amount_rub_val = float(amount_rub_raw) if amount_rub_raw is not None else 0.0
-                except Exception:
-                    amount_rub_val = 0.0
-                try:
-                    amount_cny_val = float(amount_cny_raw) if amount_cny_raw is not None else 0.0
-                except Exception:
-                    amount_cny_val = 0.0
-
-                change_rub = 0.0
-                change_cny = 0.0
-                label = None
-
-                if op_type == 'replenishment':
-                    change_rub = float(amount_rub_val)
-                    label = 'Пополнение'
-                elif op_type == 'withdrawal':
-                    change_rub = -float(amount_rub_val)
-                    label = 'Вывод'
-                elif op_type == 'purchase':
-                    change_cny = -float(amount_cny_val)
-                    # конвертируем в рубли для отображения
-                    try:
-                        change_rub = -float(convert_cny_to_rub(abs(change_cny)))
-                    except Exception:
-                        change_rub = 0.0
-                    label = 'Оплата заказа'
-                elif op_type == 'delivery_cn':
-                    # специально помеченная CN-доставка (cn_delivery_price)
-                    change_cny = -float(amount_cny_val)
-                    try:
-                        change_rub = -float(convert_cny_to_rub(abs(change_cny)))
-                    except Exception:
-                        change_rub = 0.0
-                    label = 'Оплата доставки (Китай)'
-                elif op_type == 'shipment':
-                    change_cny = -float(amount_cny_val)
-                    try:
-                        change_rub = -float(convert_cny_to_rub(abs(change_cny)))
-                    except Exception:
-                        change_rub = 0.0
-                    label = 'Оплата отправки'
-                else:
-                    label = op_type or 'Операция'
-                    if amount_rub_val:
-                        change_rub = -float(amount_rub_val)
-                    if amount_cny_val:
-                        change_cny = -float(amount_cny_val)
-                        try:
-                            change_rub = -float(convert_cny_to_rub(abs(change_cny)))
-                        except Exception:
-                            pass
-
-                # считаем balance_after только для подтверждённых/оплаченных статусов
-                if status is not None and str(status).lower() in ('approved', 'paid', 'completed', 'done', 'ok', 'in_warehouse', 'purchased', 'seller_sent', 'in_transit', 'shipped', 'pending'):
-                    balance_after_rub = round(current_balance_rub, 2)
-                    balance_after_cny = round(current_balance_cny, 2)
-                    current_balance_rub -= change_rub
-                    current_balance_cny -= change_cny
-                else:
-                    balance_after_rub = None
-                    balance_after_cny = None
-
-                display_amount_rub = None
-                display_amount_cny = None
-                if amount_rub_val != 0:
-                    display_amount_rub = f"{'+' if change_rub > 0 else '-'}{abs(amount_rub_val):.2f}"
-                else:
-                    if change_rub != 0:
-                        display_amount_rub = f"{'+' if change_rub > 0 else '-'}{abs(change_rub):.2f}"
+        history = group_ledger_entries(rows)
+        if len(history) <= limit:
+            return history, None
+        history = history[:limit]
+        last = history[-1]
+        return history, f"{last['date']}|{last['min_id']}"
 
-                if amount_cny_val != 0:
-                    display_amount_cny = f"{'+' if change_cny > 0 else '-'}{abs(amount_cny_val):.2f}"
-                else:
-                    if change_cny != 0:
-                        display_amount_cny = f"{'+' if change_cny > 0 else '-'}{abs(change_cny):.2f}"
-
-                history.append({
-                    'type': label,
-                    'operation_type': op_type,
-                    'amount_rub': display_amount_rub,
-                    'amount_cny': display_amount_cny,
-                    'date': date,
-                    'status': status,
-                    'balance_after': balance_after_cny,
-                    'change_rub': change_rub,
-                    'change_cny': change_cny,
+    def get_balance_rollups(self, user_id, months=12):
+        """Итоги по месяцам из ledger_monthly: [{'month', 'cny_in', 'cny_out', 'rub_in', 'rub_out'}]"""
+        with self.get_cursor() as cursor:
+            cursor.execute('''
+                SELECT month, currency, total_in, total_out
+                FROM ledger_monthly
+                WHERE user_id = ? AND month >= (
+                    SELECT COALESCE(MIN(month), '') FROM (
+                        SELECT DISTINCT month FROM ledger_monthly
+                        WHERE user_id = ? ORDER BY month DESC LIMIT ?
+                    )
+                )
+                ORDER BY month DESC
+            ''', (user_id, user_id, months))
+            rollups = {}
+            for r in cursor.fetchall():
+                month = rollups.setdefault(r['month'], {
+                    'month': r['month'], 'cny_in': 0.0, 'cny_out': 0.0, 'rub_in': 0.0, 'rub_out': 0.0,
                 })
-
-            return history
+                prefix = r['currency'].lower()
+                month[f'{prefix}_in'] = float(r['total_in'])
+                month[f'{prefix}_out'] = float(r['total_out'])
+            return list(rollups.values())
 
     
         # Вывод
@@ -774,8 +941,31 @@ class Database:
             except Exception as e:
                 print(f"Ошибка при получении ожидающих выводов: {str(e)}")
                 return []          
+
+    def get_admin_withdrawals(self, filters=None, limit=ADMIN_PAGE, before=None):
+        """Страница заявок на вывод для админки: (заявки, курсор следующей страницы)"""
+        query, params = admin_page_query('''
+            SELECT
+                w.id, w.user_id, w.amount, u.name AS user_name, w.card_number,
+                COALESCE(w.card_holder, '') AS card_holder, w.created_at, w.status
+            FROM withdrawals w
+            JOIN users u ON w.user_id = u.id
+        ''', 'w', filters, limit, before)
+        with self.get_cursor() as cursor:
+            cursor.execute(query, params)
+            rows, next_cursor = cut_page(cursor.fetchall(), limit)
+            withdrawals = []
+            for row in rows:
+                w = dict(row)
+                w['amount'] = float(w['amount'])
+                withdrawals.append(w)
+            return withdrawals, next_cursor
             
-    def update_withdrawal_status(self, withdrawal_id, status, comment):
+    def update_withdrawal_status(self, withdrawal_id, status, comment, charge=None):
+        """
+        Закрывает заявку на вывод. charge — {'rub', 'cny', 'fx_rate'}: списание
+        с баланса в той же транзакции (при одобрении).
+        """
         with self.get_cursor() as cursor:
             try:
                 # 1. Получаем информацию о выводе
@@ -799,6 +989,11 @@ class Database:
                         processed_at = datetime('now')
                     WHERE id = ?
                 ''', (status, comment, withdrawal_id))
+
+                if charge:
+                    self.change_balance(user_id, 'withdrawal', withdrawal_id,
+                                        cny=debit(charge, 'cny'), rub=debit(charge, 'rub'),
+                                        fx_rate=charge.get('fx_rate'), cursor=cursor)
                 
                 return True
                 
@@ -807,47 +1002,220 @@ class Database:
                 raise
 
     # работа с товарами
-    def add_product(self, product_data, url):
+    def add_product(self, product_data, url, identity=None):
+        """
+        Сохраняет товар и его модели, возвращает product_id.
+        identity — {'marketplace', 'item_id', 'canonical_url'}: повторный импорт того же
+        товара обновляет его на месте, модели сопоставляются по sku_id.
+        """
         with self.get_cursor() as cursor:
             try:
-                cursor.execute('''
-                    INSERT INTO products (title, base_price)
-                    VALUES (?, ?)
-                ''', (product_data['title'], product_data['base_price']))
-                
-                product_id = cursor.lastrowid
-                base_price = product_data.get('base_price', 0.0)
-
-                
-                # 2. Добавляем все модели/вариации товара
-                for model in product_data['models']:
-                    cursor.execute('''
-                        INSERT INTO models (
-                            product_id, 
-                            product_url,
-                            color_name, 
-                            size_name, 
-                            price, 
-                            stock, 
-                            image_url
-                        )
-                        VALUES (?, ?, ?, ?, ?, ?, ?)
-                    ''', (
-                        product_id,
-                        url,
-                        model.get('color_name', ''),
-                        model.get('size_name', ''),
-                        model.get('price', base_price),
-                        model.get('stock', 0),
-                        model.get('image_url', '')
-                    ))
-                
-                return product_id
-                
+                return self._save_product(cursor, product_data, url, identity)
             except Exception as e:
                 print(f"Ошибка при добавлении товара: {str(e)}")
                 raise
 
+    def _save_product(self, cursor, product_data, url, identity=None):
+        base_price = product_data.get('base_price', 0.0)
+        if identity is None:
+            cursor.execute('''
+                INSERT INTO products (title, base_price)
+                VALUES (?, ?)
+            ''', (product_data['title'], product_data['base_price']))
+            product_id = cursor.lastrowid
+            existing = []
+        else:
+            cursor.execute('''
+                INSERT INTO products (title, base_price, marketplace, item_id, canonical_url, updated_at)
+                VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+                ON CONFLICT (marketplace, item_id) DO UPDATE SET
+                    title = excluded.title,
+                    base_price = excluded.base_price,
+                    canonical_url = excluded.canonical_url,
+                    updated_at = CURRENT_TIMESTAMP
+            ''', (product_data['title'], product_data['base_price'],
+                  identity['marketplace'], identity['item_id'], identity['canonical_url']))
+            cursor.execute(
+                'SELECT id FROM products WHERE marketplace = ? AND item_id = ?',
+                (identity['marketplace'], identity['item_id'])
+            )
+            product_id = cursor.fetchone()[0]
+            cursor.execute(
+                'SELECT id, sku_id, color_name, size_name FROM models WHERE product_id = ?',
+                (product_id,)
+            )
+            existing = cursor.fetchall()
+
+        by_sku = {row[1]: row[0] for row in existing if row[1]}
+        by_name = {(row[2], row[3]): row[0] for row in existing}
+        # старые строки без sku_id подхватываются по цвету и размеру
+        unkeyed = {(row[2], row[3]): row[0] for row in existing if not row[1]}
+
+        inserts, updates, matched = [], [], set()
+        for model in product_data['models']:
+            sku_id = model.get('sku_id') or None
+            values = (
+                url,
+                sku_id,
+                model.get('color_name', ''),
+                model.get('size_name', ''),
+                model.get('price', base_price),
+                model.get('stock', 0),
+                model.get('image_url', '')
+            )
+            name = (values[2], values[3])
+            model_id = by_sku.get(sku_id) if sku_id else by_name.get(name)
+            if model_id is None and sku_id:
+                model_id = unkeyed.pop(name, None)
+            if model_id is None or model_id in matched:
+                inserts.append((product_id,) + values)
+            else:
+                matched.add(model_id)
+                updates.append(values + (model_id,))
+
+        if updates:
+            # временные модели удаляются через 10 минут после создания — продлеваем
+            cursor.executemany('''
+                UPDATE models SET
+                    product_url = ?, sku_id = ?, color_name = ?, size_name = ?,
+                    price = ?, stock = ?, image_url = ?,
+                    created_at = CASE WHEN status = 'temporary' THEN CURRENT_TIMESTAMP ELSE created_at END
+                WHERE id = ?
+            ''', updates)
+        if inserts:
+            cursor.executemany('''
+                INSERT INTO models (
+                    product_id, product_url, sku_id, color_name, size_name, price, stock, image_url
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (product_id, sku_id) DO UPDATE SET
+                    price = excluded.price,
+                    stock = excluded.stock,
+                    image_url = excluded.image_url
+            ''', inserts)
+
+        # SKU, которых больше нет на маркетплейсе, остаются (на них ссылаются заказы), но без остатка
+        gone = [(row[0],) for row in existing if row[0] not in matched]
+        if gone:
+            cursor.executemany('UPDATE models SET stock = 0 WHERE id = ?', gone)
+        return product_id
+
+    def acquire_import_lease(self, item_key, owner, ttl):
+        """
+        Пытается захватить импорт товара.
+        Возвращает ('acquired', None), ('done', product_id), если товар только что
+        импортирован другим запросом, или ('busy', None), если импорт ещё идёт.
+        """
+        now = time.time()
+        with self.get_cursor() as cursor:
+            cursor.execute(
+                'DELETE FROM import_leases WHERE item_key = ? AND expires_at <= ?',
+                (item_key, now)
+            )
+            cursor.execute(
+                'INSERT OR IGNORE INTO import_leases (item_key, owner, expires_at) VALUES (?, ?, ?)',
+                (item_key, owner, now + ttl)
+            )
+            if cursor.rowcount == 1:
+                return 'acquired', None
+            cursor.execute('SELECT product_id FROM import_leases WHERE item_key = ?', (item_key,))
+            row = cursor.fetchone()
+            if row and row['product_id'] is not None:
+                return 'done', row['product_id']
+            return 'busy', None
+
+    def get_import_lease(self, item_key):
+        with self.get_cursor() as cursor:
+            cursor.execute(
+                'SELECT owner, product_id, expires_at FROM import_leases WHERE item_key = ? AND expires_at > ?',
+                (item_key, time.time())
+            )
+            row = cursor.fetchone()
+            return dict(row) if row else None
+
+    def complete_import_lease(self, item_key, owner, product_id, keep_seconds):
+        """Публикует product_id для ожидающих; запись живёт ещё keep_seconds"""
+        with self.get_cursor() as cursor:
+            cursor.execute('''
+                UPDATE import_leases SET product_id = ?, expires_at = ?
+                WHERE item_key = ? AND owner = ?
+            ''', (product_id, time.time() + keep_seconds, item_key, owner))
+
+    def release_import_lease(self, item_key, owner):
+        with self.get_cursor() as cursor:
+            cursor.execute(
+                'DELETE FROM import_leases WHERE item_key = ? AND owner = ?',
+                (item_key, owner)
+            )
+
+    def add_products_bulk(self, products):
+        """
+        Добавляет пачку товаров в одной транзакции.
+        products — список (product_data, url, identity); возвращает список product_id в том же порядке.
+        """
+        with self.get_cursor() as cursor:
+            return [
+                self._save_product(cursor, product_data, url, identity)
+                for product_data, url, identity in products
+            ]
+
+    def get_resync_candidates(self, limit, order_days, min_age_seconds):
+        """
+        Товары из корзин и свежих неоплаченных у продавца заказов, которые давно
+        не сверялись с маркетплейсом; сначала никогда не сверявшиеся, затем самые старые.
+        """
+        with self.get_cursor() as cursor:
+            cursor.execute('''
+                SELECT p.id AS product_id, MIN(m.product_url) AS url, p.synced_at
+                FROM products p
+                JOIN models m ON m.product_id = p.id
+                WHERE p.id IN (
+                    SELECT cm.product_id FROM cart_items c
+                    JOIN models cm ON cm.id = c.model_id
+                    UNION
+                    SELECT om.product_id FROM orders o
+                    JOIN models om ON om.id = o.model_id
+                    WHERE o.status = 'ordered' AND o.created_at >= DATETIME('now', ?)
+                )
+                AND m.product_url IS NOT NULL AND m.product_url != ''
+                AND (p.synced_at IS NULL OR p.synced_at < DATETIME('now', ?))
+                GROUP BY p.id
+                ORDER BY p.synced_at IS NOT NULL, p.synced_at, p.id
+                LIMIT ?
+            ''', (f'-{int(order_days)} days', f'-{int(min_age_seconds)} seconds', limit))
+            return [dict(row) for row in cursor.fetchall()]
+
+    def get_models_by_product_ids(self, product_ids):
+        """Модели нескольких товаров одним запросом: {product_id: [model, ...]}"""
+        result = defaultdict(list)
+        if not product_ids:
+            return result
+        placeholders = ','.join('?' * len(product_ids))
+        with self.get_cursor() as cursor:
+            cursor.execute(f'''
+                SELECT id, product_id, sku_id, color_name, size_name, price, stock
+                FROM models WHERE product_id IN ({placeholders})
+            ''', list(product_ids))
+            for row in cursor.fetchall():
+                result[row['product_id']].append(dict(row))
+        return result
+
+    def apply_resync(self, model_updates, product_ids):
+        """
+        Записывает результат сверки в одной транзакции.
+        model_updates — список (price, stock, model_id) только для изменившихся моделей.
+        """
+        with self.get_cursor() as cursor:
+            if model_updates:
+                cursor.executemany(
+                    'UPDATE models SET price = ?, stock = ? WHERE id = ?',
+                    model_updates
+                )
+            if product_ids:
+                cursor.executemany(
+                    'UPDATE products SET synced_at = CURRENT_TIMESTAMP WHERE id = ?',
+                    [(pid,) for pid in product_ids]
+                )
+
     def get_product_with_models(self, product_id):
         with self.get_cursor() as cursor:
             # Получаем основной товар
@@ -965,41 +1333,135 @@ class Database:
             cursor.execute('SELECT * FROM models WHERE id = ?', (model_id,))
             product = cursor.fetchone()
             return dict(product) if product else None
+
+    def get_models_by_ids(self, model_ids):
+        """Модели одним запросом: {model_id: model}; несуществующих id в ответе нет"""
+        ids = list(dict.fromkeys(model_ids))
+        if not ids:
+            return {}
+        placeholders = ','.join('?' * len(ids))
+        with self.get_cursor() as cursor:
+            cursor.execute(f'SELECT * FROM models WHERE id IN ({placeholders})', ids)
+            return {row['id']: dict(row) for row in cursor.fetchall()}
+
+    def create_orders(self, user_id, items, services, our_tracking_number, fx_rate):
+        """
+        Оформляет позиции корзины одной транзакцией: заказы (по одному на позицию,
+        items — [{'model_id', 'quantity', 'total_price', 'total_rub'}]), списание
+        с баланса по каждому заказу (ledger_entries), статус моделей и уменьшение
+        корзины. Число запросов не зависит от количества позиций.
+        Возвращает id созданных заказов в порядке items.
+        """
+        if not items:
+            return []
+        services_json = json.dumps(services)
+        values = ', '.join(["(?, ?, ?, 'ordered', ?, ?, ?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP, 0, ?)"] * len(items))
+        params = []
+        for item in items:
+            params += [user_id, item['model_id'], item['quantity'], services_json,
+                       item['total_price'], our_tracking_number, fx_rate]
+
+        quantities = defaultdict(int)
+        for item in items:
+            quantities[item['model_id']] += item['quantity']
+        model_ids = list(quantities)
+        placeholders = ','.join('?' * len(model_ids))
+
+        with self.get_cursor() as cursor:
+            cursor.execute(f'''
+                INSERT INTO orders (
+                    user_id, model_id, quantity,
+                    status, additional_services,
+                    total_price, our_tracking_number,
+                    created_at, updated_at,
+                    cn_delivery_paid, fx_rate
+                ) VALUES {values}
+                RETURNING id
+            ''', params)
+            # id растут в порядке вставки
+            order_ids = sorted(row[0] for row in cursor.fetchall())
+
+            charges = []
+            for order_id, item in zip(order_ids, items):
+                charges.append(('purchase', order_id, 'CNY', -item['total_price'], fx_rate))
+                charges.append(('purchase', order_id, 'RUB', debit(item, 'total_rub'), fx_rate))
+            self._post_ledger(cursor, user_id, charges)
+
+            cursor.execute(
+                f"UPDATE models SET status = 'Принято' WHERE id IN ({placeholders})",
+                model_ids
+            )
+            cursor.executemany(
+                'UPDATE cart_items SET quantity = quantity - ? WHERE user_id = ? AND model_id = ?',
+                [(qty, user_id, model_id) for model_id, qty in quantities.items()]
+            )
+            cursor.execute(
+                f'DELETE FROM cart_items WHERE user_id = ? AND model_id IN ({placeholders}) AND quantity <= 0',
+                [user_id] + model_ids
+            )
+        return order_ids
         
-    def get_pending_orders(self):
+    def get_admin_orders(self, filters=None, limit=ADMIN_PAGE, before=None):
+        """
+        Страница заказов для админки: (заказы, курсор следующей страницы).
+        filters['tracking'] ищет по нашему и китайскому трек-номеру; фото —
+        вторым запросом только по заказам страницы.
+        """
+        filters = filters or {}
+        clauses, params = [], []
+        tracking = str(filters.get('tracking') or '').strip()
+        if tracking:
+            # id из двух индексов трек-номеров; с OR планировщик идёт по всей
+            # таблице в порядке created_at, надеясь быстро набрать LIMIT
+            clauses.append(f'orders.id IN ({TRACKING_ORDER_IDS})')
+            params += [tracking, tracking]
+
+        query, params = admin_page_query('''
+            SELECT 
+                orders.id,
+                orders.user_id,
+                users.name AS user_name,
+                products.title AS product_title,
+                models.product_url AS url,
+                models.color_name AS color,
+                models.size_name AS size,
+                orders.quantity,
+                orders.status,
+                orders.total_price,
+                orders.our_tracking_number,
+                orders.china_tracking_number,
+                orders.cn_delivery_price,
+                orders.cn_delivery_paid,
+                orders.warehouse_location,
+                orders.weight,
+                orders.created_at,
+                orders.additional_services
+            FROM orders
+            JOIN users ON orders.user_id = users.id
+            JOIN models ON orders.model_id = models.id
+            JOIN products ON models.product_id = products.id
+        ''', 'orders', filters, limit, before, clauses, params)
+
         with self.get_cursor() as cursor:
             try:
-                cursor.execute('''
-                    SELECT 
-                        orders.id,
-                        users.name AS user_name,
-                        products.title AS product_title,
-                        models.product_url AS url,
-                        models.color_name AS color,
-                        models.size_name AS size,
-                        orders.quantity,
-                        orders.status,
-                        orders.total_price,
-                        orders.our_tracking_number,
-                        orders.china_tracking_number,
-                        orders.cn_delivery_price,
-                        orders.cn_delivery_paid,
-                        orders.photos,
-                        orders.warehouse_location,
-                        orders.created_at,
-                        orders.additional_services
-                    FROM orders
-                    JOIN users ON orders.user_id = users.id
-                    JOIN models ON orders.model_id = models.id
-                    JOIN products ON models.product_id = products.id
-                    ORDER BY orders.created_at DESC
-                ''')
-                
-                orders = cursor.fetchall()
-                columns = [column[0] for column in cursor.description]
+                cursor.execute(query, params)
+                rows, next_cursor = cut_page(cursor.fetchall(), limit)
+
+                # фото заказов страницы вторым запросом, а не разбором JSON в каждой строке
+                photos = defaultdict(list)
+                if rows:
+                    order_ids = [row['id'] for row in rows]
+                    cursor.execute(f'''
+                        SELECT order_id, url FROM order_photos
+                        WHERE order_id IN ({','.join('?' * len(order_ids))})
+                        ORDER BY order_id, position
+                    ''', order_ids)
+                    for photo in cursor.fetchall():
+                        photos[photo['order_id']].append(photo['url'])
+
                 orders_list = []
-                for row in orders:
-                    order_dict = dict(zip(columns, row))
+                for row in rows:
+                    order_dict = dict(row)
                     
                     additional_services = order_dict['additional_services']
                     if additional_services:
@@ -1013,27 +1475,118 @@ class Database:
                     else:
                         order_dict['additional_services_list'] = []
                     
-                    photos = order_dict['photos']
-                    if photos:
-                        try:
-                            photos_str = photos.strip('"\'')
-                            photos_list = json.loads(photos_str)
-                            order_dict['photos'] = photos_list
-                        except (json.JSONDecodeError, TypeError, AttributeError) as e:
-                            print(f"Ошибка при парсинге photos: {e}")
-                            order_dict['photos'] = []
-                    else:
-                        order_dict['photos'] = []
-                    
+                    order_dict['photos'] = photos.get(order_dict['id'], [])
                     orders_list.append(order_dict)
 
-
-                return orders_list
+                return orders_list, next_cursor
                 
             except sqlite3.Error as e:
                 print(f"Ошибка при получении заказов: {e}")
-                return []
+                return [], None
                 
+    def add_order_photos(self, order_id, urls):
+        """
+        Добавляет фото в конец списка заказа одним INSERT; уже добавленные
+        ссылки пропускаются. Возвращает добавленные ссылки или None, если
+        заказа нет.
+        """
+        urls = list(dict.fromkeys(u.strip() for u in urls if isinstance(u, str) and u.strip()))
+        with self.get_cursor() as cursor:
+            cursor.execute('SELECT 1 FROM orders WHERE id = ?', (order_id,))
+            if cursor.fetchone() is None:
+                return None
+            if not urls:
+                return []
+            cursor.execute(
+                'SELECT COALESCE(MAX(position), -1) + 1 FROM order_photos WHERE order_id = ?',
+                (order_id,)
+            )
+            start = cursor.fetchone()[0]
+            values = ', '.join(['(?, ?, ?)'] * len(urls))
+            params = []
+            for offset, url in enumerate(urls):
+                params += [order_id, url, start + offset]
+            cursor.execute(f'''
+                INSERT INTO order_photos (order_id, url, position) VALUES {values}
+                ON CONFLICT (order_id, url) DO NOTHING
+                RETURNING url
+            ''', params)
+            added = {row[0] for row in cursor.fetchall()}
+        return [url for url in urls if url in added]
+
+    def remove_order_photos(self, order_id, urls):
+        """Удаляет фото заказа одним DELETE; возвращает удалённые ссылки"""
+        urls = list(dict.fromkeys(u.strip() for u in urls if isinstance(u, str) and u.strip()))
+        if not urls:
+            return []
+        placeholders = ','.join('?' * len(urls))
+        with self.get_cursor() as cursor:
+            cursor.execute(
+                f'DELETE FROM order_photos WHERE order_id = ? AND url IN ({placeholders}) RETURNING url',
+                [order_id] + urls
+            )
+            removed = {row[0] for row in cursor.fetchall()}
+        return [url for url in urls if url in removed]
+
+    def get_orders_with_photos(self, user_id):
+        """
+        Заказы пользователя для страниц профиля вместе с фото проверки —
+        один запрос с LEFT JOIN на order_photos, строк по числу фото.
+        """
+        with self.get_cursor() as cursor:
+            cursor.execute('''
+                SELECT 
+                    o.id            AS order_id,
+                    o.created_at    AS order_date,
+                    o.our_tracking_number,
+                    o.total_price,
+                    o.model_id,
+                    o.quantity,
+                    o.status,
+                    o.cn_delivery_price,
+                    o.cn_delivery_paid,
+                    m.image_url,
+                    m.color_name    AS color,
+                    m.size_name     AS size,
+                    m.price         AS unit_price,
+                    p.title         AS product_title,
+                    ph.url          AS photo_url
+                FROM orders o
+                JOIN models m ON o.model_id = m.id
+                JOIN products p ON m.product_id = p.id
+                LEFT JOIN order_photos ph ON ph.order_id = o.id
+                WHERE o.user_id = ?
+                ORDER BY o.created_at DESC, o.id, o.model_id, ph.position
+            ''', (user_id,))
+            rows = cursor.fetchall()
+
+        orders = []
+        current = None
+        for r in rows:
+            if current is None or current['id'] != r['order_id']:
+                current = {
+                    'id': r['order_id'],
+                    'created_at': r['order_date'],
+                    'our_tracking_number': r['our_tracking_number'],
+                    'total_price': r['total_price'],
+                    'cn_delivery_price': r['cn_delivery_price'],
+                    'cn_delivery_paid': r['cn_delivery_paid'],
+                    'items': [{
+                        'product_title': r['product_title'],
+                        'image_url': r['image_url'],
+                        'color': r['color'],
+                        'size': r['size'],
+                        'price': r['unit_price'],
+                        'quantity': r['quantity'],
+                        'status': r['status'],
+                        'photos': []
+                    }]
+                }
+                orders.append(current)
+            if r['photo_url']:
+                current['items'][0]['photos'].append(r['photo_url'].split(' ')[0])
+        return orders
+
     def update_order_status(self, order_id, new_status):
         try:
             with self.get_cursor() as cursor:
@@ -1113,7 +1666,7 @@ class Database:
         
     def add_shipment(self,
                      user_id: int,
-                     model_ids: str,
+                     order_ids: list,
                      delivery_method: str,
                      packaging_options: list,
                      recipient_name: str,
@@ -1125,33 +1678,31 @@ class Database:
                      packaging_cost: float = 0.0,
                      total_cost: float | None = None,
                      our_tracking_number: str | None = None,
-                     status: str = 'pending'
+                     status: str = 'pending',
+                     fx_rate: float | None = None,
+                     charge: dict | None = None
                      ) -> int:
-        model_ids_str = model_ids if model_ids is not None else ''
+        """
+        Создаёт посылку и её состав в shipment_items (order_ids — orders.id в порядке
+        показа). charge — {'cny': ..., 'rub': ...}: списание за посылку с баланса
+        в той же транзакции.
+        """
+        order_ids = list(dict.fromkeys(int(oid) for oid in order_ids))
         packaging_str = ','.join(map(str, packaging_options)) if packaging_options else ''
 
         try:
             with self.get_cursor() as cursor:
-                # Убедимся, что колонка our_tracking_number существует (безопасно)
-                cursor.execute("PRAGMA table_info(order_shipments)")
-                cols = [row['name'] if isinstance(row, dict) and 'name' in row else row[1] for row in cursor.fetchall()]
-                if 'our_tracking_number' not in cols:
-                    try:
-                        cursor.execute("ALTER TABLE order_shipments ADD COLUMN our_tracking_number TEXT")
-                    except sqlite3.OperationalError:
-                        # игнорируем — миграцию нужно сделать отдельно
-                        pass
-
-                # Вставка: перечисляем колонки без лишней запятой
+                # model_ids дублирует состав для старых отчётов; читается только shipment_items
                 cursor.execute('''
                     INSERT INTO order_shipments (
                         user_id, model_ids, delivery_method, packaging_options,
                         recipient_name, recipient_phone, recipient_city, recipient_address,
-                        total_weight, delivery_cost, packaging_cost, total_cost, our_tracking_number, status
-                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                        total_weight, delivery_cost, packaging_cost, total_cost, our_tracking_number, status,
+                        fx_rate
+                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
                 ''', (
                     user_id,
-                    model_ids_str,
+                    json.dumps(order_ids),
                     delivery_method,
                     packaging_str,
                     recipient_name,
@@ -1163,96 +1714,30 @@ class Database:
                     packaging_cost,
                     total_cost,
                     our_tracking_number,
-                    status
+                    status,
+                    fx_rate
                 ))
-                return cursor.lastrowid
+                shipment_id = cursor.lastrowid
+                cursor.executemany(
+                    'INSERT INTO shipment_items (shipment_id, order_id, position) VALUES (?, ?, ?)',
+                    [(shipment_id, order_id, position) for position, order_id in enumerate(order_ids)]
+                )
+                if charge:
+                    self.change_balance(user_id, 'shipment', shipment_id,
+                                        cny=debit(charge, 'cny'), rub=debit(charge, 'rub'),
+                                        fx_rate=fx_rate, cursor=cursor)
+                return shipment_id
         except Exception as e:
             current_app.logger.exception(f"Failed to add shipment: {e}")
             raise
     
     def get_shipments_with_photos(self, user_id):
-        import json, sqlite3, re
-
-        def _strict_parse_ids(val):
-            """Только JSON [1,2] или CSV '1,2,3'. Без регэкспов."""
-            if val is None:
-                return []
-            if isinstance(val, (list, tuple)):
-                out = []
-                for v in val:
-                    try:
-                        out.append(int(v))
-                    except Exception:
-                        pass
-                return out
-            s = str(val).strip()
-            if not s:
-                return []
-            # JSON массив
-            if s.startswith('[') and s.endswith(']'):
-                try:
-                    arr = json.loads(s)
-                    if isinstance(arr, (list, tuple)):
-                        return [int(x) for x in arr if str(x).strip().isdigit()]
-                except Exception:
-                    return []
-            # CSV из цифр
-            parts = [p.strip() for p in s.split(',') if p.strip()]
-            out = []
-            for p in parts:
-                if p.isdigit():
-                    out.append(int(p))
-            return out
-
-        def _repair_broken_ids(raw_str, valid_ids):
-            """
-            Чиним строки вида '[,1,2,,, ,1,3,]'.
-            Склеиваем 3- / 2- / 1-значные числа, если они существуют в valid_ids.
-            """
-            if not raw_str:
-                return []
-            digits = re.findall(r'\d', str(raw_str))
-            if not digits:
-                return []
-            s = ''.join(digits)  # например '1213'
-            out = []
-            i = 0
-            # Определим максимальную длину id в БД (обычно 1..6)
-            max_len = max((len(str(x)) for x in valid_ids), default=1)
-            max_len = min(max_len, 6)
-            while i < len(s):
-                taken = False
-                # сначала пробуем длинные окна
-                for L in range(min(max_len, len(s)-i), 0, -1):
-                    candidate = int(s[i:i+L])
-                    if candidate in valid_ids:
-                        out.append(candidate)
-                        i += L
-                        taken = True
-                        break
-                if not taken:
-                    i += 1
-            # убираем дубли, сохраняя порядок
-            seen = set()
-            res = []
-            for oid in out:
-                if oid not in seen:
-                    seen.add(oid)
-                    res.append(oid)
-            return res
-
-        # helper: безопасное получение из row
-        def g(row, key, idx):
-            if isinstance(row, dict):
-                return row.get(key)
-            return row[idx]
-
+        """Посылки пользователя с фото товаров; два запроса при любом числе посылок"""
         try:
             with self.get_cursor() as cursor:
                 cursor.execute('''
                     SELECT 
                         id,
-                        model_ids,
                         recipient_city,
                         status,
                         created_at,
@@ -1269,425 +1754,250 @@ class Database:
                 rows = cursor.fetchall()
                 if not rows:
                     return []
+
+                # состав и фото всех посылок пользователя — одним запросом
+                cursor.execute('''
+                    SELECT si.shipment_id, si.order_id, m.image_url
+                    FROM order_shipments s
+                    JOIN shipment_items si ON si.shipment_id = s.id
+                    LEFT JOIN orders o ON o.id = si.order_id
+                    LEFT JOIN models m ON m.id = o.model_id
+                    WHERE s.user_id = ?
+                    ORDER BY si.shipment_id, si.position
+                ''', (user_id,))
+                order_ids = defaultdict(list)
+                photo_urls = defaultdict(list)
+                for item in cursor.fetchall():
+                    order_ids[item['shipment_id']].append(item['order_id'])
+                    if item['image_url']:
+                        photo_urls[item['shipment_id']].append(item['image_url'])
         except sqlite3.Error as e:
             print(f"Database error: {e}")
             return []
 
-        shipments_list = []
-        all_order_ids = set()
+        def to_float(v, d=None):
+            try: return float(v)
+            except Exception: return d
+        def to_int(v, d=None):
+            try: return int(v)
+            except Exception: return d
 
+        shipments_list = []
         for r in rows:
-            sid               = g(r, 'id', 0)
-            model_ids_raw     = g(r, 'model_ids', 1)
-            recipient_city    = g(r, 'recipient_city', 2)
-            status            = g(r, 'status', 3)
-            created_at        = g(r, 'created_at', 4)
-            recipient_address = g(r, 'recipient_address', 5)
-            total_weight      = g(r, 'total_weight', 6)
-            our_track         = g(r, 'our_tracking_number', 7)
-            delivery_method   = g(r, 'delivery_method', 8)
-            packaging_cost    = g(r, 'packaging_cost', 9)
-            packaging_paid    = g(r, 'packaging_paid', 10)
-
-            try:
-                sid = int(sid)
-            except Exception:
-                continue
-
-            # пробуем жёсткий парсер
-            order_ids = _strict_parse_ids(model_ids_raw)
-
-            # если пусто или подозрительно — чиним, сверяясь с валидными orders для пользователя
-            if not order_ids:
-                try:
-                    with self.get_cursor() as cursor:
-                        valid_ids_rows = cursor.execute(
-                            "SELECT id FROM orders WHERE user_id = ?",
-                            (user_id,)
-                        ).fetchall()
-                    valid_ids = { (x['id'] if isinstance(x, dict) else x[0]) for x in valid_ids_rows }
-                except Exception:
-                    valid_ids = set()
-                if valid_ids:
-                    order_ids = _repair_broken_ids(model_ids_raw, valid_ids)
-
-            # окончательно убираем дубли, сохраняя порядок
-            seen = set()
-            order_ids = [oid for oid in order_ids if (oid not in seen and not seen.add(oid))]
-
-            all_order_ids.update(order_ids)
-
-            try:
-                total_weight = float(total_weight) if total_weight is not None else None
-            except Exception:
-                total_weight = None
-
-            try:
-                packaging_cost = float(packaging_cost or 0.0)
-            except Exception:
-                packaging_cost = 0.0
-
-            try:
-                packaging_paid = int(packaging_paid or 0)
-            except Exception:
-                packaging_paid = 0
-
             shipments_list.append({
-                'id': sid,
-                'order_ids': order_ids,
-                'recipient_city': recipient_city,
-                'recipient_address': recipient_address,
-                'status': status,
-                'created_at': created_at,
-                'total_weight': total_weight,
-                'our_tracking_number': our_track,
-                'delivery_method': delivery_method,
-                'packaging_cost': packaging_cost,
-                'packaging_paid': packaging_paid,
-                'photo_urls': []
+                'id': r['id'],
+                'order_ids': order_ids[r['id']],
+                'recipient_city': r['recipient_city'],
+                'recipient_address': r['recipient_address'],
+                'status': r['status'],
+                'created_at': r['created_at'],
+                'total_weight': to_float(r['total_weight']),
+                'our_tracking_number': r['our_tracking_number'],
+                'delivery_method': r['delivery_method'],
+                'packaging_cost': to_float(r['packaging_cost'] or 0.0, 0.0),
+                'packaging_paid': to_int(r['packaging_paid'] or 0, 0),
+                'photo_urls': photo_urls[r['id']]
             })
-
-        if not all_order_ids:
-            return shipments_list
-
-        # подтягиваем фото по orders.id
-        try:
-            with self.get_cursor() as cursor:
-                placeholders = ','.join(['?'] * len(all_order_ids))
-                cursor.execute(f'''
-                    SELECT 
-                        o.id AS order_id,
-                        m.image_url
-                    FROM orders o
-                    LEFT JOIN models m ON o.model_id = m.id
-                    WHERE o.id IN ({placeholders})
-                ''', list(all_order_ids))
-                photo_rows = cursor.fetchall()
-        except sqlite3.Error as e:
-            print(f"Database error: {e}")
-            photo_rows = []
-
-        order_photos = {}
-        for pr in photo_rows:
-            if isinstance(pr, dict):
-                oid = pr.get('order_id')
-                url = pr.get('image_url')
-            else:
-                oid, url = pr[0], pr[1]
-            try:
-                oid = int(oid)
-            except Exception:
-                continue
-            if not url:
-                continue
-            order_photos.setdefault(oid, []).append(url)
-
-        # приклеиваем фото
-        for s in shipments_list:
-            photos = []
-            for oid in s['order_ids']:
-                photos.extend(order_photos.get(oid, []))
-            s['photo_urls'] = photos
-
         return shipments_list
       
                     
     def calculate_total_weight(self, order_ids):
-        with self.get_cursor() as cursor:
-            if not order_ids:
-                return 0.0
-            total = 0.0            
-            try:
-                for order_id in order_ids:
-                    cursor.execute('SELECT weight FROM orders WHERE id = ?', (order_id,))
-                    result = cursor.fetchone()
-                    if result and result[0]:
-                        total += float(result[0])
-                        
-                return total
-                
-            except sqlite3.Error as e:
-                print(f"Database error: {e}")
-                return 0.0
-                        
-    def get_pending_shipments(self) -> List[Dict[str, Any]]:
-        import json, re
-        from flask import current_app
-
-        # есть ли колонка packaging_paid
-        has_packaging_paid = False
+        """Суммарный вес заказов одним запросом"""
+        ids = list(dict.fromkeys(order_ids))
+        if not ids:
+            return 0.0
+        placeholders = ','.join('?' * len(ids))
         try:
             with self.get_cursor() as cursor:
-                cols = cursor.execute("PRAGMA table_info(order_shipments)").fetchall()
-            def _n(c): return (c.get('name') if isinstance(c, dict) else c[1])
-            has_packaging_paid = 'packaging_paid' in {_n(c) for c in cols}
-        except Exception:
-            pass
-
-        select_cols = """
-            id, user_id, model_ids, delivery_method, packaging_options,
-            recipient_name, recipient_phone, recipient_city, recipient_address,
-            total_weight, delivery_cost, packaging_cost, total_cost,
-            our_tracking_number, created_at, status
-        """
-        if has_packaging_paid:
-            select_cols += ", packaging_paid"
-
-        try:
-            with self.get_cursor() as cursor:
-                cursor.execute(f'''
-                    SELECT {select_cols}
-                    FROM order_shipments
-                    -- не скрываем из админки: показываем все рабочие
-                    WHERE status IN ('pending','processing','shipped','delivered')
-                    ORDER BY datetime(created_at) DESC
-                ''')
-                rows = cursor.fetchall()
-        except Exception as e:
-            current_app.logger.exception("Failed to fetch shipments: %s", e)
-            return []
+                cursor.execute(
+                    f'SELECT COALESCE(SUM(weight), 0) FROM orders WHERE id IN ({placeholders})',
+                    ids
+                )
+                return float(cursor.fetchone()[0])
+        except sqlite3.Error as e:
+            print(f"Database error: {e}")
+            return 0.0
 
-        def _strict_parse_ids(val):
-            if val is None:
-                return []
-            if isinstance(val, (list, tuple)):
-                out = []
-                for v in val:
-                    try: out.append(int(v))
-                    except Exception: pass
-                return out
-            s = str(val).strip()
-            if not s:
-                return []
-            if s.startswith('[') and s.endswith(']'):
-                try:
-                    arr = json.loads(s)
-                    if isinstance(arr, (list, tuple)):
-                        return [int(x) for x in arr if str(x).strip().isdigit()]
-                except Exception:
-                    return []
-            parts = [p.strip() for p in s.split(',') if p.strip()]
-            return [int(p) for p in parts if p.isdigit()]
+    def update_orders_status(self, order_ids, new_status, user_id=None):
+        """
+        Меняет статус нескольких заказов одним запросом; если задан user_id —
+        только заказов этого пользователя. Возвращает множество обновлённых id.
+        """
+        ids = list(dict.fromkeys(order_ids))
+        if not ids:
+            return set()
+        placeholders = ','.join('?' * len(ids))
+        query = f'''
+            UPDATE orders
+            SET status = ?, updated_at = CURRENT_TIMESTAMP
+            WHERE id IN ({placeholders})
+        '''
+        params = [new_status] + ids
+        if user_id is not None:
+            query += ' AND user_id = ?'
+            params.append(user_id)
+        with self.get_cursor() as cursor:
+            cursor.execute(query + ' RETURNING id', params)
+            return {row[0] for row in cursor.fetchall()}
+
+    _SHIPMENT_COLUMNS = '''
+        s.id, s.user_id, s.delivery_method, s.packaging_options,
+        s.recipient_name, s.recipient_phone, s.recipient_city, s.recipient_address,
+        s.total_weight, s.delivery_cost, s.packaging_cost, s.total_cost,
+        s.our_tracking_number, s.created_at, s.status, s.packaging_paid
+    '''
+
+    def _shipment_items_query(self, where):
+        """Состав посылок (условие where на s и si) с заказами, моделями, товарами и покупателями"""
+        # какие поля есть у users — схема известна после миграций, берём из кэша
+        user_cols = self.columns('users')
+
+        def pick_user_expr(preferred, fallbacks, alias):
+            for col in ([preferred] + fallbacks):
+                if col in user_cols:
+                    return f"u.{col} AS {alias}"
+            return f"NULL AS {alias}"
+
+        u_name_expr    = pick_user_expr('name', ['full_name','fullname','username','login'], 'u_name')
+        u_phone_expr   = pick_user_expr('phone', ['phone_number','tel','telephone','mobile'], 'u_phone')
+        u_city_expr    = pick_user_expr('city', ['town','locality'], 'u_city')
+        u_address_expr = pick_user_expr('address', ['addr','street','address_line'], 'u_address')
+
+        return f"""
+            SELECT 
+                si.shipment_id          AS shipment_id,
+                si.order_id             AS order_id,
+                o.id                    AS o_id,
+                o.user_id               AS buyer_id,
+                o.model_id              AS model_id,
+                o.quantity              AS quantity,
+                o.weight                AS weight,
+                o.total_price           AS price,
+                o.our_tracking_number   AS our_tracking_number,
+                o.china_tracking_number AS china_tracking_number,
+                o.created_at            AS order_created_at,
+
+                m.id                    AS m_id,
+                m.product_id            AS product_id,
+                m.product_url           AS product_url,
+                m.color_name            AS color_name,
+                m.size_name             AS size_name,
+                m.image_url             AS model_image_url,
+
+                p.title                 AS product_title,
+
+                u.id                    AS u_id,
+                {u_name_expr},
+                {u_phone_expr},
+                {u_city_expr},
+                {u_address_expr}
+            FROM order_shipments s
+            JOIN shipment_items si ON si.shipment_id = s.id
+            LEFT JOIN orders   o ON o.id = si.order_id
+            LEFT JOIN models   m ON o.model_id = m.id
+            LEFT JOIN products p ON m.product_id = p.id
+            LEFT JOIN users    u ON o.user_id = u.id
+            WHERE {where}
+            ORDER BY si.shipment_id, si.position
+        """
 
-        def _repair_broken_ids(raw_str, valid_ids):
-            digits = re.findall(r'\d', str(raw_str))
-            if not digits:
-                return []
-            s = ''.join(digits)
-            out = []
-            i = 0
-            max_len = max((len(str(x)) for x in valid_ids), default=1)
-            max_len = min(max_len, 6)
-            while i < len(s):
-                taken = False
-                for L in range(min(max_len, len(s)-i), 0, -1):
-                    candidate = int(s[i:i+L])
-                    if candidate in valid_ids:
-                        out.append(candidate)
-                        i += L
-                        taken = True
-                        break
-                if not taken:
-                    i += 1
-            seen = set()
-            res = []
-            for oid in out:
-                if oid not in seen:
-                    seen.add(oid)
-                    res.append(oid)
-            return res
-
-        def safe_get(row, key, idx):
-            try:
-                if isinstance(row, dict):
-                    return row.get(key)
-                return row[idx]
-            except Exception:
-                return None
+    def get_admin_shipments(self, filters=None, limit=ADMIN_PAGE, before=None):
+        """
+        Страница посылок для админки: (посылки, курсор следующей страницы).
+        filters['tracking'] ищет по треку посылки и по трекам заказов в ней;
+        состав — вторым запросом только по посылкам страницы.
+        """
+        filters = filters or {}
+        clauses, params = [], []
+        tracking = str(filters.get('tracking') or '').strip()
+        if tracking:
+            clauses.append(f'''(s.our_tracking_number = ? OR s.id IN (
+                SELECT si.shipment_id FROM shipment_items si
+                WHERE si.order_id IN ({TRACKING_ORDER_IDS})
+            ))''')
+            params += [tracking] * 3
+
+        query, params = admin_page_query(
+            f'SELECT {self._SHIPMENT_COLUMNS} FROM order_shipments s',
+            's', filters, limit, before, clauses, params
+        )
+        with self.get_cursor() as cursor:
+            cursor.execute(query, params)
+            rows, next_cursor = cut_page(cursor.fetchall(), limit)
+            item_rows = []
+            if rows:
+                shipment_ids = [row['id'] for row in rows]
+                cursor.execute(self._shipment_items_query(
+                    f"si.shipment_id IN ({','.join('?' * len(shipment_ids))})"
+                ), shipment_ids)
+                item_rows = cursor.fetchall()
+        return self._build_shipments(rows, item_rows), next_cursor
+
+    def _build_shipments(self, rows, item_rows):
+        """Собирает посылки с составом из строк order_shipments и _shipment_items_query"""
+        shipment_orders = defaultdict(list)
+        by_oid = {}
+        for row in item_rows:
+            shipment_orders[row['shipment_id']].append(row['order_id'])
+            if row['o_id'] is not None:
+                by_oid[row['order_id']] = row
+
+        def to_int(v, d=None):
+            try: return int(v)
+            except Exception: return d
+        def to_float(v, d=None):
+            try: return float(v)
+            except Exception: return d
+
+        def make_item(oid):
+            r0 = by_oid.get(oid)
+            if not r0:
+                return {
+                    'order_id': oid,
+                    'model_id': None,
+                    'product_title': None,
+                    'quantity': None,
+                    'weight': None,
+                    'price': None,
+                    'our_tracking_number': None,
+                    'china_tracking_number': None,
+                    'buyer': None,
+                    'product': None,
+                    'found': False
+                }
+            return {
+                'order_id': oid,
+                'model_id': to_int(r0['model_id']),
+                'product_title': r0['product_title'],
+                'quantity': to_int(r0['quantity']),
+                'weight': to_float(r0['weight']),
+                'price': to_float(r0['price']),
+                'our_tracking_number': r0['our_tracking_number'],
+                'china_tracking_number': r0['china_tracking_number'],
+                'buyer': {
+                    'id': r0['buyer_id'] or r0['u_id'],
+                    'name': r0['u_name'],
+                    'phone': r0['u_phone'],
+                    'city': r0['u_city'],
+                    'address': r0['u_address'],
+                },
+                'product': {
+                    'id': r0['product_id'],
+                    'url': r0['product_url'],
+                    'color_name': r0['color_name'],
+                    'size_name': r0['size_name'],
+                    'image_url': r0['model_image_url'],
+                },
+                'found': True
+            }
 
         shipments: List[Dict[str, Any]] = []
-
         for r in rows:
-            sid                 = safe_get(r, 'id', 0)
-            creator_user_id     = safe_get(r, 'user_id', 1)
-            model_ids_raw       = safe_get(r, 'model_ids', 2)
-            delivery_method     = safe_get(r, 'delivery_method', 3)
-            packaging_raw       = safe_get(r, 'packaging_options', 4)
-            recipient_name      = safe_get(r, 'recipient_name', 5)
-            recipient_phone     = safe_get(r, 'recipient_phone', 6)
-            recipient_city      = safe_get(r, 'recipient_city', 7)
-            recipient_address   = safe_get(r, 'recipient_address', 8)
-            total_weight        = safe_get(r, 'total_weight', 9)
-            delivery_cost       = safe_get(r, 'delivery_cost', 10)
-            packaging_cost      = safe_get(r, 'packaging_cost', 11)
-            total_cost          = safe_get(r, 'total_cost', 12)
-            our_tracking_number = safe_get(r, 'our_tracking_number', 13)
-            created_at          = safe_get(r, 'created_at', 14)
-            status              = safe_get(r, 'status', 15)
-            packaging_paid      = safe_get(r, 'packaging_paid', 16) if has_packaging_paid else 0
-
-            # 1) строгий парс
-            order_ids = _strict_parse_ids(model_ids_raw)
-
-            # 2) если пусто — пытаемся чинить, сверяясь с заказами конкретного владельца посылки
-            valid_ids = set()
-            try:
-                with self.get_cursor() as cursor:
-                    rows_valid = cursor.execute(
-                        "SELECT id FROM orders WHERE user_id = ?",
-                        (creator_user_id,)
-                    ).fetchall()
-                valid_ids = { (x['id'] if isinstance(x, dict) else x[0]) for x in rows_valid }
-            except Exception:
-                pass
-
-            if (not order_ids) and valid_ids:
-                order_ids = _repair_broken_ids(model_ids_raw, valid_ids)
-
-            # 3) убираем дубли, сохраняем порядок
-            seen = set()
-            order_ids = [oid for oid in order_ids if (oid not in seen and not seen.add(oid))]
-
-            # 4) тянем товары только по orders.id
-            items: List[Dict[str, Any]] = []
-            if order_ids:
-                # какие поля есть у users
-                try:
-                    with self.get_cursor() as cursor:
-                        cols = cursor.execute("PRAGMA table_info(users)").fetchall()
-                    def _name(c): return (c.get('name') if isinstance(c, dict) else c[1])
-                    user_cols = {_name(c) for c in cols}
-                except Exception:
-                    user_cols = set()
-
-                def pick_user_expr(preferred, fallbacks, alias):
-                    for col in ([preferred] + fallbacks):
-                        if col in user_cols:
-                            return f"u.{col} AS {alias}"
-                    return f"NULL AS {alias}"
-
-                u_name_expr    = pick_user_expr('name', ['full_name','fullname','username','login'], 'u_name')
-                u_phone_expr   = pick_user_expr('phone', ['phone_number','tel','telephone','mobile'], 'u_phone')
-                u_city_expr    = pick_user_expr('city', ['town','locality'], 'u_city')
-                u_address_expr = pick_user_expr('address', ['addr','street','address_line'], 'u_address')
-
-                placeholders = ','.join(['?'] * len(order_ids))
-                sql = f"""
-                    SELECT 
-                        o.id                    AS order_id,
-                        o.user_id               AS buyer_id,
-                        o.model_id              AS model_id,
-                        o.quantity              AS quantity,
-                        o.weight                AS weight,
-                        o.total_price           AS price,
-                        o.our_tracking_number   AS our_tracking_number,
-                        o.china_tracking_number AS china_tracking_number,
-                        o.created_at            AS order_created_at,
-
-                        m.id                    AS m_id,
-                        m.product_id            AS product_id,
-                        m.product_url           AS product_url,
-                        m.color_name            AS color_name,
-                        m.size_name             AS size_name,
-                        m.image_url             AS model_image_url,
-
-                        p.title                 AS product_title,
-
-                        u.id                    AS u_id,
-                        {u_name_expr},
-                        {u_phone_expr},
-                        {u_city_expr},
-                        {u_address_expr}
-                    FROM orders o
-                    LEFT JOIN models   m ON o.model_id = m.id
-                    LEFT JOIN products p ON m.product_id = p.id
-                    LEFT JOIN users    u ON o.user_id = u.id
-                    WHERE o.id IN ({placeholders})
-                """
-                try:
-                    with self.get_cursor() as cursor:
-                        order_rows = cursor.execute(sql, order_ids).fetchall()
-                except Exception as ex:
-                    current_app.logger.exception("Error fetching orders for shipment %s: %s", sid, ex)
-                    order_rows = []
-
-                def _asdict(row):
-                    return dict(row) if isinstance(row, dict) else {
-                        'order_id'            : row[0],
-                        'buyer_id'            : row[1],
-                        'model_id'            : row[2],
-                        'quantity'            : row[3],
-                        'weight'              : row[4],
-                        'price'               : row[5],
-                        'our_tracking_number' : row[6],
-                        'china_tracking_number': row[7],
-                        'order_created_at'    : row[8],
-                        'm_id'                : row[9],
-                        'product_id'          : row[10],
-                        'product_url'         : row[11],
-                        'color_name'          : row[12],
-                        'size_name'           : row[13],
-                        'model_image_url'     : row[14],
-                        'product_title'       : row[15],
-                        'u_id'                : row[16],
-                        'u_name'              : row[17],
-                        'u_phone'             : row[18],
-                        'u_city'              : row[19],
-                        'u_address'           : row[20],
-                    }
-
-                order_rows = [_asdict(x) for x in order_rows]
-                by_oid = { int(x['order_id']): x for x in order_rows if x.get('order_id') is not None }
-
-                for oid in order_ids:
-                    r0 = by_oid.get(oid)
-                    if r0:
-                        items.append({
-                            'order_id': oid,
-                            'model_id': (int(r0['model_id']) if r0.get('model_id') is not None else None),
-                            'product_title': r0.get('product_title'),
-                            'quantity': (int(r0['quantity']) if r0.get('quantity') is not None else None),
-                            'weight': (float(r0['weight']) if r0.get('weight') is not None else None),
-                            'price': (float(r0['price']) if r0.get('price') is not None else None),
-                            'our_tracking_number': r0.get('our_tracking_number'),
-                            'china_tracking_number': r0.get('china_tracking_number'),
-                            'buyer': {
-                                'id': r0.get('buyer_id') or r0.get('u_id'),
-                                'name': r0.get('u_name'),
-                                'phone': r0.get('u_phone'),
-                                'city': r0.get('u_city'),
-                                'address': r0.get('u_address'),
-                            },
-                            'product': {
-                                'id': r0.get('product_id'),
-                                'url': r0.get('product_url'),
-                                'color_name': r0.get('color_name'),
-                                'size_name': r0.get('size_name'),
-                                'image_url': r0.get('model_image_url'),
-                            },
-                            'found': True
-                        })
-                    else:
-                        items.append({
-                            'order_id': oid,
-                            'model_id': None,
-                            'product_title': None,
-                            'quantity': None,
-                            'weight': None,
-                            'price': None,
-                            'our_tracking_number': None,
-                            'china_tracking_number': None,
-                            'buyer': None,
-                            'product': None,
-                            'found': False
-                        })
+            order_ids = shipment_orders[r['id']]
 
             # packaging_options
-            if packaging_raw is None:
-                packaging_options = None
-            elif isinstance(packaging_raw, (list, tuple)):
-                packaging_options = [str(x) for x in packaging_raw]
-            elif isinstance(packaging_raw, str):
+            packaging_raw = r['packaging_options']
+            if isinstance(packaging_raw, str):
                 s = packaging_raw.strip()
                 if s.startswith('[') and s.endswith(']'):
                     try:
@@ -1700,31 +2010,27 @@ class Database:
             else:
                 packaging_options = None
 
-            def to_int(v, d=None):
-                try: return int(v)
-                except Exception: return d
-            def to_float(v, d=None):
-                try: return float(v)
-                except Exception: return d
-
+            delivery_method = r['delivery_method']
+            our_tracking_number = r['our_tracking_number']
+            status = r['status']
             shipments.append({
-                'id': to_int(sid),
-                'creator_user_id': to_int(creator_user_id),
+                'id': to_int(r['id']),
+                'creator_user_id': to_int(r['user_id']),
                 'model_ids': order_ids,
-                'items': items,
+                'items': [make_item(oid) for oid in order_ids],
                 'delivery_method': (str(delivery_method) if delivery_method is not None else None),
                 'packaging_options': packaging_options,
-                'recipient_name': recipient_name,
-                'recipient_phone': recipient_phone,
-                'recipient_city': recipient_city,
-                'recipient_address': recipient_address,
-                'total_weight': to_float(total_weight),
-                'delivery_cost': to_float(delivery_cost),
-                'packaging_cost': to_float(packaging_cost, 0.0),
-                'packaging_paid': to_int(packaging_paid, 0),
-                'total_cost': to_float(total_cost),
+                'recipient_name': r['recipient_name'],
+                'recipient_phone': r['recipient_phone'],
+                'recipient_city': r['recipient_city'],
+                'recipient_address': r['recipient_address'],
+                'total_weight': to_float(r['total_weight']),
+                'delivery_cost': to_float(r['delivery_cost']),
+                'packaging_cost': to_float(r['packaging_cost'], 0.0),
+                'packaging_paid': to_int(r['packaging_paid'], 0),
+                'total_cost': to_float(r['total_cost']),
                 'our_tracking_number': (str(our_tracking_number) if our_tracking_number is not None else None),
-                'created_at': created_at,
+                'created_at': r['created_at'],
                 'status': (str(status) if status is not None else None)
             })
 
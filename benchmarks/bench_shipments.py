@@ -0,0 +1,90 @@
+"""
+Время и число запросов при сборке списков посылок.
+
+Запуск из корня проекта:
+    python -m benchmarks.bench_shipments [--shipments 10000] [--runs 5]
+
+База заполняется как в benchmarks.query_plans (на 10k посылок — 100k заказов,
+состав посылок — в shipment_items). Для Database.get_admin_shipments (первая
+страница админки, рабочие посылки) и get_shipments_with_photos (профиль самого активного пользователя) печатаются
+медианное время и число SQL-запросов за вызов; число запросов не должно
+зависеть от количества посылок.
+"""
+import os
+import time
+import sqlite3
+import argparse
+import tempfile
+import statistics
+from flask import Flask
+from base import Database
+from migrations import migrate
+from benchmarks.query_plans import SIZES, SHIPMENT_STATUSES, seed
+
+
+def prepare(path, shipments, seed_value=42):
+    conn = sqlite3.connect(path, isolation_level=None)
+    conn.execute('PRAGMA synchronous = OFF')
+    conn.execute('BEGIN IMMEDIATE')
+    migrate(conn.cursor())
+    conn.execute('COMMIT')
+    seed(conn, scale=shipments / SIZES['order_shipments'], seed_value=seed_value)
+    total = conn.execute('SELECT COUNT(*) FROM order_shipments').fetchone()[0]
+    conn.close()
+    return total
+
+
+def measure(db, func, runs):
+    """Медианное время (мс) и число запросов за один вызов"""
+    statements = []
+    conn = db.get_connection()
+    conn.set_trace_callback(statements.append)
+    try:
+        func()
+    finally:
+        conn.set_trace_callback(None)
+
+    samples = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        result = func()
+        samples.append((time.perf_counter() - started) * 1000)
+    return statistics.median(samples), len(statements), len(result)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--shipments', type=int, default=10000)
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'shipments.db')
+        started = time.perf_counter()
+        total = prepare(path, args.shipments)
+        print(f"Посылок: {total}, база готова за {time.perf_counter() - started:.1f} с")
+
+        app = Flask(__name__)
+        app.config.update(DATABASE=path)
+        db = Database(app)
+        with app.app_context():
+            with db.get_cursor() as cursor:
+                cursor.execute('''
+                    SELECT user_id FROM order_shipments
+                    GROUP BY user_id ORDER BY COUNT(*) DESC LIMIT 1
+                ''')
+                user_id = cursor.fetchone()[0]
+            # схема users кэшируется первым вызовом; в замер не входит
+            db.columns('users')
+
+            print(f"{'метод':<40} {'мс':>9} {'запросов':>9} {'посылок':>8}")
+            for name, func in (
+                ('get_admin_shipments()', lambda: db.get_admin_shipments({'status': SHIPMENT_STATUSES})[0]),
+                (f'get_shipments_with_photos({user_id})', lambda: db.get_shipments_with_photos(user_id)),
+            ):
+                elapsed, queries, rows = measure(db, func, args.runs)
+                print(f"{name:<40} {elapsed:>9.1f} {queries:>9} {rows:>8}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+"""
+Сравнение способов достать data-obj из страницы товара Weidian.
+
+Запуск из корня проекта:
+    python -m benchmarks.bench_weidian_extract [--skus 200] [--filler-kb 800] [--runs 20]
+
+Страница синтетическая, но по структуре как настоящая: заголовок со
+скриптами, тег __rocker-render-inject__ с JSON товара и объёмная разметка
+после него. Для каждого способа печатается время и пик памяти на страницу,
+для потокового режима — сколько байт пришлось прочитать до остановки.
+"""
+import json
+import html
+import time
+import argparse
+import tracemalloc
+from bs4 import BeautifulSoup, SoupStrainer
+from parser.weidian import (
+    RENDER_INJECT_ID, STREAM_CHUNK_SIZE, scan_render_inject, extract_render_data
+)
+
+
+def build_page(skus, filler_kb):
+    data = {"result": {"default_model": {
+        "item_info": {"item_name": "测试商品", "itemLowPrice": 12300},
+        "sku_properties": {
+            "attr_list": [
+                {"attr_values": [{"attr_id": c, "attr_value": f"颜色{c}"} for c in range(20)]},
+                {"attr_values": [{"attr_id": 100 + s, "attr_value": f"尺码{s}"} for s in range(10)]},
+            ],
+            "sku": {str(1000 + i): {"attr_ids": f"{i % 20}-{100 + i % 10}", "price": "123.00",
+                                    "stock": 5, "img": f"https://si.geilicdn.com/{i}.jpg"}
+                    for i in range(skus)},
+        },
+    }}}
+    head = '<html><head><title>商品</title>' + '<script src="/static/app.js"></script>' * 30 + '</head><body>'
+    tag = (f'<script id="{RENDER_INJECT_ID}" data-obj="'
+           + html.escape(json.dumps(data, ensure_ascii=False)) + '"></script>')
+    block = '<div class="item"><span class="name">文本</span><a href="/x?a=1&amp;b=2">ссылка</a></div>\n'
+    filler = block * (filler_kb * 1024 // len(block.encode()))
+    return head + tag + filler + '</body></html>'
+
+
+def full_parse(page):
+    soup = BeautifulSoup(page, 'html.parser')
+    return json.loads(soup.find('script', {'id': RENDER_INJECT_ID}).get('data-obj'))
+
+
+def strainer_parse(page):
+    only = SoupStrainer('script', id=RENDER_INJECT_ID)
+    return json.loads(BeautifulSoup(page, 'html.parser', parse_only=only).find('script').get('data-obj'))
+
+
+def streamed_bytes(page):
+    """Сколько байт прочитал бы fetch_render_data, прежде чем остановиться"""
+    raw = page.encode('utf-8')
+    text = ''
+    for start in range(0, len(raw), STREAM_CHUNK_SIZE):
+        text += raw[start:start + STREAM_CHUNK_SIZE].decode('utf-8', errors='ignore')
+        if scan_render_inject(text) is not None:
+            return min(start + STREAM_CHUNK_SIZE, len(raw))
+    return len(raw)
+
+
+def measure(func, page, runs):
+    func(page)
+    started = time.perf_counter()
+    for _ in range(runs):
+        func(page)
+    elapsed_ms = (time.perf_counter() - started) * 1000 / runs
+
+    tracemalloc.start()
+    func(page)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed_ms, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--skus', type=int, default=200)
+    parser.add_argument('--filler-kb', type=int, default=800)
+    parser.add_argument('--runs', type=int, default=20)
+    args = parser.parse_args()
+
+    page = build_page(args.skus, args.filler_kb)
+    expected = full_parse(page)
+    print(f"Страница: {len(page.encode()) / 1024:.0f} KB, SKU: {args.skus}")
+
+    baseline = None
+    for name, func in (
+        ('BeautifulSoup (вся страница)', full_parse),
+        ('BeautifulSoup + SoupStrainer', strainer_parse),
+        ('scan_render_inject', extract_render_data),
+    ):
+        assert func(page) == expected, name
+        elapsed_ms, peak = measure(func, page, args.runs)
+        baseline = baseline or (elapsed_ms, peak)
+        print(f"{name:<32} {elapsed_ms:8.2f} ms/стр  пик {peak / 1024 / 1024:6.2f} MB"
+              f"  (x{baseline[0] / elapsed_ms:.1f} быстрее, памяти в {baseline[1] / max(peak, 1):.1f} раз меньше)")
+
+    read = streamed_bytes(page)
+    print(f"Потоковая загрузка: прочитано {read / 1024:.0f} KB из {len(page.encode()) / 1024:.0f} KB")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,316 @@
+"""
+Стенд с записанными ответами внешних сервисов: tmapi item_detail, страницы
+товаров Weidian, daily_json.js ЦБ и переводчик. Нужен, чтобы импорт товаров и
+курсы можно было гонять без сети, под нагрузкой и с имитацией сбоев.
+
+Запуск:
+    python -m benchmarks.fixture_server --port 8800 --latency 150 --jitter 50 --error-rate 0.05
+    python -m benchmarks.fixture_server --fault tmapi:latency=800,timeout_rate=0.1 --fault cbr:error_rate=1
+
+Приложение направляется на стенд переменными окружения:
+    TMAPI_ITEM_DETAIL_URL=http://127.0.0.1:8800/taobao/item_detail
+    WEIDIAN_BASE_URL=http://127.0.0.1:8800/weidian
+    CBR_URL=http://127.0.0.1:8800/cbr/daily_json.js
+    TRANSLATOR_BACKEND=http TRANSLATOR_URL=http://127.0.0.1:8800/translate
+
+Ответы лежат в benchmarks/fixtures. Для id товара без своей записи отдаётся
+одна из имеющихся (выбор по id детерминирован). Новые записи:
+    python -m benchmarks.fixture_server record tmapi 652874751412      # нужен API_TOKEN
+    python -m benchmarks.fixture_server record weidian 'https://weidian.com/item.html?itemID=...'
+    python -m benchmarks.fixture_server record cbr
+
+Служебные адреса: GET /__stats — счётчики по сервисам, POST /__config —
+поменять параметры сбоев на лету (JSON вида {"tmapi": {"error_rate": 0.2}}).
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+SERVICES = ('tmapi', 'weidian', 'cbr', 'translate')
+
+
+class Faults:
+    """Параметры задержек и сбоев одного сервиса"""
+
+    FIELDS = ('latency', 'jitter', 'error_rate', 'error_status', 'timeout_rate', 'hang')
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, error_status=503,
+                 timeout_rate=0.0, hang=60.0):
+        self.latency = latency            # мс
+        self.jitter = jitter              # мс, равномерно в обе стороны
+        self.error_rate = error_rate      # доля ответов с error_status
+        self.error_status = error_status
+        self.timeout_rate = timeout_rate  # доля запросов, на которые стенд молчит hang секунд
+        self.hang = hang
+
+    def update(self, **values):
+        for name, value in values.items():
+            if name not in self.FIELDS:
+                raise ValueError(f"Неизвестный параметр сбоя: {name}")
+            setattr(self, name, int(value) if name == 'error_status' else float(value))
+        return self
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.FIELDS}
+
+
+class FixtureStore:
+    """Записанные ответы из каталога fixtures"""
+
+    def __init__(self, root=FIXTURES_DIR):
+        self.root = root
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def _read(self, *parts):
+        path = os.path.join(self.root, *parts)
+        with self._lock:
+            if path not in self._cache:
+                with open(path, 'rb') as f:
+                    self._cache[path] = f.read()
+            return self._cache[path]
+
+    def _pick(self, kind, item_id, ext):
+        names = sorted(n for n in os.listdir(os.path.join(self.root, kind)) if n.endswith(ext))
+        if not names:
+            raise FileNotFoundError(f"Нет записей в fixtures/{kind}")
+        exact = f"{item_id}{ext}"
+        if exact in names:
+            return exact, True
+        index = int(item_id) % len(names) if str(item_id).isdigit() else 0
+        return names[index], False
+
+    def tmapi(self, item_id):
+        name, exact = self._pick('tmapi', item_id, '.json')
+        body = self._read('tmapi', name)
+        if exact:
+            return body
+        data = json.loads(body)
+        data['data']['item_id'] = int(item_id)
+        return json.dumps(data, ensure_ascii=False).encode('utf-8')
+
+    def weidian(self, item_id):
+        name, _ = self._pick('weidian', item_id, '.html')
+        return self._read('weidian', name)
+
+    def cbr(self):
+        return self._read('cbr', 'daily_json.js')
+
+    def translations(self):
+        try:
+            return json.loads(self._read('translations.json'))
+        except FileNotFoundError:
+            return {}
+
+
+class FixtureServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 256
+
+    def __init__(self, address, store=None, faults=None, seed=None):
+        super().__init__(address, FixtureHandler)
+        self.store = store or FixtureStore()
+        self.faults = {service: Faults() for service in SERVICES}
+        for service, fault in (faults or {}).items():
+            self.faults[service] = fault
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {service: {'requests': 0, 'errors': 0, 'timeouts': 0} for service in SERVICES}
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def decide(self, service):
+        """Возвращает (задержка в секундах, 'error' | 'timeout' | None) для очередного запроса"""
+        fault = self.faults[service]
+        with self.lock:
+            delay = max(fault.latency + self.random.uniform(-fault.jitter, fault.jitter), 0) / 1000
+            roll = self.random.random()
+            self.stats[service]['requests'] += 1
+            if roll < fault.timeout_rate:
+                self.stats[service]['timeouts'] += 1
+                return fault.hang, 'timeout'
+            if roll < fault.timeout_rate + fault.error_rate:
+                self.stats[service]['errors'] += 1
+                return delay, 'error'
+        return delay, None
+
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body=b'', content_type='application/json; charset=utf-8'):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _serve(self, service, produce):
+        delay, outcome = self.server.decide(service)
+        time.sleep(delay)
+        if outcome == 'timeout':
+            # ответа нет — клиент должен отвалиться по своему таймауту чтения
+            self.close_connection = True
+            return
+        if outcome == 'error':
+            self._send(self.server.faults[service].error_status, {'error': 'injected'})
+            return
+        try:
+            self._send(200, *produce())
+        except FileNotFoundError as e:
+            self._send(404, {'error': str(e)})
+
+    def _json_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length) or b'{}')
+
+    def do_GET(self):
+        parsed = urlparse(self.path)
+        params = {k: v[0] for k, v in parse_qs(parsed.query).items()}
+        store = self.server.store
+
+        if parsed.path == '/taobao/item_detail':
+            item_id = params.get('item_id', '')
+            if not item_id.isdigit():
+                return self._send(200, {'code': 422, 'msg': 'item_id is required'})
+            return self._serve('tmapi', lambda: (store.tmapi(item_id),))
+
+        if parsed.path == '/weidian/item.html':
+            item_id = params.get('itemID') or params.get('itemId') or ''
+            return self._serve('weidian', lambda: (store.weidian(item_id), 'text/html; charset=utf-8'))
+
+        if parsed.path == '/cbr/daily_json.js':
+            return self._serve('cbr', lambda: (store.cbr(), 'application/javascript; charset=utf-8'))
+
+        if parsed.path == '/__stats':
+            with self.server.lock:
+                return self._send(200, {
+                    service: {**self.server.stats[service], 'faults': self.server.faults[service].as_dict()}
+                    for service in SERVICES
+                })
+
+        self._send(404, {'error': 'unknown path'})
+
+    def do_POST(self):
+        parsed = urlparse(self.path)
+
+        if parsed.path == '/translate':
+            payload = self._json_body()
+            known = self.server.store.translations()
+
+            def produce():
+                return ({'translations': [known.get(text, text) for text in payload.get('q', [])]},)
+            return self._serve('translate', produce)
+
+        if parsed.path == '/__config':
+            try:
+                for service, values in self._json_body().items():
+                    self.server.faults[service].update(**values)
+            except (KeyError, ValueError, TypeError) as e:
+                return self._send(400, {'error': str(e)})
+            return self._send(200, {s: f.as_dict() for s, f in self.server.faults.items()})
+
+        self._send(404, {'error': 'unknown path'})
+
+
+def start(host='127.0.0.1', port=0, faults=None, seed=None, store=None):
+    """Запускает стенд в фоновом потоке (для бенчмарков и проверок); возвращает сервер"""
+    server = FixtureServer((host, port), store=store, faults=faults, seed=seed)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def parse_fault(spec):
+    """'tmapi:latency=800,error_rate=0.1' -> ('tmapi', {'latency': '800', 'error_rate': '0.1'})"""
+    service, _, options = spec.partition(':')
+    if service not in SERVICES:
+        raise argparse.ArgumentTypeError(f"Неизвестный сервис: {service}")
+    values = dict(item.split('=', 1) for item in options.split(',') if item)
+    return service, values
+
+
+def record(kind, target, root=FIXTURES_DIR):
+    """Сохраняет настоящий ответ сервиса в fixtures"""
+    import http_client
+    from parser import taobao, weidian
+
+    if kind == 'tmapi':
+        response = http_client.get(taobao.TMAPI_ITEM_DETAIL_URL,
+                                   params={'apiToken': os.getenv('API_TOKEN'), 'item_id': target})
+        path = os.path.join(root, 'tmapi', f"{target}.json")
+    elif kind == 'weidian':
+        item_id = weidian.extract_item_id(target)
+        response = http_client.get(target)
+        path = os.path.join(root, 'weidian', f"{item_id}.html")
+    elif kind == 'cbr':
+        from rates import CBR_URL
+        response = http_client.get(CBR_URL)
+        path = os.path.join(root, 'cbr', 'daily_json.js')
+    else:
+        raise ValueError(f"Неизвестный сервис: {kind}")
+
+    response.raise_for_status()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(response.content)
+    print(f"Сохранено {len(response.content)} байт в {path}")
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv and argv[0] == 'record':
+        parser = argparse.ArgumentParser(prog='fixture_server record')
+        parser.add_argument('kind', choices=('tmapi', 'weidian', 'cbr'))
+        parser.add_argument('target', nargs='?', default='')
+        args = parser.parse_args(argv[1:])
+        return record(args.kind, args.target)
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8800)
+    parser.add_argument('--latency', type=float, default=0, help='задержка ответа, мс')
+    parser.add_argument('--jitter', type=float, default=0, help='разброс задержки, мс')
+    parser.add_argument('--error-rate', type=float, default=0, help='доля ответов с ошибкой')
+    parser.add_argument('--error-status', type=int, default=503)
+    parser.add_argument('--timeout-rate', type=float, default=0, help='доля запросов без ответа')
+    parser.add_argument('--hang', type=float, default=60, help='сколько молчать при таймауте, секунд')
+    parser.add_argument('--fault', type=parse_fault, action='append', default=[],
+                        help='настройки одного сервиса, например tmapi:latency=800,error_rate=0.1')
+    parser.add_argument('--seed', type=int, default=None, help='зерно генератора для воспроизводимости')
+    args = parser.parse_args(argv)
+
+    faults = {}
+    for service in SERVICES:
+        faults[service] = Faults(args.latency, args.jitter, args.error_rate, args.error_status,
+                                 args.timeout_rate, args.hang)
+    for service, values in args.fault:
+        faults[service].update(**values)
+
+    server = FixtureServer((args.host, args.port), faults=faults, seed=args.seed)
+    print(f"Стенд запущен на {server.base_url}")
+    for service in SERVICES:
+        print(f"  {service}: {faults[service].as_dict()}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+{
+    "Date": "2026-10-17T11:30:00+03:00",
+    "PreviousDate": "2026-10-16T11:30:00+03:00",
+    "PreviousURL": "//www.cbr-xml-daily.ru/archive/2026/10/16/daily_json.js",
+    "Timestamp": "2026-10-16T20:00:00+03:00",
+    "Valute": {
+        "USD": {
+            "ID": "R01235",
+            "NumCode": "840",
+            "CharCode": "USD",
+            "Nominal": 1,
+            "Name": "Доллар США",
+            "Value": 81.4632,
+            "Previous": 81.2051
+        },
+        "EUR": {
+            "ID": "R01239",
+            "NumCode": "978",
+            "CharCode": "EUR",
+            "Nominal": 1,
+            "Name": "Евро",
+            "Value": 94.871,
+            "Previous": 94.6392
+        },
+        "CNY": {
+            "ID": "R01375",
+            "NumCode": "156",
+            "CharCode": "CNY",
+            "Nominal": 1,
+            "Name": "Китайский юань",
+            "Value": 11.3865,
+            "Previous": 11.3517
+        },
+        "HKD": {
+            "ID": "R01200",
+            "NumCode": "344",
+            "CharCode": "HKD",
+            "Nominal": 10,
+            "Name": "Гонконгских долларов",
+            "Value": 104.782,
+            "Previous": 104.479
+        },
+        "KZT": {
+            "ID": "R01335",
+            "NumCode": "398",
+            "CharCode": "KZT",
+            "Nominal": 100,
+            "Name": "Казахстанских тенге",
+            "Value": 15.1204,
+            "Previous": 15.0821
+        }
+    }
+}
\ No newline at end of file
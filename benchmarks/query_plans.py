@@ -0,0 +1,484 @@
+"""
+Проверка планов горячих запросов на большой базе.
+
+Запуск из корня проекта:
+    python -m benchmarks.query_plans [--scale 1] [--runs 20] [--db /tmp/plans.db] [--plans]
+    python -m benchmarks.query_plans --without-indexes     # как было до набора индексов
+
+База создаётся миграциями (migrations.migrate) и заполняется синтетическими
+данными; при повторном запуске с тем же --db заполнение пропускается. Для
+каждого запроса из HOT_QUERIES печатается медианное время и план; если в плане
+появился полный проход по таблице, которого нет в allow_scan запроса, скрипт
+завершается с кодом 1 — так деградация видна в CI и при ручной проверке.
+"""
+import os
+import sys
+import json
+import time
+import random
+import sqlite3
+import argparse
+import tempfile
+import statistics
+from migrations import (migrate, backfill_shipment_items, backfill_order_photos, backfill_ledger,
+                        backfill_ledger_monthly, INDEXES)
+
+
+# базовые размеры таблиц при --scale 1
+SIZES = {
+    'users': 2000,
+    'products': 20000,
+    'models_per_product': 5,
+    'orders': 200000,
+    'cart_items': 20000,
+    'replenishments': 20000,
+    'withdrawals': 5000,
+    'order_shipments': 20000,
+}
+
+ORDER_STATUSES = ('ordered', 'paid', 'purchased', 'in_warehouse', 'shipped')
+SHIPMENT_STATUSES = ('pending', 'processing', 'shipped', 'delivered')
+
+
+class HotQuery:
+    """Запрос из кода приложения; allow_scan — алиасы таблиц, которые он обходит целиком намеренно"""
+
+    def __init__(self, name, sql, params=(), allow_scan=(), writes=False):
+        self.name = name
+        self.sql = sql
+        self.params = params
+        self.allow_scan = set(allow_scan)
+        self.writes = writes
+
+
+HOT_QUERIES = [
+    HotQuery('get_user(name)', 'SELECT * FROM users WHERE name = ?', ('user{user}',)),
+    HotQuery('get_pending_withdrawals', '''
+        SELECT w.id, w.amount, u.name AS user_name, w.created_at, w.status
+        FROM withdrawals w
+        JOIN users u ON w.user_id = u.id
+        WHERE w.status = 'pending'
+        ORDER BY w.created_at DESC
+    '''),
+    HotQuery('get_user_withdrawals', '''
+        SELECT * FROM withdrawals WHERE user_id = ? ORDER BY created_at DESC
+    ''', ('{user}',)),
+    HotQuery('get_balance_history', '''
+        SELECT id, currency, amount, balance_after, ref_type, ref_id, created_at
+        FROM ledger_entries
+        WHERE user_id = ?
+        ORDER BY created_at DESC, id DESC LIMIT ?
+    ''', ('{user}', 102)),
+    HotQuery('get_balance_history next page', '''
+        SELECT id, currency, amount, balance_after, ref_type, ref_id, created_at
+        FROM ledger_entries
+        WHERE user_id = ? AND (created_at, id) < (?, ?)
+        ORDER BY created_at DESC, id DESC LIMIT ?
+    ''', ('{user}', '2099-01-01 00:00:00', 0, 102)),
+    HotQuery('get_balance_rollups', '''
+        SELECT month, currency, total_in, total_out
+        FROM ledger_monthly
+        WHERE user_id = ? AND month >= (
+            SELECT COALESCE(MIN(month), '') FROM (
+                SELECT DISTINCT month FROM ledger_monthly
+                WHERE user_id = ? ORDER BY month DESC LIMIT ?
+            )
+        )
+        ORDER BY month DESC
+    ''', ('{user}', '{user}', 12)),
+    HotQuery('change_balance', '''
+        UPDATE users SET balance_cny = balance_cny + ?, balance_rub = balance_rub + ?
+        WHERE id = ? RETURNING balance_cny, balance_rub
+    ''', (-1.0, -10.0, '{user}'), writes=True),
+    HotQuery('product by identity', '''
+        SELECT id FROM products WHERE marketplace = ? AND item_id = ?
+    ''', ('taobao', '{item}')),
+    HotQuery('get_product_with_models', '''
+        SELECT * FROM models WHERE product_id = ? ORDER BY color_name, size_name
+    ''', ('{product}',)),
+    HotQuery('add_cart_item lookup', '''
+        SELECT id, quantity FROM cart_items WHERE user_id = ? AND model_id = ?
+    ''', ('{user}', '{model}')),
+    HotQuery('get_cart_items', '''
+        SELECT c.model_id, c.quantity, m.price, m.color_name, m.size_name,
+               m.image_url, p.title AS product_title
+        FROM cart_items c
+        JOIN models m ON c.model_id = m.id
+        JOIN products p ON m.product_id = p.id
+        WHERE c.user_id = ?
+    ''', ('{user}',)),
+    HotQuery('remove_from_cart', '''
+        DELETE FROM cart_items WHERE model_id = ? AND user_id = ?
+    ''', ('{model}', '{user}'), writes=True),
+    HotQuery('clean_old_temporary_models', '''
+        DELETE FROM models
+        WHERE status = 'temporary'
+        AND created_at < DATETIME('now', '-10 minutes')
+    ''', writes=True),
+    HotQuery('get_resync_candidates', '''
+        SELECT p.id AS product_id, MIN(m.product_url) AS url, p.synced_at
+        FROM products p
+        JOIN models m ON m.product_id = p.id
+        WHERE p.id IN (
+            SELECT cm.product_id FROM cart_items c
+            JOIN models cm ON cm.id = c.model_id
+            UNION
+            SELECT om.product_id FROM orders o
+            JOIN models om ON om.id = o.model_id
+            WHERE o.status = 'ordered' AND o.created_at >= DATETIME('now', ?)
+        )
+        AND m.product_url IS NOT NULL AND m.product_url != ''
+        AND (p.synced_at IS NULL OR p.synced_at < DATETIME('now', ?))
+        GROUP BY p.id
+        ORDER BY p.synced_at IS NOT NULL, p.synced_at, p.id
+        LIMIT ?
+    ''', ('-3 days', '-900 seconds', 20), allow_scan={'c'}),
+    HotQuery('profile orders', '''
+        SELECT o.id, o.status, o.quantity, o.total_price, m.color_name, m.size_name, p.title, ph.url
+        FROM orders o
+        JOIN models m ON o.model_id = m.id
+        JOIN products p ON m.product_id = p.id
+        LEFT JOIN order_photos ph ON ph.order_id = o.id
+        WHERE o.user_id = ?
+        ORDER BY o.created_at DESC, o.id, o.model_id, ph.position
+    ''', ('{user}',)),
+    HotQuery('add_order_photos position', '''
+        SELECT COALESCE(MAX(position), -1) + 1 FROM order_photos WHERE order_id = ?
+    ''', ('{order}',)),
+    HotQuery('remove_order_photos', '''
+        DELETE FROM order_photos WHERE order_id = ? AND url IN (?)
+    ''', ('{order}', 'https://photos.example/{order}/0.jpg'), writes=True),
+    HotQuery('user order ids', 'SELECT id FROM orders WHERE user_id = ?', ('{user}',)),
+    HotQuery('order tracking unique', '''
+        SELECT COUNT(*) AS cnt FROM orders WHERE our_tracking_number = ?
+    ''', ('TRK{order}',)),
+    HotQuery('shipment tracking unique', '''
+        SELECT COUNT(*) AS cnt FROM order_shipments WHERE our_tracking_number = ?
+    ''', ('SHP{shipment}',)),
+    HotQuery('get_shipments_with_photos', '''
+        SELECT id, model_ids, recipient_city, status, created_at, total_weight, packaging_paid
+        FROM order_shipments
+        WHERE user_id = ?
+        ORDER BY datetime(created_at) DESC
+    ''', ('{user}',)),
+    HotQuery('get_shipments_with_photos items', '''
+        SELECT si.shipment_id, si.order_id, m.image_url
+        FROM order_shipments s
+        JOIN shipment_items si ON si.shipment_id = s.id
+        LEFT JOIN orders o ON o.id = si.order_id
+        LEFT JOIN models m ON m.id = o.model_id
+        WHERE s.user_id = ?
+        ORDER BY si.shipment_id, si.position
+    ''', ('{user}',)),
+    HotQuery('shipment of order', '''
+        SELECT shipment_id FROM shipment_items WHERE order_id = ?
+    ''', ('{order}',)),
+    # страницы разделов админки (base.admin_page_query): LIMIT 51 по индексу с
+    # created_at; первая страница без фильтров идёт обходом индекса по убыванию
+    # даты и останавливается на лимите — это не полный проход
+    HotQuery('admin replenishments', '''
+        SELECT r.id, r.user_id, r.amount_rub, r.status, r.created_at, u.name AS user_name
+        FROM replenishments r
+        JOIN users u ON r.user_id = u.id
+        WHERE r.status = ?
+        ORDER BY r.created_at DESC, r.id DESC LIMIT ?
+    ''', ('pending', 51)),
+    HotQuery('admin replenishments next page', '''
+        SELECT r.id, r.user_id, r.amount_rub, r.status, r.created_at, u.name AS user_name
+        FROM replenishments r
+        JOIN users u ON r.user_id = u.id
+        WHERE r.status = ? AND (r.created_at, r.id) < (?, ?)
+        ORDER BY r.created_at DESC, r.id DESC LIMIT ?
+    ''', ('pending', '2099-01-01 00:00:00', 0, 51)),
+    HotQuery('admin replenishments by user', '''
+        SELECT r.id, r.user_id, r.amount_rub, r.status, r.created_at, u.name AS user_name
+        FROM replenishments r
+        JOIN users u ON r.user_id = u.id
+        WHERE r.user_id = (SELECT id FROM users WHERE name = ?)
+        ORDER BY r.created_at DESC, r.id DESC LIMIT ?
+    ''', ('user{user}', 51)),
+    HotQuery('admin withdrawals', '''
+        SELECT w.id, w.amount, u.name AS user_name, w.created_at, w.status
+        FROM withdrawals w
+        JOIN users u ON w.user_id = u.id
+        WHERE w.status = ? AND w.created_at >= ? AND w.created_at < date(?, '+1 day')
+        ORDER BY w.created_at DESC, w.id DESC LIMIT ?
+    ''', ('pending', '2000-01-01', '2099-01-01', 51)),
+    HotQuery('admin orders', '''
+        SELECT orders.id, users.name, products.title, orders.status, orders.created_at
+        FROM orders
+        JOIN users ON orders.user_id = users.id
+        JOIN models ON orders.model_id = models.id
+        JOIN products ON models.product_id = products.id
+        ORDER BY orders.created_at DESC, orders.id DESC LIMIT ?
+    ''', (51,), allow_scan={'orders'}),
+    HotQuery('admin orders next page', '''
+        SELECT orders.id, users.name, products.title, orders.status, orders.created_at
+        FROM orders
+        JOIN users ON orders.user_id = users.id
+        JOIN models ON orders.model_id = models.id
+        JOIN products ON models.product_id = products.id
+        WHERE (orders.created_at, orders.id) < (?, ?)
+        ORDER BY orders.created_at DESC, orders.id DESC LIMIT ?
+    ''', ('2099-01-01 00:00:00', 0, 51)),
+    HotQuery('admin orders by status', '''
+        SELECT orders.id, orders.status, orders.created_at
+        FROM orders
+        WHERE orders.status = ? AND orders.created_at >= ?
+        ORDER BY orders.created_at DESC, orders.id DESC LIMIT ?
+    ''', ('in_warehouse', '2000-01-01', 51)),
+    HotQuery('admin orders by user', '''
+        SELECT orders.id, orders.status, orders.created_at
+        FROM orders
+        WHERE orders.user_id = ?
+        ORDER BY orders.created_at DESC, orders.id DESC LIMIT ?
+    ''', ('{user}', 51)),
+    HotQuery('admin orders by tracking', '''
+        SELECT orders.id, orders.status, orders.created_at
+        FROM orders
+        WHERE orders.id IN (
+            SELECT id FROM orders WHERE our_tracking_number = ?
+            UNION ALL
+            SELECT id FROM orders WHERE china_tracking_number = ?
+        )
+        ORDER BY orders.created_at DESC, orders.id DESC LIMIT ?
+    ''', ('TRK{order}', 'TRK{order}', 51)),
+    HotQuery('admin orders photos', '''
+        SELECT order_id, url FROM order_photos
+        WHERE order_id IN (?, ?, ?)
+        ORDER BY order_id, position
+    ''', ('{order}', '{order}', '{order}')),
+    HotQuery('admin shipments', '''
+        SELECT s.id, s.status, s.created_at FROM order_shipments s
+        ORDER BY s.created_at DESC, s.id DESC LIMIT ?
+    ''', (51,), allow_scan={'s'}),
+    # раздел посылок по умолчанию: рабочие статусы — почти все строки, поэтому
+    # тот же обход индекса created_at до лимита, что и без фильтра
+    HotQuery('admin shipments working', '''
+        SELECT s.id, s.status, s.created_at FROM order_shipments s
+        WHERE s.status IN (?, ?, ?, ?)
+        ORDER BY s.created_at DESC, s.id DESC LIMIT ?
+    ''', (*SHIPMENT_STATUSES, 51), allow_scan={'s'}),
+    HotQuery('admin shipments by status', '''
+        SELECT s.id, s.status, s.created_at FROM order_shipments s
+        WHERE s.status = ? AND (s.created_at, s.id) < (?, ?)
+        ORDER BY s.created_at DESC, s.id DESC LIMIT ?
+    ''', ('processing', '2099-01-01 00:00:00', 0, 51)),
+    HotQuery('admin shipments by tracking', '''
+        SELECT s.id, s.status, s.created_at FROM order_shipments s
+        WHERE (s.our_tracking_number = ? OR s.id IN (
+            SELECT si.shipment_id FROM shipment_items si
+            WHERE si.order_id IN (
+                SELECT id FROM orders WHERE our_tracking_number = ?
+                UNION ALL
+                SELECT id FROM orders WHERE china_tracking_number = ?
+            )
+        ))
+        ORDER BY s.created_at DESC, s.id DESC LIMIT ?
+    ''', ('SHP{shipment}', 'TRK{order}', 'TRK{order}', 51)),
+    HotQuery('admin shipment items', '''
+        SELECT si.shipment_id, si.order_id, o.id, m.id, p.title, u.name
+        FROM order_shipments s
+        JOIN shipment_items si ON si.shipment_id = s.id
+        LEFT JOIN orders o ON o.id = si.order_id
+        LEFT JOIN models m ON o.model_id = m.id
+        LEFT JOIN products p ON m.product_id = p.id
+        LEFT JOIN users u ON o.user_id = u.id
+        WHERE si.shipment_id IN (?, ?, ?)
+        ORDER BY si.shipment_id, si.position
+    ''', ('{shipment}', '{shipment}', '{shipment}')),
+]
+
+
+def _ts(rnd, days=180):
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(time.time() - rnd.uniform(0, days * 86400)))
+
+
+def seed(conn, scale=1.0, seed_value=42):
+    """Заполняет пустую базу синтетическими данными"""
+    rnd = random.Random(seed_value)
+    n = {name: max(int(size * scale), 1) for name, size in SIZES.items()}
+    n['models_per_product'] = SIZES['models_per_product']
+    n_models = n['products'] * n['models_per_product']
+
+    with conn:
+        conn.executemany(
+            'INSERT INTO users (id, name, password, region, created_at) VALUES (?, ?, ?, ?, ?)',
+            ((i, f'user{i}', 'x', 'RU', _ts(rnd, 720)) for i in range(1, n['users'] + 1))
+        )
+        conn.executemany(
+            'INSERT INTO products (id, title, base_price, marketplace, item_id, canonical_url, synced_at)'
+            ' VALUES (?, ?, ?, ?, ?, ?, ?)',
+            ((i, f'Товар {i}', 100.0, 'taobao', str(600000000000 + i),
+              f'https://item.taobao.com/item.htm?id={600000000000 + i}',
+              _ts(rnd, 2) if rnd.random() < 0.5 else None)
+             for i in range(1, n['products'] + 1))
+        )
+        conn.executemany(
+            'INSERT INTO models (id, product_id, product_url, sku_id, color_name, size_name, price, stock,'
+            ' image_url, status, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            ((i, (i - 1) // n['models_per_product'] + 1,
+              f'https://item.taobao.com/item.htm?id={600000000000 + (i - 1) // n["models_per_product"] + 1}',
+              str(5000000 + i), f'Цвет {i % 7}', f'{36 + i % 8}', 100.0 + i % 50, rnd.randint(0, 50),
+              f'https://img.alicdn.com/{i}.jpg', 'temporary' if rnd.random() < 0.02 else 'Принято',
+              _ts(rnd)) for i in range(1, n_models + 1))
+        )
+        conn.executemany(
+            'INSERT INTO orders (id, user_id, model_id, quantity, status, total_price, our_tracking_number,'
+            ' cn_delivery_price, cn_delivery_paid, weight, photos, created_at)'
+            ' VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            ((i, rnd.randint(1, n['users']), rnd.randint(1, n_models), rnd.randint(1, 3),
+              rnd.choice(ORDER_STATUSES), rnd.uniform(10, 500), f'TRK{i}',
+              rnd.choice((None, 15.0)), rnd.randint(0, 1), rnd.uniform(0.1, 2),
+              json.dumps([f'https://photos.example/{i}/{k}.jpg' for k in range(rnd.choice((0, 0, 3)))]),
+              _ts(rnd))
+             for i in range(1, n['orders'] + 1))
+        )
+        # фото проверки — тем же переносом из orders.photos, что и у старых баз
+        backfill_order_photos(conn.cursor())
+        conn.executemany(
+            'INSERT INTO cart_items (user_id, model_id, quantity, added_at) VALUES (?, ?, ?, ?)',
+            ((rnd.randint(1, n['users']), rnd.randint(1, n_models), 1, _ts(rnd, 30))
+             for _ in range(n['cart_items']))
+        )
+        conn.executemany(
+            'INSERT INTO replenishments (user_id, amount_rub, amount_cny, payment_date, receipt_path, status,'
+            ' created_at) VALUES (?, ?, ?, ?, ?, ?, ?)',
+            ((rnd.randint(1, n['users']), 1000.0, 80.0, '2024-01-01', 'receipt.png',
+              'pending' if rnd.random() < 0.05 else 'approved', _ts(rnd))
+             for _ in range(n['replenishments']))
+        )
+        conn.executemany(
+            'INSERT INTO withdrawals (user_id, amount, card_number, card_holder, status, created_at)'
+            ' VALUES (?, ?, ?, ?, ?, ?)',
+            ((rnd.randint(1, n['users']), 500.0, '0000', 'HOLDER',
+              'pending' if rnd.random() < 0.05 else 'approved', _ts(rnd))
+             for _ in range(n['withdrawals']))
+        )
+        conn.executemany(
+            'INSERT INTO order_shipments (id, user_id, model_ids, delivery_method, packaging_options,'
+            ' recipient_name, recipient_phone, recipient_city, recipient_address, total_weight, delivery_cost,'
+            ' our_tracking_number, packaging_cost, total_cost, status, created_at)'
+            ' VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            ((i, rnd.randint(1, n['users']), ','.join(str(rnd.randint(1, n['orders'])) for _ in range(3)),
+              'air_fast', '', 'Имя', '+7', 'Москва', 'ул. Ленина, 1', 1.5, 60.0, f'SHP{i}', 0.0, 60.0,
+              rnd.choice(SHIPMENT_STATUSES), _ts(rnd)) for i in range(1, n['order_shipments'] + 1))
+        )
+        # состав посылок — тем же переносом, что и у старых баз
+        backfill_shipment_items(conn.cursor())
+        conn.executemany(
+            'INSERT OR IGNORE INTO fx_rates (currency, rate_date, rate) VALUES (?, ?, ?)',
+            ((currency, time.strftime('%Y-%m-%d', time.gmtime(time.time() - d * 86400)), 12.5)
+             for currency in ('CNY', 'USD', 'EUR') for d in range(365))
+        )
+        # журнал баланса — тем же восстановлением по движениям денег, что и у старых баз
+        backfill_ledger(conn.cursor())
+        backfill_ledger_monthly(conn.cursor())
+        conn.execute('ANALYZE')
+    return n
+
+
+def full_scans(conn, query, params):
+    """Алиасы таблиц, которые план обходит целиком, и строки плана"""
+    rows = conn.execute(f'EXPLAIN QUERY PLAN {query.sql}', params).fetchall()
+    detail = [row[3] for row in rows]
+    scans = set()
+    for line in detail:
+        # SCAN (subquery-N) — проход по уже отобранным строкам подзапроса, не по таблице
+        if line.startswith('SCAN ') and not line.startswith(('SCAN CONSTANT ROW', 'SCAN (')):
+            scans.add(line.split()[1])
+    return scans, detail
+
+
+def time_query(conn, query, params, runs):
+    samples = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        if query.writes:
+            conn.execute('SAVEPOINT plan_check')
+            conn.execute(query.sql, params)
+            conn.execute('ROLLBACK TO plan_check')
+            conn.execute('RELEASE plan_check')
+        else:
+            conn.execute(query.sql, params).fetchall()
+        samples.append((time.perf_counter() - started) * 1000)
+    return statistics.median(samples)
+
+
+def bind(params, values):
+    """'{user}' -> значение как есть, 'TRK{order}' -> строка по шаблону"""
+    out = []
+    for p in params:
+        if isinstance(p, str) and p.startswith('{') and p.endswith('}'):
+            out.append(values[p[1:-1]])
+        elif isinstance(p, str) and '{' in p:
+            out.append(p.format(**values))
+        else:
+            out.append(p)
+    return tuple(out)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db', default=os.path.join(tempfile.gettempdir(), 'query_plans.db'),
+                        help='файл базы для проверки (создаётся и заполняется при отсутствии)')
+    parser.add_argument('--scale', type=float, default=1.0, help='множитель размеров таблиц')
+    parser.add_argument('--runs', type=int, default=20, help='повторов на запрос для медианы')
+    parser.add_argument('--plans', action='store_true', help='печатать планы всех запросов')
+    parser.add_argument('--without-indexes', action='store_true',
+                        help='удалить индексы из INDEXES перед проверкой (для сравнения)')
+    args = parser.parse_args(argv)
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.db)), exist_ok=True)
+    fresh = not os.path.exists(args.db)
+    conn = sqlite3.connect(args.db, isolation_level=None)
+    conn.execute('BEGIN IMMEDIATE')
+    migrate(conn.cursor())
+    conn.execute('COMMIT')
+    if fresh:
+        # заполнение — одна большая транзакция, надёжность записи здесь не нужна
+        conn.execute('PRAGMA synchronous = OFF')
+        conn.execute('PRAGMA cache_size = -262144')
+        started = time.perf_counter()
+        n = seed(conn, args.scale)
+        print(f"База заполнена за {time.perf_counter() - started:.1f} с: {n}")
+    if args.without_indexes:
+        for name in INDEXES:
+            conn.execute(f'DROP INDEX IF EXISTS {name}')
+        conn.execute('ANALYZE')
+
+    users = conn.execute('SELECT COUNT(*) FROM users').fetchone()[0]
+    values = {
+        'user': users // 2 or 1,
+        'product': conn.execute('SELECT MAX(id) FROM products').fetchone()[0] // 2 or 1,
+        'model': conn.execute('SELECT MAX(id) FROM models').fetchone()[0] // 2 or 1,
+        'order': conn.execute('SELECT MAX(id) FROM orders').fetchone()[0] // 2 or 1,
+        'shipment': conn.execute('SELECT MAX(id) FROM order_shipments').fetchone()[0] // 2 or 1,
+        'item': str(600000000000 + (conn.execute('SELECT COUNT(*) FROM products').fetchone()[0] // 2 or 1)),
+    }
+
+    failed = []
+    print(f"{'запрос':<32} {'мс':>9}  план")
+    for query in HOT_QUERIES:
+        params = bind(query.params, values)
+        scans, detail = full_scans(conn, query, params)
+        unexpected = scans - query.allow_scan
+        elapsed = time_query(conn, query, params, args.runs)
+        status = f"ПОЛНЫЙ ПРОХОД: {', '.join(sorted(unexpected))}" if unexpected else 'ok'
+        print(f"{query.name:<32} {elapsed:>9.2f}  {status}")
+        if args.plans or unexpected:
+            for line in detail:
+                print(f"{'':<44}{line}")
+        if unexpected:
+            failed.append(query.name)
+
+    if args.without_indexes:
+        print("Индексы удалены; при следующем запуске migrate() создаст их заново")
+    if failed:
+        print(f"Деградировали до полного прохода: {', '.join(failed)}")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,446 @@
+import os
+import json
+import time
+import logging
+import sqlite3
+import uuid
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from urllib.parse import urlparse
+from parser import taobao, weidian
+from parser.taobao import parse_taobao_product
+from parser.weidian import parse_weidian_product
+from parser.aio import fetch_products, AIO_CONCURRENCY
+
+
+PARSE_CACHE_TTL = int(os.getenv("PARSE_CACHE_TTL", 3600))                   # удачный разбор, секунды
+PARSE_CACHE_NEGATIVE_TTL = int(os.getenv("PARSE_CACHE_NEGATIVE_TTL", 300))  # ссылки, которые не разобрались
+PARSE_CACHE_SIZE = int(os.getenv("PARSE_CACHE_SIZE", 512))                  # записей в памяти процесса
+PARSE_CACHE_PATH = os.getenv("PARSE_CACHE_PATH", os.path.join('instance', 'parse_cache.db'))
+BULK_IMPORT_MAX = int(os.getenv("BULK_IMPORT_MAX", 200))                    # ссылок в одном импорте
+BULK_IMPORT_BATCH = int(os.getenv("BULK_IMPORT_BATCH", 50))                 # товаров в одной транзакции
+RESYNC_INTERVAL = int(os.getenv("RESYNC_INTERVAL", 900))                    # пауза между сверками, секунды
+RESYNC_BUDGET = int(os.getenv("RESYNC_BUDGET", 20))                         # товаров (запросов к tmapi) за прогон
+RESYNC_ORDER_DAYS = int(os.getenv("RESYNC_ORDER_DAYS", 3))                  # насколько свежие заказы сверять
+IMPORT_LEASE_TTL = int(os.getenv("IMPORT_LEASE_TTL", 60))                   # аренда импорта, если воркер упал
+# сколько ждать чужой импорт; не меньше аренды, чтобы брошенная аренда успела истечь
+IMPORT_WAIT_TIMEOUT = max(int(os.getenv("IMPORT_WAIT_TIMEOUT", IMPORT_LEASE_TTL + 15)), IMPORT_LEASE_TTL)
+IMPORT_COALESCE_WINDOW = int(os.getenv("IMPORT_COALESCE_WINDOW", 60))       # отдаём готовый product_id повторам
+IMPORT_POLL_INTERVAL = 0.2
+
+logger = logging.getLogger(__name__)
+
+
+class ParseCache:
+    """
+    Двухуровневый кэш результатов парсинга товаров.
+
+    Первый уровень — LRU в памяти процесса, второй — SQLite-файл, общий для
+    всех воркеров и переживающий перезапуск. Ошибки разбора тоже кэшируются
+    (на более короткий срок), чтобы битые ссылки не тратили квоту tmapi.
+    """
+
+    def __init__(self, path=PARSE_CACHE_PATH, ttl=PARSE_CACHE_TTL,
+                 negative_ttl=PARSE_CACHE_NEGATIVE_TTL, max_size=PARSE_CACHE_SIZE):
+        self.path = path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS parse_cache (
+                    cache_key TEXT PRIMARY KEY,
+                    payload TEXT,
+                    error TEXT,
+                    expires_at REAL NOT NULL
+                )
+            ''')
+            self._local.conn = conn
+        return conn
+
+    def _remember(self, key, entry):
+        with self._lock:
+            self._memory[key] = entry
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_size:
+                self._memory.popitem(last=False)
+
+    def get(self, key):
+        """
+        Возвращает (payload, error) или None при промахе.
+        payload — dict товара, error — текст ошибки для негативной записи.
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._memory.move_to_end(key)
+                else:
+                    del self._memory[key]
+                    entry = None
+
+        if entry is None:
+            row = self._connection().execute(
+                'SELECT expires_at, payload, error FROM parse_cache WHERE cache_key = ?',
+                (key,)
+            ).fetchone()
+            if not row or row[0] <= now:
+                return None
+            entry = row
+            self._remember(key, entry)
+
+        expires_at, payload, error = entry
+        return (json.loads(payload) if payload else None), error
+
+    def _store(self, key, payload, error, ttl):
+        entry = (time.time() + ttl, payload, error)
+        self._remember(key, entry)
+        conn = self._connection()
+        with conn:
+            conn.execute('''
+                INSERT OR REPLACE INTO parse_cache (cache_key, expires_at, payload, error)
+                VALUES (?, ?, ?, ?)
+            ''', (key, *entry))
+
+    def set(self, key, product):
+        self._store(key, json.dumps(product, ensure_ascii=False), None, self.ttl)
+
+    def set_error(self, key, message):
+        self._store(key, None, message, self.negative_ttl)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._memory.pop(key, None)
+        conn = self._connection()
+        with conn:
+            conn.execute('DELETE FROM parse_cache WHERE cache_key = ?', (key,))
+
+    def purge_expired(self):
+        conn = self._connection()
+        with conn:
+            return conn.execute('DELETE FROM parse_cache WHERE expires_at <= ?', (time.time(),)).rowcount
+
+
+parse_cache = ParseCache()
+
+
+# маркетплейс -> модуль парсера (HOSTS, extract_item_id, canonical_url)
+MARKETPLACES = {
+    'taobao': taobao,
+    'weidian': weidian,
+}
+
+
+def detect_marketplace(url):
+    """'taobao', 'weidian' или None для неподдерживаемых сайтов (по имени хоста)"""
+    url = (url or '').strip()
+    host = (urlparse(url if '://' in url else 'https://' + url).hostname or '').lower()
+    for marketplace, module in MARKETPLACES.items():
+        if any(host == h or host.endswith('.' + h) for h in module.HOSTS):
+            return marketplace
+    return None
+
+
+def canonicalize(url):
+    """
+    Каноническая идентичность товара по ссылке:
+    {'marketplace', 'item_id', 'canonical_url'} или None, если сайт не поддерживается
+    или id товара из ссылки не извлекается.
+    """
+    marketplace = detect_marketplace(url)
+    if marketplace is None:
+        return None
+    module = MARKETPLACES[marketplace]
+    item_id = module.extract_item_id(url.strip())
+    if not item_id:
+        return None
+    return {
+        'marketplace': marketplace,
+        'item_id': item_id,
+        'canonical_url': module.canonical_url(item_id),
+    }
+
+
+def get_item_key(url):
+    """Ключ кэша вида 'taobao:123456' или None, если id из ссылки не извлекается"""
+    identity = canonicalize(url)
+    return f"{identity['marketplace']}:{identity['item_id']}" if identity else None
+
+
+def _parse_uncached(url):
+    marketplace = detect_marketplace(url)
+    if marketplace == 'taobao':
+        return parse_taobao_product(os.getenv("API_TOKEN"), url)
+    if marketplace == 'weidian':
+        return parse_weidian_product(url)
+    raise ValueError("Неподдерживаемый сайт")
+
+
+def parse_product(url, use_cache=True):
+    """Разбирает ссылку на товар, используя кэш по маркетплейсу и id товара"""
+    key = get_item_key(url) if use_cache else None
+    if key is None:
+        return _parse_uncached(url)
+
+    cached = parse_cache.get(key)
+    if cached is not None:
+        product, error = cached
+        if error:
+            raise Exception(error)
+        return product
+
+    try:
+        product = _parse_uncached(url)
+    except OSError:
+        # сетевые ошибки (requests.RequestException) и сбои сервиса
+        # (http_client.UpstreamError) временные — не кэшируем
+        raise
+    except Exception as e:
+        parse_cache.set_error(key, str(e))
+        raise
+
+    parse_cache.set(key, product)
+    return product
+
+
+def parse_products(urls, use_cache=True, concurrency=AIO_CONCURRENCY):
+    """
+    Разбирает список ссылок: попадания берутся из кэша, остальные
+    загружаются параллельно асинхронным движком.
+    Возвращает список {'url', 'product', 'error', 'elapsed_ms', 'cached'} в порядке urls.
+    """
+    results = [None] * len(urls)
+    to_fetch = []
+    for i, url in enumerate(urls):
+        marketplace = detect_marketplace(url)
+        key = get_item_key(url) if use_cache else None
+        cached = parse_cache.get(key) if key else None
+        if marketplace is None:
+            results[i] = {'url': url, 'product': None, 'error': ValueError("Неподдерживаемый сайт"),
+                          'elapsed_ms': 0.0, 'cached': False}
+        elif cached is not None:
+            product, error = cached
+            results[i] = {'url': url, 'product': product, 'error': Exception(error) if error else None,
+                          'elapsed_ms': 0.0, 'cached': True}
+        else:
+            to_fetch.append((i, key, marketplace, url))
+
+    if to_fetch:
+        fetched = fetch_products(
+            [(marketplace, url) for _, _, marketplace, url in to_fetch],
+            api_token=os.getenv("API_TOKEN"),
+            concurrency=concurrency,
+        )
+        for (i, key, _, _), result in zip(to_fetch, fetched):
+            result['cached'] = False
+            results[i] = result
+            if key is None:
+                continue
+            if result['error'] is None:
+                parse_cache.set(key, result['product'])
+            elif not isinstance(result['error'], OSError):
+                # OSError — сеть и http_client.UpstreamError (5xx, 429, обрыв): временное, не кэшируем
+                parse_cache.set_error(key, str(result['error']))
+
+    return results
+
+
+# ---- импорт одного товара с объединением одновременных запросов ----
+
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+
+def _import_with_lease(db, key, url):
+    """Импорт под межпроцессной арендой: товар загружает и вставляет только один воркер"""
+    owner = uuid.uuid4().hex
+    while True:
+        state, product_id = db.acquire_import_lease(key, owner, IMPORT_LEASE_TTL)
+        if state == 'done':
+            return product_id
+        if state == 'acquired':
+            break
+        # импорт идёт в другом воркере — ждём его результата; чужая аренда истекает
+        # раньше deadline, и тогда снова пытаемся её захватить
+        deadline = time.time() + IMPORT_WAIT_TIMEOUT
+        while True:
+            time.sleep(IMPORT_POLL_INTERVAL)
+            lease = db.get_import_lease(key)
+            if lease is None:
+                break
+            if lease['product_id'] is not None:
+                return lease['product_id']
+            if time.time() >= deadline:
+                raise TimeoutError(f"Импорт товара {key} в другом воркере не завершился")
+
+    try:
+        product_id = db.add_product(parse_product(url), url, canonicalize(url))
+    except Exception:
+        db.release_import_lease(key, owner)
+        raise
+    db.complete_import_lease(key, owner, product_id, IMPORT_COALESCE_WINDOW)
+    return product_id
+
+
+def import_product(db, url):
+    """
+    Загружает и сохраняет товар, возвращает product_id.
+
+    Одновременные импорты одного товара (одинаковые маркетплейс и id) объединяются:
+    в процессе — через общий Future, между воркерами — через таблицу import_leases.
+    Загрузку и вставку выполняет первый запрос, остальные получают тот же product_id.
+    """
+    key = get_item_key(url)
+    if key is None:
+        return db.add_product(parse_product(url), url)
+
+    with _inflight_lock:
+        future = _inflight.get(key)
+        leader = future is None
+        if leader:
+            future = Future()
+            _inflight[key] = future
+
+    if not leader:
+        try:
+            return future.result(timeout=IMPORT_WAIT_TIMEOUT)
+        except FutureTimeoutError:
+            # лидер ещё занят (сам ждёт чужой аренды) — дальше ждём через аренду:
+            # она отдаст готовый product_id, а не второй импорт
+            return _import_with_lease(db, key, url)
+
+    try:
+        product_id = _import_with_lease(db, key, url)
+        future.set_result(product_id)
+        return product_id
+    except Exception as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _inflight_lock:
+            _inflight.pop(key, None)
+
+
+def bulk_import(db, urls, concurrency=AIO_CONCURRENCY):
+    """
+    Массовый импорт товаров по списку ссылок.
+
+    Ссылки с одинаковым маркетплейсом и id товара загружаются один раз,
+    загрузка идёт параллельно, вставка — пачками по BULK_IMPORT_BATCH товаров
+    в одной транзакции. Возвращает отчёт по каждой входной ссылке:
+    {'url', 'status': imported|duplicate|error, 'product_id', 'error', 'elapsed_ms', 'cached'}.
+    """
+    urls = [u.strip() for u in urls if u and u.strip()]
+    if len(urls) > BULK_IMPORT_MAX:
+        raise ValueError(f"Слишком много ссылок: {len(urls)}, максимум {BULK_IMPORT_MAX}")
+
+    # дедупликация по маркетплейсу и id товара (если id не извлекается — по самой ссылке)
+    first_index = {}
+    unique_urls = []
+    for i, url in enumerate(urls):
+        key = get_item_key(url) or url
+        if key not in first_index:
+            first_index[key] = i
+            unique_urls.append(url)
+
+    parsed = {r['url']: r for r in parse_products(unique_urls, concurrency=concurrency)}
+
+    ok = [parsed[url] for url in unique_urls if parsed[url]['error'] is None]
+    for start in range(0, len(ok), BULK_IMPORT_BATCH):
+        batch = ok[start:start + BULK_IMPORT_BATCH]
+        started = time.perf_counter()
+        try:
+            product_ids = db.add_products_bulk([(r['product'], r['url'], canonicalize(r['url'])) for r in batch])
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении пачки товаров: {e}")
+            for r in batch:
+                r['error'] = e
+            continue
+        insert_ms = (time.perf_counter() - started) * 1000 / len(batch)
+        for r, product_id in zip(batch, product_ids):
+            r['product_id'] = product_id
+            r['elapsed_ms'] = round(r['elapsed_ms'] + insert_ms, 1)
+
+    report = []
+    for i, url in enumerate(urls):
+        first = first_index[get_item_key(url) or url]
+        r = parsed[urls[first]]
+        if r['error'] is not None:
+            status = 'error'
+        elif i == first:
+            status = 'imported'
+        else:
+            status = 'duplicate'
+        report.append({
+            'url': url,
+            'status': status,
+            'product_id': r.get('product_id'),
+            'error': str(r['error']) if r['error'] is not None else None,
+            'elapsed_ms': r['elapsed_ms'] if i == first else 0.0,
+            'cached': r.get('cached', False),
+        })
+    return report
+
+
+def _model_key(model):
+    if model.get('sku_id'):
+        return ('sku', str(model['sku_id']))
+    return ('name', model.get('color_name') or '', model.get('size_name') or '')
+
+
+def resync_products(db, budget=RESYNC_BUDGET, concurrency=AIO_CONCURRENCY):
+    """
+    Сверяет цены и остатки товаров из корзин и свежих заказов с маркетплейсом.
+
+    За прогон загружается не больше budget товаров, самые давно сверявшиеся —
+    первыми. Модели сопоставляются по sku_id (старые строки без него — по цвету
+    и размеру), в базу пишутся только изменившиеся строки.
+    Возвращает {'checked', 'changed_models', 'errors'}.
+    """
+    candidates = db.get_resync_candidates(budget, RESYNC_ORDER_DAYS, RESYNC_INTERVAL)
+    if not candidates:
+        return {'checked': 0, 'changed_models': 0, 'errors': 0}
+
+    results = parse_products([c['url'] for c in candidates], use_cache=False, concurrency=concurrency)
+    stored = db.get_models_by_product_ids([c['product_id'] for c in candidates])
+
+    updates = []
+    errors = 0
+    for candidate, result in zip(candidates, results):
+        if result['error'] is not None:
+            # товар всё равно помечается сверенным, чтобы битые ссылки не съедали бюджет
+            errors += 1
+            logger.warning(f"Сверка товара {candidate['product_id']} не удалась: {result['error']}")
+            continue
+
+        product = result['product']
+        key = get_item_key(candidate['url'])
+        if key:
+            parse_cache.set(key, product)
+
+        fresh = {_model_key(m): m for m in product['models']}
+        # строки, сохранённые до появления sku_id, ищем по цвету и размеру
+        fresh.update({_model_key({**m, 'sku_id': None}): m for m in product['models']})
+        for model in stored.get(candidate['product_id'], []):
+            upstream = fresh.get(_model_key(model))
+            if upstream is None:
+                continue
+            price = float(upstream.get('price', model['price']) or 0)
+            stock = int(upstream.get('stock', model['stock']) or 0)
+            if price != model['price'] or stock != model['stock']:
+                updates.append((price, stock, model['id']))
+
+    db.apply_resync(updates, [c['product_id'] for c in candidates])
+    report = {'checked': len(candidates), 'changed_models': len(updates), 'errors': errors}
+    logger.info(f"Сверка товаров: {report}")
+    return report
@@ -0,0 +1,141 @@
+import os
+import time
+import random
+import logging
+import threading
+from urllib.parse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+
+
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", 3.05))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", 15))
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", 2))            # повторов сверх первой попытки
+HTTP_BACKOFF = float(os.getenv("HTTP_BACKOFF", 0.3))        # базовая пауза между повторами, секунды
+HTTP_POOL_HOSTS = int(os.getenv("HTTP_POOL_HOSTS", 16))     # сколько хостов держать в пуле
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", 10))       # keep-alive соединений на хост
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'OPTIONS'}
+
+logger = logging.getLogger(__name__)
+
+
+class UpstreamError(OSError):
+    """
+    Временный сбой внешнего сервиса: 5xx, 429, исчерпанная квота, обрыв
+    соединения. Наследует OSError, как и ошибки requests, — такие ошибки
+    не кэшируются как «ссылка не разбирается».
+    """
+
+
+def is_transient_status(status):
+    """Ответ, который стоит повторить позже: перегрузка или сбой сервиса"""
+    return status == 429 or status >= 500
+
+
+class HttpClient:
+    """
+    Общий исходящий HTTP-клиент для парсеров и курсов ЦБ.
+
+    Одна requests.Session с пулом keep-alive соединений на каждый хост,
+    gzip, раздельные таймауты подключения и чтения, ограниченное число
+    повторов с джиттером и счётчики задержек по хостам.
+    """
+
+    def __init__(self, connect_timeout=HTTP_CONNECT_TIMEOUT, read_timeout=HTTP_READ_TIMEOUT,
+                 retries=HTTP_RETRIES, backoff=HTTP_BACKOFF,
+                 pool_hosts=HTTP_POOL_HOSTS, pool_size=HTTP_POOL_SIZE):
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_hosts, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers.update({
+            'User-Agent': 'Mozilla/5.0',
+            'Accept-Encoding': 'gzip, deflate',
+            'Connection': 'keep-alive',
+        })
+
+        self._stats = {}
+        self._stats_lock = threading.Lock()
+
+    def _record(self, host, started, error=False, retry=False):
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        with self._stats_lock:
+            s = self._stats.setdefault(host, {
+                'requests': 0, 'errors': 0, 'retries': 0, 'total_ms': 0.0, 'max_ms': 0.0
+            })
+            s['requests'] += 1
+            s['total_ms'] += elapsed_ms
+            s['max_ms'] = max(s['max_ms'], elapsed_ms)
+            if error:
+                s['errors'] += 1
+            if retry:
+                s['retries'] += 1
+
+    def _sleep_before_retry(self, attempt):
+        # "full jitter": случайная пауза от 0 до backoff * 2^attempt
+        time.sleep(random.uniform(0, self.backoff * (2 ** attempt)))
+
+    def request(self, method, url, timeout=None, retries=None, **kwargs):
+        method = method.upper()
+        host = urlparse(url).netloc
+        if retries is None:
+            retries = self.retries if method in IDEMPOTENT_METHODS else 0
+        timeout = timeout or self.timeout
+
+        for attempt in range(retries + 1):
+            last_attempt = attempt >= retries
+            started = time.perf_counter()
+            try:
+                response = self.session.request(method, url, timeout=timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self._record(host, started, error=True, retry=not last_attempt)
+                if last_attempt:
+                    raise
+                logger.warning(f"{method} {host}: {e}, повтор {attempt + 1}/{retries}")
+            else:
+                retryable = response.status_code in RETRY_STATUSES
+                self._record(host, started, error=response.status_code >= 500,
+                             retry=retryable and not last_attempt)
+                if not retryable or last_attempt:
+                    return response
+                response.close()
+                logger.warning(f"{method} {host}: HTTP {response.status_code}, повтор {attempt + 1}/{retries}")
+            self._sleep_before_retry(attempt)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def stats(self):
+        """Счётчики по хостам: число запросов, ошибок, повторов, средняя и максимальная задержка"""
+        with self._stats_lock:
+            result = {}
+            for host, s in self._stats.items():
+                result[host] = dict(s)
+                result[host]['avg_ms'] = round(s['total_ms'] / s['requests'], 2) if s['requests'] else 0.0
+                result[host]['total_ms'] = round(s['total_ms'], 2)
+                result[host]['max_ms'] = round(s['max_ms'], 2)
+            return result
+
+
+client = HttpClient()
+
+
+def get(url, **kwargs):
+    return client.get(url, **kwargs)
+
+
+def post(url, **kwargs):
+    return client.post(url, **kwargs)
+
+
+def stats():
+    return client.stats()
@@ -0,0 +1,220 @@
+import os
+import io
+import hashlib
+import logging
+import threading
+from urllib.parse import urljoin, urlparse
+from PIL import Image
+import http_client
+
+
+IMAGE_CACHE_DIR = os.getenv("IMAGE_CACHE_DIR", os.path.join('instance', 'image_cache'))
+IMAGE_CACHE_MAX_MB = int(os.getenv("IMAGE_CACHE_MAX_MB", 512))       # предел размера кэша на диске
+IMAGE_MAX_BYTES = int(os.getenv("IMAGE_MAX_BYTES", 10 * 1024 * 1024))  # больше не скачиваем
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", 82))
+# откуда разрешено проксировать картинки (хост или его поддомены)
+IMAGE_HOSTS = tuple(h.strip() for h in os.getenv(
+    "IMAGE_HOSTS", "alicdn.com,geilicdn.com,weidian.com,taobao.com,tmall.com,tbcdn.cn"
+).split(',') if h.strip())
+# размеры миниатюр (по большей стороне); запрошенный размер округляется вверх
+IMAGE_SIZES = (80, 160, 320, 640, 1280)
+IMAGE_MAX_AGE = 365 * 24 * 3600
+IMAGE_MAX_REDIRECTS = 3
+
+logger = logging.getLogger(__name__)
+
+
+class ImageCache:
+    """
+    Дисковый кэш картинок маркетплейсов с миниатюрами.
+
+    Оригинал скачивается один раз, миниатюры нужного размера (WebP или JPEG)
+    строятся из него по первому запросу. Время последнего обращения хранится
+    в mtime файла; при превышении max_bytes удаляются самые давно нужные файлы.
+    """
+
+    FORMATS = {
+        'webp': ('WEBP', 'image/webp'),
+        'jpeg': ('JPEG', 'image/jpeg'),
+    }
+
+    def __init__(self, root=IMAGE_CACHE_DIR, max_bytes=IMAGE_CACHE_MAX_MB * 1024 * 1024,
+                 hosts=IMAGE_HOSTS, sizes=IMAGE_SIZES, quality=IMAGE_QUALITY):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hosts = hosts
+        self.sizes = sizes
+        self.quality = quality
+        # одна загрузка/сборка на файл; блокировки разбиты на полосы по хэшу имени
+        self._locks = [threading.Lock() for _ in range(64)]
+        self._total = None
+        self._total_lock = threading.Lock()
+
+    def is_allowed(self, url):
+        if not url or not isinstance(url, str):
+            return False
+        parsed = urlparse(url if '://' in url else 'https:' + url)
+        host = (parsed.hostname or '').lower()
+        return parsed.scheme in ('http', 'https') and any(
+            host == h or host.endswith('.' + h) for h in self.hosts
+        )
+
+    def snap_size(self, size):
+        """Ближайший разрешённый размер не меньше запрошенного"""
+        return next((s for s in self.sizes if s >= size), self.sizes[-1])
+
+    @staticmethod
+    def key(url):
+        return hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+    def etag(self, url, size, fmt):
+        return f"{self.key(url)}-{size}.{fmt}"
+
+    def _path(self, kind, name):
+        return os.path.join(self.root, kind, name[:2], name)
+
+    def _lock_for(self, name):
+        return self._locks[hash(name) % len(self._locks)]
+
+    def _touch(self, path):
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+    def _write(self, path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+        self._account(len(data))
+
+    def _download(self, url):
+        url = url if '://' in url else 'https:' + url
+        # редиректы проходим сами: каждый следующий адрес тоже должен быть с разрешённого хоста
+        for _ in range(IMAGE_MAX_REDIRECTS + 1):
+            response = http_client.get(url, stream=True, allow_redirects=False)
+            if not response.is_redirect:
+                break
+            location = urljoin(url, response.headers['Location'])
+            response.close()
+            if not self.is_allowed(location):
+                raise Exception(f"Редирект картинки на неразрешённый адрес: {location}")
+            url = location
+        else:
+            raise Exception("Слишком много редиректов при загрузке картинки")
+        try:
+            if response.status_code != 200:
+                raise Exception(f"Ошибка загрузки картинки: HTTP {response.status_code}")
+            if not response.headers.get('Content-Type', 'image/').startswith('image/'):
+                raise Exception("По ссылке не картинка")
+            data = bytearray()
+            for chunk in response.iter_content(chunk_size=64 * 1024):
+                data += chunk
+                if len(data) > IMAGE_MAX_BYTES:
+                    raise Exception("Картинка слишком большая")
+            return bytes(data)
+        finally:
+            response.close()
+
+    def original(self, url):
+        """Путь к скачанному оригиналу; скачивает его, если в кэше нет"""
+        path = self._path('orig', self.key(url))
+        if os.path.exists(path):
+            self._touch(path)
+            return path
+        with self._lock_for(path):
+            if not os.path.exists(path):
+                self._write(path, self._download(url))
+        return path
+
+    def thumbnail(self, url, size, fmt='webp'):
+        """Путь к миниатюре size (по большей стороне) в формате fmt ('webp' или 'jpeg')"""
+        size = self.snap_size(size)
+        pil_format, _ = self.FORMATS[fmt]
+        path = self._path('thumb', self.etag(url, size, fmt))
+        if os.path.exists(path):
+            self._touch(path)
+            return path
+
+        # оригинал берётся до блокировки миниатюры, чтобы не держать две блокировки сразу
+        source = self.original(url)
+        with self._lock_for(path):
+            if os.path.exists(path):
+                return path
+            with Image.open(source) as image:
+                image.draft('RGB', (size, size))  # для JPEG декодирует сразу в уменьшенном масштабе
+                image = image.convert('RGBA' if fmt == 'webp' and image.mode in ('RGBA', 'LA', 'P') else 'RGB')
+                image.thumbnail((size, size), Image.LANCZOS)
+                buf = io.BytesIO()
+                if fmt == 'jpeg':
+                    image.save(buf, pil_format, quality=self.quality, optimize=True, progressive=True)
+                else:
+                    image.save(buf, pil_format, quality=self.quality, method=4)
+            self._write(path, buf.getvalue())
+        return path
+
+    def open_thumbnail(self, url, size, fmt='webp'):
+        """
+        Миниатюра, открытая на чтение. prune из соседнего запроса может удалить
+        оригинал или миниатюру между сборкой и открытием — тогда собираем заново;
+        уже открытому файлу удаление не мешает.
+        """
+        for _ in range(2):
+            try:
+                return open(self.thumbnail(url, size, fmt), 'rb')
+            except FileNotFoundError:
+                logger.info(f"Картинку {url} вытеснили из кэша во время сборки, собираем заново")
+        return open(self.thumbnail(url, size, fmt), 'rb')
+
+    def mimetype(self, fmt):
+        return self.FORMATS[fmt][1]
+
+    # ---- ограничение размера ----
+
+    def _files(self):
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                if name.endswith('.tmp'):
+                    continue
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                yield path, st.st_size, st.st_mtime
+
+    def _account(self, added):
+        with self._total_lock:
+            if self._total is None:
+                self._total = sum(size for _, size, _ in self._files())
+            else:
+                self._total += added
+            over = self._total > self.max_bytes
+        if over:
+            self.prune()
+
+    def prune(self, target_ratio=0.9):
+        """Удаляет самые давно использованные файлы, пока кэш не станет меньше target_ratio * max_bytes"""
+        with self._total_lock:
+            files = sorted(self._files(), key=lambda f: f[2])
+            total = sum(size for _, size, _ in files)
+            target = self.max_bytes * target_ratio
+            removed = 0
+            for path, size, _ in files:
+                if total <= target:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+                removed += 1
+            self._total = total
+        if removed:
+            logger.info(f"Кэш картинок: удалено {removed} файлов, осталось {total / 1024 / 1024:.1f} MB")
+        return removed
+
+
+image_cache = ImageCache()
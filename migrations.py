@@ -0,0 +1,701 @@
+"""
+Версионированные миграции схемы БД.
+
+Каждая миграция — функция с номером версии, получает курсор и меняет схему.
+Применённые версии записываются в таблицу schema_version; migrate()
+выполняет по порядку только те, что новее записанной, и досоздаёт
+индексы из INDEXES. Базовая схема (1) создаётся сразу в актуальном виде,
+следующие миграции догоняют базы, созданные до появления миграций,
+поэтому они не падают на уже существующих колонках.
+"""
+import re
+import json
+import logging
+from collections import defaultdict
+
+
+logger = logging.getLogger(__name__)
+
+# (версия, описание, функция) по возрастанию версии
+MIGRATIONS = []
+
+
+def migration(version, description):
+    def decorator(func):
+        if MIGRATIONS and MIGRATIONS[-1][0] >= version:
+            raise ValueError(f"Миграция {version} объявлена не по порядку")
+        MIGRATIONS.append((version, description, func))
+        return func
+    return decorator
+
+
+def table_columns(cursor, table):
+    cursor.execute(f"PRAGMA table_info({table})")
+    return {row[1] for row in cursor.fetchall()}
+
+
+def add_missing_columns(cursor, table, columns):
+    """Добавляет в существующую таблицу колонки, которых в ней ещё нет"""
+    existing = table_columns(cursor, table)
+    added = []
+    for name, decl in columns.items():
+        if name not in existing:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {name} {decl}")
+            added.append(name)
+    return added
+
+
+@migration(1, 'Базовая схема')
+def create_base_schema(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT UNIQUE NOT NULL,
+            password TEXT NOT NULL,
+            region TEXT NOT NULL,
+            photo TEXT DEFAULT 'static/default.png',
+            is_admin BOOLEAN DEFAULT FALSE,
+            balance_cny DECIMAL(10, 2) DEFAULT 0.0,
+            balance_rub DECIMAL(10, 2) DEFAULT 0.0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS replenishments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            amount_rub DECIMAL(10, 2) NOT NULL,
+            amount_cny DECIMAL(10, 2) NOT NULL,
+            payment_date TEXT NOT NULL,
+            receipt_path TEXT NOT NULL,
+            status TEXT DEFAULT 'pending',
+            admin_id INTEGER,
+            admin_comment TEXT,
+            fx_rate REAL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            processed_at TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id),
+            FOREIGN KEY (admin_id) REFERENCES users (id)
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS withdrawals (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            amount DECIMAL(10, 2) NOT NULL,
+            card_number TEXT NOT NULL,
+            card_holder TEXT NOT NULL,
+            name TEXT,
+            status TEXT DEFAULT 'pending',
+            admin_comment TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            processed_at TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+
+    # Таблица товаров
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS products (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            title TEXT NOT NULL,
+            base_price REAL,
+            marketplace TEXT,
+            item_id TEXT,
+            canonical_url TEXT,
+            synced_at TIMESTAMP,
+            updated_at TIMESTAMP
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS models (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            product_id INTEGER,
+            product_url TEXT,
+            sku_id TEXT,
+            color_name TEXT,
+            size_name TEXT,
+            price REAL,
+            stock INTEGER,  
+            image_url TEXT,
+            status TEXT DEFAULT 'temporary',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (product_id) REFERENCES products(id)
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS cart_items (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            model_id INTEGER NOT NULL,
+            quantity INTEGER NOT NULL,
+            added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(id),
+            FOREIGN KEY (model_id) REFERENCES models(id)
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS orders (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            model_id INTEGER NOT NULL,
+            quantity INTEGER NOT NULL,
+            status TEXT DEFAULT 'ordered',
+            additional_services TEXT,
+            total_price REAL,
+            our_tracking_number TEXT,
+            china_tracking_number TEXT,
+            cn_delivery_price REAL,
+            cn_delivery_paid BOOLEAN DEFAULT FALSE,
+            photos TEXT DEFAULT '[]',
+            weight REAL,
+            warehouse_location TEXT,
+            fx_rate REAL,
+            cn_delivery_fx_rate REAL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(id),
+            FOREIGN KEY (model_id) REFERENCES models(id)
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS order_shipments  (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            model_ids TEXT NOT NULL,
+            delivery_method TEXT NOT NULL,
+            packaging_options TEXT NOT NULL,
+            recipient_name TEXT NOT NULL,
+            recipient_phone TEXT NOT NULL,
+            recipient_city TEXT NOT NULL,
+            recipient_address TEXT NOT NULL,
+            total_weight REAL NOT NULL,
+            delivery_cost REAL NOT NULL,
+            our_tracking_number TEXT,
+            packaging_cost REAL NOT NULL,
+            total_cost REAL NOT NULL,
+            status TEXT DEFAULT 'pending' CHECK(status IN ('pending', 'processing', 'shipped', 'delivered')),
+            fx_rate REAL,
+            packaging_paid INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP
+        )
+    ''')
+
+    # Курсы ЦБ по датам (рублей за 1 единицу валюты)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS fx_rates (
+            currency TEXT NOT NULL,
+            rate_date TEXT NOT NULL,
+            rate REAL NOT NULL,
+            fetched_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (currency, rate_date)
+        )
+    ''')
+
+    # Кто из воркеров сейчас импортирует товар (ключ — маркетплейс и id товара)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS import_leases (
+            item_key TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            product_id INTEGER,
+            expires_at REAL NOT NULL
+        )
+    ''')
+
+
+@migration(2, 'Курс ЦБ в движениях денег')
+def add_fx_rate_columns(cursor):
+    add_missing_columns(cursor, 'replenishments', {'fx_rate': 'REAL'})
+    add_missing_columns(cursor, 'orders', {'fx_rate': 'REAL', 'cn_delivery_fx_rate': 'REAL'})
+    add_missing_columns(cursor, 'order_shipments', {'fx_rate': 'REAL'})
+
+
+@migration(3, 'Время сверки товаров с маркетплейсом')
+def add_product_synced_at(cursor):
+    add_missing_columns(cursor, 'products', {'synced_at': 'TIMESTAMP'})
+
+
+@migration(4, 'Каноническая идентичность товаров и id SKU')
+def add_product_identity(cursor):
+    added = add_missing_columns(cursor, 'products', {
+        'marketplace': 'TEXT', 'item_id': 'TEXT', 'canonical_url': 'TEXT', 'updated_at': 'TIMESTAMP'
+    })
+    add_missing_columns(cursor, 'models', {'sku_id': 'TEXT'})
+    if 'item_id' in added:
+        backfill_product_identity(cursor)
+    cursor.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_products_marketplace_item
+        ON products (marketplace, item_id)
+    ''')
+    cursor.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_models_product_sku
+        ON models (product_id, sku_id)
+    ''')
+
+
+def backfill_product_identity(cursor):
+    """
+    Проставляет marketplace/item_id товарам, созданным до канонического хранилища.
+    Из дублей одного товара идентичность получает самый новый; остальные остаются
+    как есть, на них ссылаются старые заказы.
+    """
+    from catalog import canonicalize
+
+    cursor.execute('''
+        SELECT p.id, MIN(m.product_url) AS url
+        FROM products p JOIN models m ON m.product_id = p.id
+        WHERE p.item_id IS NULL AND m.product_url IS NOT NULL
+        GROUP BY p.id
+        ORDER BY p.id DESC
+    ''')
+    seen = set()
+    updates = []
+    for product_id, url in cursor.fetchall():
+        identity = canonicalize(url)
+        if not identity:
+            continue
+        key = (identity['marketplace'], identity['item_id'])
+        if key in seen:
+            continue
+        seen.add(key)
+        updates.append((identity['marketplace'], identity['item_id'], identity['canonical_url'], product_id))
+    cursor.executemany(
+        'UPDATE products SET marketplace = ?, item_id = ?, canonical_url = ? WHERE id = ?',
+        updates
+    )
+
+
+@migration(5, 'Оплата упаковки и время изменения посылок')
+def add_shipment_columns(cursor):
+    # раньше add_shipment добавлял our_tracking_number прямо при вставке
+    add_missing_columns(cursor, 'order_shipments', {
+        'our_tracking_number': 'TEXT',
+        'packaging_paid': 'INTEGER DEFAULT 0',
+        'updated_at': 'TIMESTAMP',
+    })
+
+
+@migration(6, 'Состав посылок в shipment_items')
+def create_shipment_items(cursor):
+    # order_id без внешнего ключа: старые посылки ссылаются и на удалённые заказы,
+    # в админке они видны как ненайденные позиции
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS shipment_items (
+            shipment_id INTEGER NOT NULL,
+            order_id INTEGER NOT NULL,
+            position INTEGER NOT NULL,
+            PRIMARY KEY (shipment_id, order_id),
+            FOREIGN KEY (shipment_id) REFERENCES order_shipments(id) ON DELETE CASCADE
+        )
+    ''')
+    backfill_shipment_items(cursor)
+
+
+def parse_order_ids(val):
+    """Список orders.id из model_ids: только JSON [1,2] или CSV '1,2,3'. Без регэкспов."""
+    if val is None:
+        return []
+    s = str(val).strip()
+    if not s:
+        return []
+    # JSON массив
+    if s.startswith('[') and s.endswith(']'):
+        try:
+            arr = json.loads(s)
+            if isinstance(arr, (list, tuple)):
+                return [int(x) for x in arr if str(x).strip().isdigit()]
+        except Exception:
+            return []
+    # CSV из цифр
+    return [int(p) for p in (p.strip() for p in s.split(',')) if p.isdigit()]
+
+
+def repair_order_ids(raw_str, valid_ids):
+    """
+    Чиним строки вида '[,1,2,,, ,1,3,]'.
+    Склеиваем 3- / 2- / 1-значные числа, если они существуют в valid_ids.
+    """
+    if not raw_str or not valid_ids:
+        return []
+    s = ''.join(re.findall(r'\d', str(raw_str)))  # например '1213'
+    out = []
+    i = 0
+    # максимальная длина id в БД (обычно 1..6)
+    max_len = min(max(len(str(x)) for x in valid_ids), 6)
+    while i < len(s):
+        # сначала пробуем длинные окна
+        for L in range(min(max_len, len(s) - i), 0, -1):
+            candidate = int(s[i:i + L])
+            if candidate in valid_ids:
+                out.append(candidate)
+                i += L
+                break
+        else:
+            i += 1
+    return out
+
+
+def backfill_shipment_items(cursor):
+    """
+    Переносит model_ids существующих посылок в shipment_items. Битые строки
+    чинятся по заказам владельца посылки, и model_ids переписывается в JSON.
+    """
+    cursor.execute('SELECT id, user_id, model_ids FROM order_shipments')
+    shipments = cursor.fetchall()
+
+    valid = {}
+    cursor.execute('SELECT id, user_id FROM orders')
+    for order_id, user_id in cursor.fetchall():
+        valid.setdefault(user_id, set()).add(order_id)
+
+    items = []
+    repaired = []
+    for shipment_id, user_id, model_ids in shipments:
+        order_ids = parse_order_ids(model_ids)
+        if not order_ids and model_ids:
+            order_ids = repair_order_ids(model_ids, valid.get(user_id))
+            repaired.append((json.dumps(list(dict.fromkeys(order_ids))), shipment_id))
+        for position, order_id in enumerate(dict.fromkeys(order_ids)):
+            items.append((shipment_id, order_id, position))
+
+    cursor.executemany(
+        'INSERT OR IGNORE INTO shipment_items (shipment_id, order_id, position) VALUES (?, ?, ?)',
+        items
+    )
+    cursor.executemany('UPDATE order_shipments SET model_ids = ? WHERE id = ?', repaired)
+    if repaired:
+        logger.info(f"Починены model_ids у {len(repaired)} посылок")
+
+
+@migration(7, 'Фото проверки заказов в order_photos')
+def create_order_photos(cursor):
+    # orders.photos остаётся для совместимости со старым кодом, но больше не пишется
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS order_photos (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            order_id INTEGER NOT NULL,
+            url TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE (order_id, url),
+            FOREIGN KEY (order_id) REFERENCES orders(id) ON DELETE CASCADE
+        )
+    ''')
+    backfill_order_photos(cursor)
+
+
+def parse_photo_urls(val):
+    """
+    Список ссылок из orders.photos. Строка бывает JSON-массивом, дважды
+    закодированным JSON, JSON в лишних кавычках или просто одной ссылкой.
+    """
+    if not val or not isinstance(val, str):
+        return []
+    s = val.strip()
+    for candidate in (s, s.strip('"\'')):
+        try:
+            data = json.loads(candidate)
+        except json.JSONDecodeError:
+            continue
+        if isinstance(data, str):
+            try:
+                data = json.loads(data)
+            except json.JSONDecodeError:
+                pass
+        break
+    else:
+        data = s.strip('"\'')
+    if isinstance(data, str):
+        data = [data]
+    if not isinstance(data, list):
+        return []
+    return [u.strip() for u in data if isinstance(u, str) and u.strip()]
+
+
+def backfill_order_photos(cursor):
+    """Переносит orders.photos в order_photos с сохранением порядка"""
+    cursor.execute("SELECT id, photos FROM orders WHERE photos IS NOT NULL AND photos != ''")
+    rows = []
+    for order_id, photos in cursor.fetchall():
+        for position, url in enumerate(dict.fromkeys(parse_photo_urls(photos))):
+            rows.append((order_id, url, position))
+    cursor.executemany(
+        'INSERT OR IGNORE INTO order_photos (order_id, url, position) VALUES (?, ?, ?)',
+        rows
+    )
+    if rows:
+        logger.info(f"Перенесено {len(rows)} фото заказов в order_photos")
+
+
+@migration(8, 'Журнал движений по балансу')
+def create_ledger_entries(cursor):
+    # amount со знаком; balance_after — баланс валюты у пользователя сразу после записи
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS ledger_entries (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            currency TEXT NOT NULL CHECK (currency IN ('CNY', 'RUB')),
+            amount REAL NOT NULL,
+            balance_after REAL NOT NULL,
+            ref_type TEXT NOT NULL,
+            ref_id INTEGER,
+            fx_rate REAL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+        )
+    ''')
+    backfill_ledger(cursor)
+
+
+# Курс CNY из fx_rates на дату операции — для рублёвого эквивалента старых записей
+_CNY_RATE_ON = '''(
+    SELECT rate FROM fx_rates
+    WHERE currency = 'CNY' AND rate_date <= date({date})
+    ORDER BY rate_date DESC LIMIT 1
+)'''
+
+# Прошлые движения денег в том виде, в каком их списывал/зачислял код приложения:
+# (user_id, дата, ref_type, ref_id, CNY, RUB, курс). Вторая валюта, которую
+# нечем пересчитать, — NULL: её досчитывает backfill_ledger
+_LEGACY_MOVEMENTS = f'''
+    SELECT user_id, COALESCE(processed_at, created_at), 'replenishment', id,
+           amount_cny, amount_rub, fx_rate
+    FROM replenishments WHERE status = 'approved'
+    UNION ALL
+    SELECT user_id, COALESCE(processed_at, created_at), 'withdrawal', id,
+           NULL, -amount, {_CNY_RATE_ON.format(date='COALESCE(processed_at, created_at)')}
+    FROM withdrawals WHERE status = 'approved'
+    UNION ALL
+    SELECT user_id, created_at, 'purchase', id,
+           -total_price, NULL, COALESCE(fx_rate, {_CNY_RATE_ON.format(date='created_at')})
+    FROM orders WHERE COALESCE(total_price, 0) != 0
+    UNION ALL
+    SELECT user_id, created_at, 'delivery_cn', id,
+           -cn_delivery_price, NULL,
+           COALESCE(cn_delivery_fx_rate, fx_rate, {_CNY_RATE_ON.format(date='created_at')})
+    FROM orders WHERE cn_delivery_paid = 1 AND COALESCE(cn_delivery_price, 0) != 0
+    UNION ALL
+    SELECT user_id, created_at, 'shipment', id,
+           -total_cost, NULL, COALESCE(fx_rate, {_CNY_RATE_ON.format(date='created_at')})
+    FROM order_shipments WHERE COALESCE(total_cost, 0) != 0
+    UNION ALL
+    SELECT user_id, COALESCE(updated_at, created_at), 'packaging', id,
+           -packaging_cost, NULL, NULL
+    FROM order_shipments WHERE packaging_paid = 1 AND COALESCE(packaging_cost, 0) != 0
+'''
+
+# Упаковка списывалась только в юанях — рублёвой записи у неё не было
+_CNY_ONLY_MOVEMENTS = {'packaging'}
+
+# Курс, по которому пользователь пополнял баланс: RUB / CNY его одобренных пополнений
+_REPLENISHMENT_RATES = '''
+    SELECT user_id, SUM(amount_rub) / SUM(amount_cny)
+    FROM replenishments
+    WHERE status = 'approved' AND amount_rub > 0 AND amount_cny > 0
+    GROUP BY user_id
+'''
+
+
+def backfill_ledger(cursor):
+    """
+    Восстанавливает журнал по прошлым пополнениям, выводам и оплатам.
+
+    Вторая валюта старой записи пересчитывается по её курсу, курсу ЦБ из
+    fx_rates на дату или, если их нет, по курсу пополнений пользователя; без
+    курса рублёвая запись не выдумывается. Разница с текущим балансом — в
+    конце, записью 'reconciliation'; 'opening' в начале появляется, только
+    если без неё баланс по ходу истории ушёл бы в минус. Так balance_after
+    последней записи точно равен users.balance_*, а промежуточные остатки
+    не отрицательны, если не отрицателен текущий.
+    """
+    cursor.execute(_REPLENISHMENT_RATES)
+    user_rates = {user_id: rate for user_id, rate in cursor.fetchall()}
+
+    cursor.execute(_LEGACY_MOVEMENTS)
+    movements = defaultdict(list)
+    for user_id, date, ref_type, ref_id, cny, rub, fx_rate in cursor.fetchall():
+        rate = fx_rate or user_rates.get(user_id)
+        if rate and ref_type not in _CNY_ONLY_MOVEMENTS and (cny is None) != (rub is None):
+            if rub is None:
+                rub = round(float(cny) * rate, 2)
+            else:
+                cny = round(float(rub) / rate, 2)
+            fx_rate = rate
+        movements[user_id].append((str(date or ''), ref_type, ref_id, cny, rub, fx_rate))
+
+    cursor.execute('SELECT id, balance_cny, balance_rub, created_at FROM users')
+    rows = []
+    for user_id, balance_cny, balance_rub, created_at in cursor.fetchall():
+        history = sorted(movements.get(user_id, []), key=lambda m: m[0])
+        balances = {'CNY': float(balance_cny or 0), 'RUB': float(balance_rub or 0)}
+        entries = []
+        for date, ref_type, ref_id, cny, rub, fx_rate in history:
+            for currency, amount in (('CNY', cny), ('RUB', rub)):
+                if amount:
+                    entries.append((date, ref_type, ref_id, currency, float(amount), fx_rate))
+
+        first_date = min([str(created_at or '')] + [e[0] for e in entries if e[0]])
+        last_date = max([str(created_at or '')] + [e[0] for e in entries if e[0]])
+        opening, closing = [], []
+        for currency in ('CNY', 'RUB'):
+            running = lowest = 0.0
+            for e in entries:
+                if e[3] == currency:
+                    running += e[4]
+                    lowest = min(lowest, running)
+            start = round(-lowest, 2) if lowest <= -0.005 else 0.0
+            if not any(e[3] == currency for e in entries):
+                start = balances[currency]
+            if abs(start) >= 0.005:
+                opening.append((first_date, 'opening', None, currency, start, None))
+            diff = round(balances[currency] - start - running, 2)
+            if abs(diff) >= 0.005:
+                closing.append((last_date, 'reconciliation', None, currency, diff, None))
+
+        running = {'CNY': 0.0, 'RUB': 0.0}
+        for date, ref_type, ref_id, currency, amount, fx_rate in opening + entries + closing:
+            running[currency] += amount
+            if running[currency] < -0.005 and balances[currency] >= 0:
+                raise ValueError(
+                    f"Журнал пользователя {user_id} уходит в минус по {currency} "
+                    f"при неотрицательном балансе"
+                )
+            rows.append((user_id, currency, amount, running[currency], ref_type, ref_id, fx_rate, date or None))
+
+    cursor.executemany('''
+        INSERT INTO ledger_entries
+            (user_id, currency, amount, balance_after, ref_type, ref_id, fx_rate, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP))
+    ''', rows)
+    if rows:
+        logger.info(f"Журнал баланса восстановлен: {len(rows)} записей")
+
+
+@migration(9, 'Помесячные итоги журнала баланса')
+def create_ledger_monthly(cursor):
+    # пополняется вместе с ledger_entries (Database._post_ledger)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS ledger_monthly (
+            user_id INTEGER NOT NULL,
+            month TEXT NOT NULL,
+            currency TEXT NOT NULL,
+            total_in REAL NOT NULL DEFAULT 0,
+            total_out REAL NOT NULL DEFAULT 0,
+            entries INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, month, currency),
+            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+        )
+    ''')
+    backfill_ledger_monthly(cursor)
+
+
+def backfill_ledger_monthly(cursor):
+    """
+    Пересчитывает ledger_monthly по ledger_entries (month — 'YYYY-MM' по
+    created_at). Записи 'opening' и 'reconciliation' из backfill_ledger —
+    сверка с балансом, а не движение денег: в обороты месяца не входят.
+    """
+    cursor.execute('DELETE FROM ledger_monthly')
+    cursor.execute('''
+        INSERT INTO ledger_monthly (user_id, month, currency, total_in, total_out, entries)
+        SELECT user_id, strftime('%Y-%m', created_at), currency,
+               SUM(CASE WHEN amount > 0 THEN amount ELSE 0 END),
+               SUM(CASE WHEN amount < 0 THEN -amount ELSE 0 END),
+               COUNT(*)
+        FROM ledger_entries
+        WHERE ref_type NOT IN ('opening', 'reconciliation')
+        GROUP BY user_id, strftime('%Y-%m', created_at), currency
+    ''')
+
+
+@migration(10, 'Индекс заявок на пополнение по пользователю заменён на (пользователь, дата)')
+def drop_replenishments_user_index(cursor):
+    # idx_replenishments_user заменён idx_replenishments_user_created из INDEXES:
+    # фильтр админки по пользователю идёт страницами по (user_id, created_at)
+    cursor.execute('DROP INDEX IF EXISTS idx_replenishments_user')
+
+
+# Вторичные индексы горячих запросов: имя -> (таблица, колонки).
+# Описаны декларативно и досоздаются при каждом migrate(); проверка планов —
+# benchmarks/query_plans.py. models.product_id отдельно не нужен: его покрывает
+# префикс уникального idx_models_product_sku (product_id, sku_id).
+INDEXES = {
+    'idx_orders_user_created': ('orders', ('user_id', 'created_at')),
+    'idx_orders_created': ('orders', ('created_at',)),
+    'idx_orders_status_created': ('orders', ('status', 'created_at')),
+    'idx_orders_model': ('orders', ('model_id',)),
+    'idx_orders_our_tracking': ('orders', ('our_tracking_number',)),
+    'idx_orders_china_tracking': ('orders', ('china_tracking_number',)),
+    'idx_models_status_created': ('models', ('status', 'created_at')),
+    'idx_cart_items_user_model': ('cart_items', ('user_id', 'model_id')),
+    'idx_replenishments_status_created': ('replenishments', ('status', 'created_at')),
+    'idx_replenishments_user_created': ('replenishments', ('user_id', 'created_at')),
+    'idx_withdrawals_status_created': ('withdrawals', ('status', 'created_at')),
+    'idx_withdrawals_user_created': ('withdrawals', ('user_id', 'created_at')),
+    'idx_order_shipments_user_created': ('order_shipments', ('user_id', 'created_at')),
+    'idx_order_shipments_created': ('order_shipments', ('created_at',)),
+    'idx_order_shipments_status_created': ('order_shipments', ('status', 'created_at')),
+    'idx_order_shipments_our_tracking': ('order_shipments', ('our_tracking_number',)),
+    'idx_shipment_items_order': ('shipment_items', ('order_id',)),
+    'idx_order_photos_order_position': ('order_photos', ('order_id', 'position')),
+    'idx_ledger_entries_user_created': ('ledger_entries', ('user_id', 'created_at', 'id')),
+}
+
+
+def ensure_indexes(cursor, indexes=INDEXES):
+    """Создаёт недостающие индексы из набора; возвращает имена созданных"""
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index'")
+    existing = {row[0] for row in cursor.fetchall()}
+    created = []
+    for name, (table, columns) in indexes.items():
+        if name in existing:
+            continue
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({', '.join(columns)})")
+        created.append(name)
+    if created:
+        # статистика для планировщика по таблицам с новыми индексами
+        for table in sorted({indexes[name][0] for name in created}):
+            cursor.execute(f"ANALYZE {table}")
+    return created
+
+
+def current_version(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT NOT NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('SELECT MAX(version) FROM schema_version')
+    return cursor.fetchone()[0] or 0
+
+
+def migrate(cursor):
+    """
+    Применяет недостающие миграции; возвращает список применённых версий.
+    Вызывающий держит транзакцию (BEGIN IMMEDIATE), чтобы несколько процессов,
+    стартующих одновременно, не применяли одну миграцию дважды.
+    """
+    version = current_version(cursor)
+    applied = []
+    for number, description, func in MIGRATIONS:
+        if number <= version:
+            continue
+        logger.info(f"Миграция схемы {number}: {description}")
+        func(cursor)
+        cursor.execute(
+            'INSERT INTO schema_version (version, description) VALUES (?, ?)',
+            (number, description)
+        )
+        applied.append(number)
+    created = ensure_indexes(cursor)
+    if created:
+        logger.info(f"Созданы индексы: {', '.join(created)}")
+    return applied
@@ -0,0 +1,112 @@
+import os
+import time
+import random
+import asyncio
+import aiohttp
+from http_client import (
+    HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT, HTTP_RETRIES, HTTP_BACKOFF, RETRY_STATUSES,
+    UpstreamError
+)
+from parser.taobao import build_item_detail_request, process_item_detail, is_transient_code
+from parser.weidian import extract_render_data, process_weidian_data, page_url, page_error
+
+
+AIO_CONCURRENCY = int(os.getenv("AIO_CONCURRENCY", 20))   # одновременных запросов к маркетплейсам
+
+
+class AsyncFetcher:
+    """
+    Асинхронный загрузчик для массового парсинга товаров.
+
+    Одна aiohttp-сессия с keep-alive на весь пакет, семафор ограничивает число
+    одновременных запросов. Повторы и таймауты — как у http_client.
+    """
+
+    def __init__(self, concurrency=AIO_CONCURRENCY, connect_timeout=HTTP_CONNECT_TIMEOUT,
+                 read_timeout=HTTP_READ_TIMEOUT, retries=HTTP_RETRIES, backoff=HTTP_BACKOFF):
+        self.concurrency = max(int(concurrency), 1)
+        self.timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self._semaphore = None
+        self._session = None
+
+    async def __aenter__(self):
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self._session = aiohttp.ClientSession(
+            timeout=self.timeout,
+            connector=aiohttp.TCPConnector(limit=self.concurrency, ttl_dns_cache=300),
+            headers={'User-Agent': 'Mozilla/5.0', 'Accept-Encoding': 'gzip, deflate'},
+        )
+        return self
+
+    async def __aexit__(self, *exc):
+        await self._session.close()
+
+    async def get(self, url, params=None, as_json=False):
+        """GET с повторами; возвращает (status, json или текст)"""
+        for attempt in range(self.retries + 1):
+            last_attempt = attempt >= self.retries
+            try:
+                async with self._semaphore:
+                    async with self._session.get(url, params=params) as response:
+                        if response.status not in RETRY_STATUSES or last_attempt:
+                            if as_json:
+                                return response.status, await response.json(content_type=None)
+                            return response.status, await response.text()
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                # ошибки aiohttp не OSError — оборачиваем, чтобы их не закэшировали как неразбираемую ссылку
+                if last_attempt:
+                    raise UpstreamError(f"{type(e).__name__}: {e}") from e
+            await asyncio.sleep(random.uniform(0, self.backoff * (2 ** attempt)))
+
+
+async def parse_taobao_product_async(fetcher, api_token, product_url):
+    url, params = build_item_detail_request(api_token, product_url)
+    status, data = await fetcher.get(url, params=params, as_json=True)
+    if status >= 400:
+        if is_transient_code(status):
+            raise UpstreamError(f"Ошибка tmapi: HTTP {status}")
+        raise Exception(f"Ошибка tmapi: HTTP {status}")
+    return process_item_detail(data)
+
+
+async def parse_weidian_product_async(fetcher, url):
+    status, html = await fetcher.get(page_url(url))
+    if status != 200:
+        raise page_error(status)
+    # перевод ходит в сеть синхронно — не блокируем цикл событий
+    return await asyncio.to_thread(process_weidian_data, extract_render_data(html))
+
+
+async def _parse_one(fetcher, marketplace, url, api_token):
+    started = time.perf_counter()
+    try:
+        if marketplace == 'taobao':
+            product = await parse_taobao_product_async(fetcher, api_token, url)
+        elif marketplace == 'weidian':
+            product = await parse_weidian_product_async(fetcher, url)
+        else:
+            raise ValueError("Неподдерживаемый сайт")
+        return {'url': url, 'product': product, 'error': None,
+                'elapsed_ms': round((time.perf_counter() - started) * 1000, 1)}
+    except Exception as e:
+        return {'url': url, 'product': None, 'error': e,
+                'elapsed_ms': round((time.perf_counter() - started) * 1000, 1)}
+
+
+async def fetch_products_async(items, api_token=None, concurrency=AIO_CONCURRENCY):
+    """
+    Параллельно разбирает товары.
+    items — список пар (marketplace, url); результат в том же порядке:
+    {'url', 'product', 'error', 'elapsed_ms'}.
+    """
+    async with AsyncFetcher(concurrency=concurrency) as fetcher:
+        return await asyncio.gather(*(
+            _parse_one(fetcher, marketplace, url, api_token) for marketplace, url in items
+        ))
+
+
+def fetch_products(items, api_token=None, concurrency=AIO_CONCURRENCY):
+    """Синхронная обёртка над fetch_products_async для вызова из Flask и CLI"""
+    return asyncio.run(fetch_products_async(items, api_token=api_token, concurrency=concurrency))
@@ -1,39 +1,69 @@
+import os
 import sqlite3
-import requests
 import re
+import http_client
 from urllib.parse import urlparse, parse_qs
 
-def extract_item_id(url):
-    id_match = re.search(r'(?:id=|item_id=)(\d+)', url)
-    if id_match:
-        return id_match.group(1)
+HOSTS = ('taobao.com', 'tmall.com')
 
+
+def extract_item_id(url):
     parsed = urlparse(url)
     params = parse_qs(parsed.query)
-    if 'id' in params:
-        return params['id'][0]
+    for key in ('id', 'item_id'):
+        if key in params and params[key][0].isdigit():
+            return params[key][0]
+
+    # id= не должен быть хвостом другого параметра (skuId=, sku_id=)
+    id_match = re.search(r'(?<![A-Za-z0-9_])(?:id=|item_id=)(\d+)', url)
+    if id_match:
+        return id_match.group(1)
     return None
 
 
-def parse_taobao_product(api_token, product_url):
+def canonical_url(item_id):
+    return f"https://item.taobao.com/item.htm?id={item_id}"
+
+
+TMAPI_ITEM_DETAIL_URL = os.getenv("TMAPI_ITEM_DETAIL_URL", "http://api.tmapi.top/taobao/item_detail")
+# коды tmapi, к ссылке отношения не имеющие: токен, квота и лимит запросов (плюс 429 и 5xx)
+TMAPI_TRANSIENT_CODES = {401, 402, 403}
+
+
+def is_transient_code(code):
+    return code in TMAPI_TRANSIENT_CODES or http_client.is_transient_status(code)
+
+
+def build_item_detail_request(api_token, product_url):
+    """URL и параметры запроса item_detail к tmapi для ссылки на товар"""
     item_id = extract_item_id(product_url)
     if not item_id:
         raise Exception("Не удалось извлечь ID товара из URL")
 
-    url = "http://api.tmapi.top/taobao/item_detail"
     params = {"apiToken": api_token, "item_id": item_id}
-    headers = {"User-Agent": "Mozilla/5.0"}
+    return TMAPI_ITEM_DETAIL_URL, params
 
-    response = requests.get(url, headers=headers, params=params)
-    response.raise_for_status()
-    data = response.json()
 
+def process_item_detail(data):
+    """Разбирает ответ tmapi item_detail в словарь товара"""
     if data['code'] != 200:
+        if is_transient_code(data['code']):
+            raise http_client.UpstreamError(f"API error: {data['msg']}")
         raise Exception(f"API error: {data['msg']}")
 
     return process_product_data(data['data'])
 
 
+def parse_taobao_product(api_token, product_url):
+    url, params = build_item_detail_request(api_token, product_url)
+    headers = {"User-Agent": "Mozilla/5.0"}
+
+    response = http_client.get(url, headers=headers, params=params)
+    response.raise_for_status()
+
+    return process_item_detail(response.json())
+
+
 def process_product_data(product_data):
     product_info = {
         'title': product_data.get('title', 'Неизвестно'),
@@ -73,7 +103,9 @@ def process_product_data(product_data):
         if ':' in size_name:
             size_name = size_name.split(':')[-1].strip()
 
+        sku_id = sku.get('skuid') or sku.get('sku_id')
         product_info['models'].append({
+            'sku_id': str(sku_id) if sku_id else None,
             'color_name': color_name,
             'size_name': size_name,
             'price': float(sku.get('sale_price', 0)),
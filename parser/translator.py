@@ -0,0 +1,186 @@
+import os
+import time
+import logging
+import sqlite3
+import threading
+from deep_translator import GoogleTranslator
+import http_client
+
+
+TRANSLATOR_BACKEND = os.getenv("TRANSLATOR_BACKEND", "google")     # google | http | identity
+TRANSLATOR_URL = os.getenv("TRANSLATOR_URL", "")                     # для бэкенда http
+TRANSLATION_CACHE_PATH = os.getenv("TRANSLATION_CACHE_PATH", os.path.join('instance', 'translations.db'))
+TRANSLATION_BATCH_CHARS = int(os.getenv("TRANSLATION_BATCH_CHARS", 4500))  # лимит Google — 5000 символов
+
+# строки, которые не переводим
+SKIP_TEXTS = {'', 'Неизвестно'}
+
+logger = logging.getLogger(__name__)
+
+
+class GoogleBackend:
+    """
+    Перевод через Google одним запросом на пачку строк.
+
+    Строки склеиваются через перевод строки и делятся обратно; если Google
+    склеил или разбил строки и их число не сошлось, пачка переводится по одной.
+    """
+
+    def __init__(self, max_chars=TRANSLATION_BATCH_CHARS):
+        self.max_chars = max_chars
+
+    def _chunks(self, texts):
+        chunk, size = [], 0
+        for text in texts:
+            if chunk and size + len(text) + 1 > self.max_chars:
+                yield chunk
+                chunk, size = [], 0
+            chunk.append(text)
+            size += len(text) + 1
+        if chunk:
+            yield chunk
+
+    def translate_many(self, texts, source, target):
+        translator = GoogleTranslator(source=source, target=target)
+        result = []
+        for chunk in self._chunks(texts):
+            if len(chunk) == 1:
+                result.append(translator.translate(chunk[0]) or chunk[0])
+                continue
+            lines = (translator.translate('\n'.join(chunk)) or '').split('\n')
+            if len(lines) != len(chunk):
+                logger.warning(f"Пакетный перевод вернул {len(lines)} строк вместо {len(chunk)}, перевожу по одной")
+                lines = [translator.translate(text) or text for text in chunk]
+            result.extend(line.strip() for line in lines)
+        return result
+
+
+class HttpBackend:
+    """
+    Перевод через HTTP-сервис: POST {"q": [...], "source", "target"}
+    -> {"translations": [...]}. Так устроен стенд с записанными ответами.
+    """
+
+    def __init__(self, url=None):
+        self.url = url or TRANSLATOR_URL
+        if not self.url:
+            raise ValueError("Для TRANSLATOR_BACKEND=http нужен TRANSLATOR_URL")
+
+    def translate_many(self, texts, source, target):
+        response = http_client.post(self.url, json={'q': list(texts), 'source': source, 'target': target})
+        response.raise_for_status()
+        return response.json()['translations']
+
+
+class IdentityBackend:
+    """Возвращает текст как есть — для тестов и работы без доступа к Google"""
+
+    def translate_many(self, texts, source, target):
+        return list(texts)
+
+
+BACKENDS = {
+    'google': GoogleBackend,
+    'http': HttpBackend,
+    'identity': IdentityBackend,
+}
+
+
+class TranslationService:
+    """
+    Перевод текстов товаров с постоянным кэшем в SQLite.
+
+    Ключ кэша — (исходный текст, язык источника, язык перевода). Все
+    непереведённые строки товара уходят в бэкенд одним вызовом translate_many.
+    Бэкенд — любой объект с методом translate_many(texts, source, target).
+    """
+
+    def __init__(self, backend=None, path=TRANSLATION_CACHE_PATH):
+        self.backend = backend or BACKENDS[TRANSLATOR_BACKEND]()
+        self.path = path
+        self._local = threading.local()
+
+    def set_backend(self, backend):
+        self.backend = backend
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS translations (
+                    source TEXT NOT NULL,
+                    target TEXT NOT NULL,
+                    text TEXT NOT NULL,
+                    translated TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    PRIMARY KEY (source, target, text)
+                )
+            ''')
+            self._local.conn = conn
+        return conn
+
+    def _lookup(self, texts, source, target):
+        found = {}
+        conn = self._connection()
+        texts = list(texts)
+        # не упираемся в лимит параметров SQLite
+        for start in range(0, len(texts), 500):
+            part = texts[start:start + 500]
+            placeholders = ','.join('?' * len(part))
+            rows = conn.execute(f'''
+                SELECT text, translated FROM translations
+                WHERE source = ? AND target = ? AND text IN ({placeholders})
+            ''', (source, target, *part)).fetchall()
+            found.update(rows)
+        return found
+
+    def _store(self, pairs, source, target):
+        conn = self._connection()
+        now = time.time()
+        with conn:
+            conn.executemany('''
+                INSERT OR REPLACE INTO translations (source, target, text, translated, created_at)
+                VALUES (?, ?, ?, ?, ?)
+            ''', [(source, target, text, translated, now) for text, translated in pairs])
+
+    def translate_many(self, texts, source='zh-CN', target='ru'):
+        """Переводит список строк; порядок сохраняется, при ошибке возвращается оригинал"""
+        unique = list(dict.fromkeys(t for t in texts if t not in SKIP_TEXTS and isinstance(t, str)))
+        if not unique:
+            return list(texts)
+
+        try:
+            translations = self._lookup(unique, source, target)
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка чтения кэша переводов: {e}")
+            translations = {}
+
+        missing = [t for t in unique if t not in translations]
+        if missing:
+            try:
+                translated = self.backend.translate_many(missing, source, target)
+                if len(translated) != len(missing):
+                    raise ValueError(f"ожидалось {len(missing)} переводов, получено {len(translated)}")
+            except Exception as e:
+                logger.error(f"Ошибка перевода {len(missing)} строк: {e}")
+            else:
+                fresh = [(text, value) for text, value in zip(missing, translated) if value]
+                translations.update(fresh)
+                try:
+                    self._store(fresh, source, target)
+                except sqlite3.Error as e:
+                    logger.error(f"Ошибка записи кэша переводов: {e}")
+
+        return [translations.get(t, t) if isinstance(t, str) else t for t in texts]
+
+    def translate_text(self, text, source='zh-CN', target='ru'):
+        return self.translate_many([text], source, target)[0]
+
+
+translator = TranslationService()
+
+
+def translate_many(texts, source='zh-CN', target='ru'):
+    return translator.translate_many(texts, source, target)
@@ -1,22 +1,134 @@
+import os
 import sqlite3
-import requests
-from bs4 import BeautifulSoup
+import codecs
+import html as html_lib
+import http_client
+from bs4 import BeautifulSoup, SoupStrainer
 from translate import Translator
 import json
 import re
-from deep_translator import GoogleTranslator
 from urllib.parse import urlparse, parse_qs
-from functools import lru_cache
+from parser.translator import translator
+
+HOSTS = ('weidian.com',)
+# Другой адрес страниц товара (например, стенд с записанными ответами); пусто — сам weidian.com
+WEIDIAN_BASE_URL = os.getenv("WEIDIAN_BASE_URL", "")
+
+
+def extract_item_id(url):
+    parsed = urlparse(url)
+    params = parse_qs(parsed.query)
+    for key in ('itemID', 'itemId', 'id'):
+        if key in params and params[key][0].isdigit():
+            return params[key][0]
+
+    id_match = re.search(r'itemI[dD]=(\d+)', url)
+    if id_match:
+        return id_match.group(1)
+    return None
+
+
+def canonical_url(item_id):
+    return f"https://weidian.com/item.html?itemID={item_id}"
+
+
+def page_url(url):
+    """Адрес, с которого реально загружается страница товара"""
+    item_id = extract_item_id(url) if WEIDIAN_BASE_URL else None
+    if not item_id:
+        return url
+    return f"{WEIDIAN_BASE_URL.rstrip('/')}/item.html?itemID={item_id}"
+
+
+def page_error(status):
+    """Ошибка для ответа страницы товара не 200: 429 и 5xx временные, остальное — про саму ссылку"""
+    message = f"Ошибка загрузки страницы: {status}"
+    if http_client.is_transient_status(status):
+        return http_client.UpstreamError(message)
+    return Exception(message)
+
 
-@lru_cache(maxsize=100)
 def translate_text(text, source='zh-CN', target='ru'):
+    return translator.translate_text(text, source, target)
+
+
+RENDER_INJECT_ID = '__rocker-render-inject__'
+STREAM_CHUNK_SIZE = 16 * 1024
+
+# атрибут тега: имя, затем необязательное значение в "", '' или без кавычек
+_ATTR_RE = re.compile(r'''\s*([^\s=>/"']+)(?:\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'>]+)))?''')
+_TAG_END_RE = re.compile(r'\s*/?\s*>')
+
+
+def _scan_tag_attrs(html, pos):
+    """Разбирает атрибуты тега начиная с pos; None, если тег ещё не закрыт '>'"""
+    attrs = {}
+    while True:
+        end = _TAG_END_RE.match(html, pos)
+        if end:
+            return attrs
+        match = _ATTR_RE.match(html, pos)
+        if not match or match.end() >= len(html):
+            return None
+        name = match.group(1).lower()
+        value = next((v for v in match.group(2, 3, 4) if v is not None), '')
+        attrs.setdefault(name, html_lib.unescape(value))
+        pos = match.end()
+
+
+def scan_render_inject(html):
+    """
+    Находит атрибуты script#__rocker-render-inject__ без построения DOM.
+    Возвращает dict атрибутов или None, если тег не найден (или ещё не дочитан).
+    """
+    search_from = 0
+    while True:
+        idx = html.find(RENDER_INJECT_ID, search_from)
+        if idx < 0:
+            return None
+        tag_start = html.rfind('<', 0, idx)
+        if tag_start >= 0 and html[tag_start + 1:tag_start + 7].lower() == 'script':
+            attrs = _scan_tag_attrs(html, tag_start + 7)
+            if attrs is None:
+                return None
+            if attrs.get('id') == RENDER_INJECT_ID:
+                return attrs
+        search_from = idx + len(RENDER_INJECT_ID)
+
+
+def _render_data_from_attrs(attrs):
+    json_data = attrs.get('data-obj')
+    if not json_data:
+        raise Exception("Не удалось извлечь JSON-данные")
+    return json.loads(json_data)
+
+
+def fetch_render_data(url, headers=None):
+    """
+    Скачивает страницу потоком и останавливается, как только дочитан тег
+    с данными товара; остаток страницы не загружается и не парсится.
+    """
+    response = http_client.get(url, headers=headers, stream=True)
     try:
-        if not text or text == 'Неизвестно':
-            return text
-        return GoogleTranslator(source=source, target=target).translate(text)
-    except Exception as e:
-        print(f"Ошибка перевода '{text}': {str(e)}")
-        return text
+        if response.status_code != 200:
+            raise page_error(response.status_code)
+
+        charset = 'utf-8'
+        if 'charset=' in response.headers.get('Content-Type', ''):
+            charset = response.encoding or charset
+        decoder = codecs.getincrementaldecoder(charset)(errors='replace')
+
+        html = ''
+        for chunk in response.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+            html += decoder.decode(chunk)
+            attrs = scan_render_inject(html)
+            if attrs is not None:
+                return _render_data_from_attrs(attrs)
+        html += decoder.decode(b'', final=True)
+    finally:
+        response.close()
+
+    return extract_render_data(html)
 
 
 # Парсинг информации о товаре с веидиан
@@ -24,12 +136,24 @@ def parse_weidian_product(url):
     headers = {
         "User-Agent": "Mozilla/5.0"
     }
-    response = requests.get(url, headers=headers)
-    if response.status_code != 200:
-        raise Exception(f"Ошибка загрузки страницы: {response.status_code}")
+    return process_weidian_data(fetch_render_data(page_url(url), headers=headers))
+
+
+def extract_render_data(html):
+    """
+    Достаёт JSON из data-obj у script#__rocker-render-inject__.
+    Сначала быстрый сканер, затем разбор только нужного тега (SoupStrainer)
+    и в крайнем случае полный разбор страницы.
+    """
+    attrs = scan_render_inject(html)
+    if attrs is not None:
+        return _render_data_from_attrs(attrs)
 
-    soup = BeautifulSoup(response.text, 'html.parser')
-    script_tag = soup.find('script', {'id': '__rocker-render-inject__'})
+    only_inject = SoupStrainer('script', id=RENDER_INJECT_ID)
+    script_tag = BeautifulSoup(html, 'html.parser', parse_only=only_inject).find('script')
+    if not script_tag:
+        soup = BeautifulSoup(html, 'html.parser')
+        script_tag = soup.find('script', {'id': RENDER_INJECT_ID})
     if not script_tag:
         raise Exception("Не удалось найти данные о товаре")
 
@@ -37,7 +161,11 @@ def parse_weidian_product(url):
     if not json_data:
         raise Exception("Не удалось извлечь JSON-данные")
 
-    data = json.loads(json_data)
+    return json.loads(json_data)
+
+
+def process_weidian_data(data):
+    """Собирает словарь товара (модели по цвету и размеру) из данных страницы"""
     try:
         item_info = data['result']['default_model']['item_info']
         sku_properties = data['result']['default_model']['sku_properties']
@@ -48,6 +176,11 @@ def parse_weidian_product(url):
     
     title = item_info.get('item_name', 'Неизвестно')
 
+    # Название и все значения атрибутов переводятся одним пакетом
+    originals = [title] + [val['attr_value'] for attr in attr_list for val in attr.get('attr_values', [])]
+    translated = iter(translator.translate_many(originals))
+    title = next(translated)
+
     # Изменение здесь: переименовали price в base_price
     product = {
         'title': title,
@@ -59,13 +192,12 @@ def parse_weidian_product(url):
     for attr in attr_list:
         attr_values = {}
         for val in attr.get('attr_values', []):
-            original_val = val['attr_value']
-            translated_val = original_val
+            translated_val = next(translated)
             attr_values[str(val['attr_id'])] = translated_val
         attr_maps.append(attr_values)
                          
     models = {}
-    for sku in sku_data.values():
+    for sku_id, sku in sku_data.items():
         attr_ids = sku['attr_ids'].split('-')
         if len(attr_ids) != len(attr_maps):
             continue
@@ -85,6 +217,7 @@ def parse_weidian_product(url):
             }
 
         models[key]['sizes'].append({
+            'sku_id': str(sku_id),
             'size': size_name,
             'price': float(sku.get('price', 0)),
             'stock': sku.get('stock', 0)
@@ -93,6 +226,7 @@ def parse_weidian_product(url):
     for model in models.values():
         for size in model['sizes']:
             product['models'].append({
+                'sku_id': size['sku_id'],
                 'color_name': model['color'],
                 'size_name': size['size'],
                 'price': size['price'],
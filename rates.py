@@ -0,0 +1,288 @@
+import os
+import mmap
+import time
+import fcntl
+import struct
+import logging
+import threading
+from contextlib import contextmanager
+import http_client
+
+
+CBR_URL = os.getenv("CBR_URL", "https://www.cbr-xml-daily.ru/daily_json.js")
+RATES_TTL = int(os.getenv("RATES_TTL", 600))            # через сколько секунд курс считается устаревшим
+RATES_FETCH_TIMEOUT = float(os.getenv("RATES_FETCH_TIMEOUT", 5))
+# Пауза после неудачной холодной загрузки: до её конца запросы сразу получают None
+RATES_RETRY_BACKOFF = float(os.getenv("RATES_RETRY_BACKOFF", 30))
+# Файл общего снимка курсов для нескольких воркеров (пусто — у каждого процесса свой кэш)
+RATES_SHARED_PATH = os.getenv("RATES_SHARED_PATH", "")
+
+logger = logging.getLogger(__name__)
+
+
+class SharedRateSnapshot:
+    """
+    Снимок курсов USD и CNY в memory-mapped файле, общий для всех воркеров.
+
+    Пишет только процесс, взявший flock на <path>.lock; читатели ничего не
+    блокируют — согласованность обеспечивает счётчик версий (seqlock):
+    нечётное значение означает, что идёт запись, и чтение повторяется.
+    """
+
+    CODES = ("USD", "CNY")
+    # seq, fetched_at, USD, CNY, дата курса ЦБ (YYYY-MM-DD)
+    _LAYOUT = struct.Struct("<Qddd10s")
+
+    def __init__(self, path):
+        self.path = path
+        self._map = None
+        self._map_lock = threading.Lock()
+
+    def _mapping(self):
+        if self._map is None:
+            with self._map_lock:
+                if self._map is None:
+                    os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+                    fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+                    try:
+                        if os.fstat(fd).st_size < self._LAYOUT.size:
+                            os.ftruncate(fd, self._LAYOUT.size)
+                        self._map = mmap.mmap(fd, self._LAYOUT.size, access=mmap.ACCESS_WRITE)
+                    finally:
+                        os.close(fd)
+        return self._map
+
+    def read(self):
+        """Возвращает {'USD', 'CNY', 'date', 'fetched_at'} или None, если снимка ещё нет"""
+        buf = self._mapping()
+        for _ in range(100):
+            seq, fetched_at, usd, cny, rate_date = self._LAYOUT.unpack_from(buf)
+            if seq % 2:
+                continue
+            if self._LAYOUT.unpack_from(buf)[0] != seq:
+                continue
+            if seq == 0:
+                return None
+            return {
+                "USD": usd,
+                "CNY": cny,
+                "date": rate_date.decode("ascii", "ignore").strip("\x00"),
+                "fetched_at": fetched_at,
+            }
+        return None
+
+    def age(self):
+        snapshot = self.read()
+        return time.time() - snapshot["fetched_at"] if snapshot else float("inf")
+
+    def write(self, usd, cny, rate_date=""):
+        buf = self._mapping()
+        seq = self._LAYOUT.unpack_from(buf)[0]
+        struct.pack_into("<Q", buf, 0, seq + 1)
+        self._LAYOUT.pack_into(buf, 0, seq + 1, time.time(), usd, cny,
+                               str(rate_date)[:10].encode("ascii", "ignore"))
+        struct.pack_into("<Q", buf, 0, seq + 2)
+
+    @contextmanager
+    def writer(self, blocking=True):
+        """Межпроцессная блокировка писателя; отдаёт True, если она получена"""
+        fd = os.open(self.path + ".lock", os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
+
+
+class RateProvider:
+    """
+    Кэш ответа ЦБ (daily_json.js) на весь процесс.
+
+    - свежие данные отдаются из памяти;
+    - устаревшие тоже отдаются сразу, а обновление запускается в фоне;
+    - при ошибке загрузки остаётся последний удачный ответ.
+    Сетевой запрос в пути обработки запроса происходит только при холодном старте,
+    причём один на процесс; после его неудачи retry_backoff секунд в сеть не ходим.
+    Если задан shared_path, USD и CNY берутся из общего для воркеров снимка,
+    и в сеть за ними ходит только один процесс.
+    """
+
+    def __init__(self, url=CBR_URL, ttl=RATES_TTL, timeout=RATES_FETCH_TIMEOUT,
+                 shared_path=RATES_SHARED_PATH, retry_backoff=RATES_RETRY_BACKOFF):
+        self.url = url
+        self.ttl = ttl
+        self.timeout = timeout
+        self.retry_backoff = retry_backoff
+        self.shared = SharedRateSnapshot(shared_path) if shared_path else None
+        self._payload = None
+        self._fetched_at = 0.0
+        self._lock = threading.Lock()
+        self._refreshing = False
+        self._cold_lock = threading.Lock()
+        self._failed_at = 0.0
+        self._listeners = []
+
+    def on_refresh(self, callback):
+        """Регистрирует callback(payload), вызываемый после каждой удачной загрузки"""
+        self._listeners.append(callback)
+        return callback
+
+    def _fetch(self):
+        response = http_client.get(self.url, timeout=self.timeout)
+        response.raise_for_status()
+        data = response.json()
+        if 'Valute' not in data:
+            raise ValueError("В ответе ЦБ нет раздела Valute")
+        return data
+
+    def refresh(self, blocking=True):
+        """Синхронно загружает курсы. Возвращает True при успехе."""
+        try:
+            if self.shared is None:
+                data = self._fetch()
+            else:
+                with self.shared.writer(blocking=blocking) as acquired:
+                    if not acquired:
+                        # обновлением уже занят другой воркер
+                        return False
+                    if self.shared.age() < self.ttl:
+                        return True
+                    data = self._fetch()
+                    self.shared.write(
+                        self._rate_from(data, "USD"),
+                        self._rate_from(data, "CNY"),
+                        str(data.get("Date") or "")[:10],
+                    )
+        except Exception as e:
+            logger.error(f"Ошибка при получении курса ЦБ: {e}")
+            self._failed_at = time.time()
+            return False
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+        with self._lock:
+            self._payload = data
+            self._fetched_at = time.time()
+
+        for callback in self._listeners:
+            try:
+                callback(data)
+            except Exception as e:
+                logger.error(f"Ошибка обработчика обновления курсов: {e}")
+        return True
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        threading.Thread(target=self.refresh, kwargs={"blocking": False}, daemon=True).start()
+
+    def is_stale(self):
+        return time.time() - self._fetched_at >= self.ttl
+
+    def _in_backoff(self):
+        return time.time() - self._failed_at < self.retry_backoff
+
+    def _cold_refresh(self, loaded):
+        """
+        Загрузка при холодном старте: потоки процесса ждут один запрос,
+        а не шлют каждый свой. loaded() — появились ли уже курсы.
+        """
+        if self._in_backoff():
+            return
+        with self._cold_lock:
+            if not loaded() and not self._in_backoff():
+                self.refresh()
+
+    def get_payload(self):
+        """Возвращает весь ответ ЦБ (last-known-good) или None, если курсов ещё не было"""
+        if self._payload is None:
+            self._cold_refresh(lambda: self._payload is not None)
+        elif self.is_stale():
+            self._refresh_in_background()
+        return self._payload
+
+    @staticmethod
+    def _rate_from(payload, code):
+        try:
+            valute = payload["Valute"][code]
+            return float(valute["Value"]) / float(valute.get("Nominal", 1) or 1)
+        except (KeyError, TypeError, ValueError, ZeroDivisionError):
+            return None
+
+    def _get_shared_snapshot(self):
+        snapshot = self.shared.read()
+        if snapshot is None:
+            self._cold_refresh(lambda: self.shared.read() is not None)
+            snapshot = self.shared.read()
+        elif time.time() - snapshot["fetched_at"] >= self.ttl:
+            self._refresh_in_background()
+        return snapshot
+
+    def get_rates(self, codes):
+        """Курсы нескольких валют из одного снимка/ответа ЦБ: {код: курс или None}"""
+        if self.shared is not None and all(code in SharedRateSnapshot.CODES for code in codes):
+            snapshot = self._get_shared_snapshot()
+            return {code: snapshot[code] if snapshot else None for code in codes}
+        payload = self.get_payload()
+        return {code: self._rate_from(payload, code) if payload else None for code in codes}
+
+    def get_rate(self, code):
+        """Курс валюты в рублях за 1 единицу (с учётом Nominal) или None"""
+        return self.get_rates((code,))[code]
+
+    def start(self, interval=None):
+        """Запускает фоновый поток, обновляющий курсы до истечения TTL"""
+        interval = interval or max(self.ttl / 2, 1)
+
+        def run():
+            while True:
+                self.refresh(blocking=False)
+                time.sleep(interval)
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return thread
+
+
+rate_provider = RateProvider()
+
+
+def get_cny_to_rub_rate():
+    return rate_provider.get_rate("CNY")
+
+
+def fetch_cbr_rates():
+    rates = rate_provider.get_rates(("USD", "CNY"))
+    if None in rates.values():
+        return None
+    return rates
+
+
+def convert_rub_to_cny(rub_amount, cny_to_rub_rate=None):
+    if cny_to_rub_rate is None:
+        cny_to_rub_rate = get_cny_to_rub_rate()
+    if cny_to_rub_rate is None:
+        return None
+
+    cny_amount = rub_amount / cny_to_rub_rate
+    return round(cny_amount, 2)
+
+
+def convert_cny_to_rub(cny_amount, cny_to_rub_rate=None):
+    if cny_to_rub_rate is None:
+        cny_to_rub_rate = get_cny_to_rub_rate()
+    if cny_to_rub_rate is None:
+        return None
+
+    rub_amount = cny_amount * cny_to_rub_rate
+    return round(rub_amount, 2)